@@ -0,0 +1,161 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+import numpy as np
+import time
+from .audio import Audio
+from .ringbuffer import RingBuffer
+
+
+class AudioAnalyzer(object):
+    """
+    Computes a magnitude spectrum, RMS level, spectral flux and onset events from audio in a
+    :class:`~imslib.ringbuffer.RingBuffer`. All analysis happens in :meth:`on_update`, on the thread that
+    calls it (usually the UI thread), so the audio path only pays for the ring buffer copy.
+
+    To analyze the output audio, add the ring buffer with :meth:`Audio.add_tap`. To analyze input audio,
+    pass the ring buffer's :meth:`~imslib.ringbuffer.RingBuffer.write` as ``input_func`` to :class:`Audio`.
+
+    Audio is mixed down to mono and analyzed in hops of *fft_size / 2* frames, each using a hann window over
+    the last *fft_size* frames. After :meth:`on_update`, the results of the most recent hop are in
+    :attr:`magnitude`, :attr:`rms` and :attr:`flux`.
+    """
+
+    def __init__(self, ring, fft_size = 1024, onset_threshold = 1.5, onset_history = 16, min_onset_interval = 0.05):
+        """
+        :param ring: The :class:`~imslib.ringbuffer.RingBuffer` to analyze.
+        :param fft_size: Number of frames per FFT. Should be a power of two.
+        :param onset_threshold: An onset is reported when the spectral flux is a local peak and is larger
+            than this factor times the average flux of the recent past.
+        :param onset_history: Number of hops averaged to get the flux of the recent past.
+        :param min_onset_interval: Minimum time (in seconds) between two onsets.
+        """
+        super(AudioAnalyzer, self).__init__()
+
+        self.reader = ring.get_reader()
+        self.num_channels = ring.num_channels
+        self.fft_size = fft_size
+        self.hop_size = fft_size // 2
+
+        self.onset_threshold = onset_threshold
+        self.min_onset_interval = min_onset_interval
+        self.onset_funcs = []
+
+        # preallocated buffers
+        self.window = np.hanning(fft_size).astype(np.float32)
+        self.history = np.zeros(fft_size, dtype=np.float32)
+        self.windowed = np.empty(fft_size, dtype=np.float32)
+        self.magnitude = np.zeros(fft_size // 2 + 1, dtype=np.float32)
+        self.prev_magnitude = np.zeros(fft_size // 2 + 1, dtype=np.float32)
+        self.diff = np.empty(fft_size // 2 + 1, dtype=np.float32)
+        self.read_buf = np.empty(self.hop_size * self.num_channels, dtype=np.float32)
+        self.flux_history = np.zeros(onset_history)
+
+        self.rms = 0
+        self.flux = 0
+        self.frame = self.reader.pos
+        self.pending = 0        # frames of the current hop already in history
+        self.prev_flux = 0
+        self.last_onset = -1
+
+    def add_onset_func(self, fn):
+        """
+        Adds a function that is called from :meth:`on_update` for every detected onset.
+
+        :param fn: A function with signature ``fn(time, strength)``, where *time* is the position of the onset
+            in the audio stream in seconds and *strength* is its spectral flux.
+        """
+        self.onset_funcs.append(fn)
+
+    def get_frequencies(self):
+        """
+        :returns: The center frequency (in Hz) of each bin in :attr:`magnitude`.
+        """
+        return np.fft.rfftfreq(self.fft_size, 1.0 / Audio.sample_rate)
+
+    def on_update(self):
+        """
+        Reads all new audio from the ring buffer and analyzes every complete hop. Should be called once per
+        graphics frame. If more audio arrived than a few hops' worth, the oldest is skipped so that analysis
+        never falls behind.
+        """
+        max_frames = 4 * self.fft_size
+        if self.reader.get_available() > max_frames:
+            self.reader.pos = self.reader.ring.get_write_pos() - max_frames
+            self.pending = 0
+
+        while True:
+            need = self.hop_size - self.pending
+            data = self.reader.read(need, self.read_buf)
+            n = len(data) // self.num_channels
+            if n == 0:
+                break
+
+            # shift new mono frames into the end of the history
+            self.history[:-n] = self.history[n:]
+            if self.num_channels == 1:
+                self.history[-n:] = data
+            else:
+                np.mean(data.reshape(n, self.num_channels), axis=1, out=self.history[-n:])
+
+            self.pending += n
+            self.frame = self.reader.pos
+            if self.pending == self.hop_size:
+                self.pending = 0
+                self._analyze()
+
+    # analyze the current history window
+    def _analyze(self):
+        np.multiply(self.history, self.window, out=self.windowed)
+        self.rms = float(np.sqrt(np.dot(self.history, self.history) / self.fft_size))
+
+        self.prev_magnitude, self.magnitude = self.magnitude, self.prev_magnitude
+        np.abs(np.fft.rfft(self.windowed), out=self.magnitude)
+
+        # spectral flux: total increase in magnitude over all bins
+        np.subtract(self.magnitude, self.prev_magnitude, out=self.diff)
+        np.maximum(self.diff, 0, out=self.diff)
+        flux = float(self.diff.sum())
+
+        # the previous hop is an onset if it was a local peak above the recent average
+        avg = self.flux_history.mean()
+        t = (self.frame - self.hop_size) / Audio.sample_rate
+        if self.prev_flux > flux and self.prev_flux > self.onset_threshold * avg and avg > 0 and \
+           t - self.last_onset >= self.min_onset_interval:
+            self.last_onset = t
+            for fn in self.onset_funcs:
+                fn(t, self.prev_flux)
+
+        self.flux_history[:-1] = self.flux_history[1:]
+        self.flux_history[-1] = flux
+        self.prev_flux = flux
+        self.flux = flux
+
+
+def benchmark_analyzer(buffer_sizes = (512, 1024, 2048), num_blocks = 2000):
+    """
+    Feeds noise through a stereo :class:`AudioAnalyzer` one audio buffer at a time, and prints the average
+    cost of analyzing each buffer for different buffer sizes (with the FFT size equal to the buffer size).
+    """
+    for size in buffer_sizes:
+        ring = RingBuffer(8 * size, 2)
+        analyzer = AudioAnalyzer(ring, size)
+        block = np.random.uniform(-1, 1, size * 2).astype(np.float32)
+
+        elapsed = 0
+        for b in range(num_blocks):
+            ring.write(block, 2)
+            t_start = time.perf_counter()
+            analyzer.on_update()
+            elapsed += time.perf_counter() - t_start
+
+        print('buffer size %4d: %7.1f us per block (%.2f%% of real time)' %
+              (size, 1e6 * elapsed / num_blocks, 100 * elapsed / (num_blocks * size / Audio.sample_rate)))
+
+
+if __name__ == "__main__":
+    benchmark_analyzer()
@@ -18,9 +18,134 @@ import pyaudio
 import numpy as np
 import time
 import platform
+import threading
+import traceback
+from collections import deque
 
 system  = platform.system()
 
+
+# Commands posted from other threads (ie, the UI thread) that must run on the audio thread.
+# deque.append() and deque.popleft() are atomic, so no locking is needed between the single
+# producer (UI thread) and single consumer (audio thread).
+g_audio_commands = deque()
+
+# thread id of the PortAudio callback thread, when Audio is running in callback mode.
+# kAudioThreadPending while the stream is open but has not called back yet.
+g_audio_thread_id = None
+kAudioThreadPending = -1
+
+def run_on_audio_thread(func, *args):
+    """
+    Calls ``func(*args)`` on the audio thread. When Audio is running in callback mode (see
+    :attr:`Audio.callback_mode`) and this is called from another thread, the call is queued and
+    will execute right before the next audio buffer is generated. Otherwise, ``func`` is called
+    right away.
+
+    :param func: The function to call.
+    :param args: Arguments to pass into ``func``.
+    """
+    if is_audio_thread():
+        func(*args)
+    else:
+        g_audio_commands.append((func, args))
+
+def is_audio_thread():
+    """
+    :returns: True if called from the thread that generates audio. When Audio is not running in
+        callback mode, audio is generated from :meth:`Audio.on_update`, so this is always True.
+        In callback mode, no thread is the audio thread until the stream's first callback runs.
+    """
+    return g_audio_thread_id is None or g_audio_thread_id == threading.get_ident()
+
+def _process_audio_commands():
+    while g_audio_commands:
+        func, args = g_audio_commands.popleft()
+        # a failing command must not kill the audio callback or drop the commands after it
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+
+
+# optional profiler that times every generator (see imslib.profiler and set_profiler())
+g_profiler = None
+
+def set_profiler(profiler):
+    """
+    Turns on per-generator profiling. While a profiler is set, every call made through
+    :func:`generate_into` (which is how :class:`Audio`, :class:`~imslib.mixer.Mixer`,
+    :class:`~imslib.clock.AudioScheduler` and the other imslib generators call their inputs) is timed.
+
+    :param profiler: A :class:`~imslib.profiler.Profiler`, or None to turn profiling off.
+    """
+    global g_profiler
+    g_profiler = profiler
+
+def generate_into(gen, out, num_frames, num_channels):
+    """
+    Asks a generator to write audio into a caller-owned buffer. If the generator defines
+    ``generate_into(out, num_frames, num_channels)``, that is used directly and no memory is
+    allocated. Otherwise, falls back to ``generate(num_frames, num_channels)`` and copies the result
+    into ``out``.
+
+    :param gen: The generator object.
+    :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+    :param num_frames: An integer number of frames to generate.
+    :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+    :returns: The generator's continue_flag.
+    """
+    if g_profiler is not None:
+        return g_profiler.time_generate(gen, out, num_frames, num_channels)
+    return _generate_into(gen, out, num_frames, num_channels)
+
+def _generate_into(gen, out, num_frames, num_channels):
+    if hasattr(gen, 'generate_into'):
+        return gen.generate_into(out, num_frames, num_channels)
+
+    (data, continue_flag) = gen.generate(num_frames, num_channels)
+
+    # make sure we got the correct number of frames that we requested
+    assert len(data) == len(out), \
+        "asked for (%d * %d) frames but got %d" % (num_frames, num_channels, len(data))
+
+    out[:] = data
+    return continue_flag
+
+
+def reserve_buffer(buf, size):
+    """
+    Helper for generators that keep preallocated scratch buffers.
+
+    :param buf: A numpy array.
+    :param size: The number of samples needed.
+
+    :returns: ``buf`` if it is large enough, otherwise a new (uninitialized) array of length *size*
+        with the same dtype as ``buf``.
+    """
+    if len(buf) < size:
+        buf = np.empty(size, dtype=buf.dtype)
+    return buf
+
+
+# shared [0, 1, 2, ...] sequence used by generators to build time series
+g_frame_ramp = np.arange(0, dtype=np.float64)
+
+def frame_ramp(num_frames):
+    """
+    :param num_frames: Length of the ramp.
+
+    :returns: A read-only float64 array ``[0, 1, 2, ..., num_frames-1]``. The array is shared
+        between callers, so it must not be modified.
+    """
+    global g_frame_ramp
+    if len(g_frame_ramp) < num_frames:
+        g_frame_ramp = np.arange(max(num_frames, 2 * len(g_frame_ramp)), dtype=np.float64)
+        g_frame_ramp.flags.writeable = False
+    return g_frame_ramp[:num_frames]
+
+
 class Audio(object):
     """
     Audio input and output stream manager. Only one `Audio` object should be created. Audio output
@@ -48,6 +173,22 @@ class Audio(object):
     :param Audio.in_dev: Can specify a non-default audio input device (via integer index).
         See :meth:`print_audio_devices`. Default is None, which chooses the default input device.
 
+    :param Audio.sample_dtype: The numpy type of audio samples passed between generators. Defaults to
+        ``np.float32``, which matches the format of the audio stream so that no conversion is needed
+        before audio is sent to the device. All generators in imslib produce this type.
+
+    :param Audio.callback_mode: If True, audio is generated on a dedicated PortAudio thread that
+        pulls from the generator whenever the device needs more data, instead of in :meth:`on_update`.
+        This allows much smaller buffer sizes (128-256) without glitching when a graphics frame stalls.
+        Calls from the UI thread that modify the generator chain are passed to the audio thread
+        with :func:`run_on_audio_thread`. Default is False.
+
+    :param Audio.adaptive_fill: If True (and not in callback mode), Audio only keeps a *target fill level* of
+        audio queued in the output stream instead of filling it completely. The target grows after each
+        underrun and slowly shrinks back while playback is stable, so latency stays as low as the machine
+        allows. It never shrinks below what is needed to cover the longest recent gap between
+        :meth:`on_update` calls, nor back down to a level that has already underrun.
+        See :meth:`get_output_latency`. Default is False.
 
 
     .. note::
@@ -64,8 +205,17 @@ class Audio(object):
     buffer_size = 1024 if system == 'Linux' else 512
     out_dev = None
     in_dev = None
+    sample_dtype = np.float32
+    callback_mode = False
+    adaptive_fill = False
+
+    # adaptive fill: how long (in seconds) playback must be stable before the target fill shrinks
+    kStableTime = 2.0
+    # adaptive fill: the target always covers this many times the longest recent on_update() interval
+    kUpdateMargin = 1.5
 
     def __init__(self, num_channels, input_func = None, num_input_channels = 1):
+        global g_audio_thread_id
         super(Audio, self).__init__()
 
         assert(num_channels == 1 or num_channels == 2)
@@ -75,6 +225,7 @@ class Audio(object):
 
         self.audio = pyaudio.PyAudio()
         self.listen_funcs = []
+        self.taps = []
 
         # on windows, if '-asio' found in command-line-args, use ASIO drivers
         if '-asio' in sys.argv:
@@ -85,16 +236,44 @@ class Audio(object):
     buffer size:     {Audio.buffer_size}
     output device:   {'default' if Audio.out_dev is None else Audio.out_dev}
     input device:    {'default' if Audio.in_dev is None else Audio.in_dev}
+    callback mode:   {Audio.callback_mode}
+    adaptive fill:   {Audio.adaptive_fill}
 ''')
 
-        # create output stream
+        self.generator = None
+        self.cpu_time = 0
+        self.underruns = 0
+        self.out_buffer = np.empty(0, dtype=Audio.sample_dtype)
+
+        # create output stream. In callback mode, PortAudio calls _stream_callback from its own thread.
+        # The stream can call back before open() returns, so from here on changes made by other threads
+        # are queued until that first callback takes them (see run_on_audio_thread).
+        if Audio.callback_mode:
+            g_audio_thread_id = kAudioThreadPending
         self.stream = self.audio.open(format = pyaudio.paFloat32,
                                       channels = num_channels,
                                       frames_per_buffer = Audio.buffer_size,
                                       rate = Audio.sample_rate,
                                       output = True,
                                       input = False,
-                                      output_device_index = Audio.out_dev)
+                                      output_device_index = Audio.out_dev,
+                                      stream_callback = self._stream_callback if Audio.callback_mode else None)
+
+        # in blocking mode, the stream starts empty, so its capacity is what's available to write.
+        # fill is the number of frames queued in the stream as of the last on_update()
+        self.stream_capacity = 0 if Audio.callback_mode else self.stream.get_write_available()
+        self.target_fill = self.stream_capacity
+        if Audio.adaptive_fill:
+            self.target_fill = min(self.stream_capacity, Audio.buffer_size)
+        self.fill = 0
+        self.was_writing = False
+        self.stable_time = 0
+        self.last_update = time.time()
+        # longest on_update() interval in the current and previous kStableTime windows
+        self.max_dt = 0
+        self.prev_max_dt = 0
+        # the target fill never shrinks to or below a level that has underrun
+        self.fill_floor = 0
 
         # create input stream
         self.input_stream = None
@@ -107,30 +286,45 @@ class Audio(object):
                                                 input = True,
                                                 input_device_index = Audio.in_dev)
 
-        self.generator = None
-        self.cpu_time = 0
         register_terminate_func(self._close)
 
     def set_generator(self, gen):
         """
         Sets a Generator object that must supply audio data to Audio. Generator must define the
         method ``generate(num_frames, num_channels)``, which returns a numpy array of
-        length *(num_frames * num_channels)*.
+        length *(num_frames * num_channels)*. If the generator also defines
+        ``generate_into(out, num_frames, num_channels)``, that will be used instead to avoid
+        allocating new memory for every buffer (see :func:`generate_into`).
 
         :param gen: The generator object. May be `None`.
 
         """
+        run_on_audio_thread(self._set_generator, gen)
+
+    def _set_generator(self, gen):
         self.generator = gen
 
     def add_listen_func(self, fn):
         """
         Adds a listener function to Audio. When a buffer of audio is generated and about to be sent to
-        the speaker, that audio will also be sent to the given function by calling ``fn(data, num_channels)``
+        the speaker, that audio will also be sent to the given function by calling ``fn(data, num_channels)``.
+        ``data`` is reused for the next buffer, so listeners that hold on to it must make a copy.
 
         :param fn: A function to be called when a buffer of audio is generated.
         """
         self.listen_funcs.append(fn)
 
+    def add_tap(self, ring):
+        """
+        Adds a ring buffer tap. Each buffer of audio sent to the speaker is copied into the ring buffer,
+        which consumers can read from any thread at their own pace (see :class:`~imslib.ringbuffer.RingBuffer`).
+        Unlike listen functions, slow consumers add nothing to the time spent generating audio.
+
+        :param ring: A :class:`~imslib.ringbuffer.RingBuffer` with the same number of channels as Audio.
+        """
+        assert(ring.num_channels == self.num_channels)
+        self.taps.append(ring)
+
 
     def get_cpu_load(self):
         """
@@ -140,6 +334,34 @@ class Audio(object):
         """
         return 1000 * self.cpu_time
 
+    def get_underruns(self):
+        """
+        :returns: The number of times the output device ran out of audio (causing a glitch) since Audio was created.
+        """
+        return self.underruns
+
+    def get_output_latency(self):
+        """
+        :returns: The current effective output latency in seconds: the time from when audio is generated
+            until it is heard. In blocking mode, this includes the audio currently queued in the stream, so it
+            changes as the (adaptive) fill level changes. Game code can subtract this from the position of a
+            generator to find out what is being heard right now.
+        """
+        latency = self.stream.get_output_latency()
+        if Audio.callback_mode:
+            return latency
+
+        # the reported device latency covers the whole stream buffer. Replace the buffer part with
+        # what is actually queued right now.
+        capacity = self.stream_capacity / Audio.sample_rate
+        return self.fill / Audio.sample_rate + max(0, latency - capacity)
+
+    def get_target_fill(self):
+        """
+        :returns: The number of frames Audio tries to keep queued in the output stream (blocking mode only).
+        """
+        return self.target_fill
+
     def on_update(self):
         """
         Must be called by the app (`MainWidget`) very often - usually 60 times per second. Typically,
@@ -154,40 +376,135 @@ class Audio(object):
                 num_frames = self.input_stream.get_read_available() # number of frames to ask for
                 if num_frames:
                     data_str = self.input_stream.read(num_frames, False)
-                    data_np = np.fromstring(data_str, dtype=np.float32)
+                    data_np = np.frombuffer(data_str, dtype=np.float32).astype(Audio.sample_dtype, copy=False)
                     self.input_func(data_np, self.num_input_channels)
             except IOError as e:
                 print('got error', e)
 
+        # in callback mode, output audio is generated by _stream_callback on the audio thread.
+        if Audio.callback_mode:
+            return
+
         # Ask the generator to generate some audio samples.
-        num_frames = self.stream.get_write_available() # number of frames to supply
+        available = self.stream.get_write_available()
+        self.fill = self.stream_capacity - available
+
+        # only top up to the target fill level
+        num_frames = min(available, max(0, self.target_fill - self.fill)) # number of frames to supply
+
+        # an empty stream means it ran dry since the last write
+        underrun = self.was_writing and self.fill <= 0
+        self.was_writing = bool(self.generator)
+
         if self.generator and num_frames != 0:
-            (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
+            data = self._generate(num_frames)
+            # only ask PortAudio to report underflow when adapting the fill level. Without adaptive_fill,
+            # underruns are still counted from an empty stream, and a write never raises as before.
+            try:
+                self.stream.write(self._to_stream_bytes(data), exception_on_underflow=Audio.adaptive_fill)
+            except IOError:
+                # the data is still written, but the device had already run dry before this write
+                underrun = True
+            self.fill += num_frames
 
-            # make sure we got the correct number of frames that we requested
-            assert len(data) == num_frames * self.num_channels, \
-                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+            # how long this all took (only calculate if num_frames != 0)
+            self._update_cpu_time(time.time() - t_start)
+
+        if underrun:
+            self.underruns += 1
+        if Audio.adaptive_fill:
+            self._adapt_fill(underrun, t_start - self.last_update)
+        self.last_update = t_start
+
+    # grow the target fill level quickly after an underrun, and shrink it slowly while things are stable.
+    # The target stays above the frames needed to get through the longest recent update interval,
+    # and above any level that has underrun before.
+    def _adapt_fill(self, underrun, dt):
+        self.max_dt = max(self.max_dt, dt)
+        step = Audio.buffer_size // 4
+
+        if underrun:
+            self.fill_floor = max(self.fill_floor, self.target_fill + step)
+            self.target_fill = min(self.stream_capacity, self.target_fill * 2)
+            self.stable_time = 0
+            return
+
+        self.stable_time += dt
+        if self.stable_time > Audio.kStableTime:
+            self.stable_time = 0
+            needed = int(max(self.max_dt, self.prev_max_dt) * Audio.sample_rate * Audio.kUpdateMargin)
+            self.prev_max_dt = self.max_dt
+            self.max_dt = 0
+
+            min_fill = min(self.stream_capacity, max(Audio.buffer_size, needed, self.fill_floor))
+            self.target_fill = max(min_fill, self.target_fill - step)
+
+    # called by PortAudio from its own thread when the output device needs more data
+    def _stream_callback(self, in_data, frame_count, time_info, status):
+        global g_audio_thread_id
+        g_audio_thread_id = threading.get_ident()
 
-            # convert type if needed and write to stream
-            if data.dtype != np.float32:
-                data = data.astype(np.float32)
-            self.stream.write(data.tobytes())
+        t_start = time.time()
 
-            # send data to listener functions as well
-            for fn in self.listen_funcs:
+        if status & pyaudio.paOutputUnderflow:
+            self.underruns += 1
+
+        # apply changes posted by other threads before generating this buffer
+        _process_audio_commands()
+
+        if self.generator:
+            data = self._to_stream_bytes(self._generate(frame_count))
+        else:
+            data = bytes(4 * frame_count * self.num_channels)
+
+        self._update_cpu_time(time.time() - t_start)
+        return (data, pyaudio.paContinue)
+
+    # the stream is always float32. Only convert if Audio.sample_dtype is something else.
+    def _to_stream_bytes(self, data):
+        if data.dtype != np.float32:
+            data = data.astype(np.float32)
+        return data.tobytes()
+
+    # ask the generator for num_frames of audio and send that audio to the listener functions.
+    # Returns the audio as a numpy array of Audio.sample_dtype, which is a view into self.out_buffer.
+    def _generate(self, num_frames):
+        num_samples = num_frames * self.num_channels
+        self.out_buffer = reserve_buffer(self.out_buffer, num_samples)
+        data = self.out_buffer[:num_samples]
+
+        profiler = g_profiler
+        if profiler:
+            profiler.begin_block(self)
+
+        continue_flag = generate_into(self.generator, data, num_frames, self.num_channels)
+
+        # send data to taps and listener functions as well
+        for ring in self.taps:
+            ring.write(data, self.num_channels)
+        for fn in self.listen_funcs:
+            if profiler:
+                profiler.time_call(fn, data, self.num_channels)
+            else:
                 fn(data, self.num_channels)
 
-            # continue flag
-            if not continue_flag:
-                self.generator = None
+        if profiler:
+            profiler.end_block()
 
-            # how long this all took (only calculate if num_frames != 0)
-            dt = time.time() - t_start
-            a = 0.9
-            self.cpu_time = a * self.cpu_time + (1-a) * dt
+        # continue flag
+        if not continue_flag:
+            self.generator = None
+
+        return data
+
+    def _update_cpu_time(self, dt):
+        a = 0.9
+        self.cpu_time = a * self.cpu_time + (1-a) * dt
 
     def _close(self):
+        global g_audio_thread_id
         self.stream.stop_stream()
+        g_audio_thread_id = None
         self.stream.close()
         if self.input_stream:
             self.input_stream.stop_stream()
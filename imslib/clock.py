@@ -6,8 +6,11 @@
 #####################################################################
 
 import time
+import heapq
+import bisect
+import itertools
 import numpy as np
-from .audio import Audio
+from .audio import Audio, generate_into, run_on_audio_thread
 
 
 # Simple time keeper object. It starts at 0 and knows how to pause
@@ -34,7 +37,7 @@ class Clock(object):
         if self.paused:
             return self.offset
         else:
-            return self.offset + time.time()
+            return self.offset + self._now()
 
     def set_time(self, t):
         """
@@ -45,7 +48,7 @@ class Clock(object):
         if self.paused:
             self.offset = t
         else:
-            self.offset = t - time.time()
+            self.offset = t - self._now()
 
     def start(self):
         """
@@ -53,7 +56,7 @@ class Clock(object):
         """
         if self.paused:
             self.paused = False
-            self.offset -= time.time()
+            self.offset -= self._now()
 
     def stop(self):
         """
@@ -61,7 +64,7 @@ class Clock(object):
         """
         if not self.paused:
             self.paused = True
-            self.offset += time.time()
+            self.offset += self._now()
 
     def toggle(self):
         """
@@ -72,6 +75,140 @@ class Clock(object):
         else:
             self.stop()
 
+    # the underlying time source
+    def _now(self):
+        return time.time()
+
+
+class VirtualClock(Clock):
+    """
+    A :class:`Clock` that is driven by the caller instead of by wall-clock time. Time only moves
+    forward when :meth:`advance` is called, which lets :class:`Scheduler`-based code run faster
+    (or slower) than real time, for example inside :class:`~imslib.render.OfflineRenderer`.
+    """
+    def __init__(self):
+        self.now = 0
+        super(VirtualClock, self).__init__()
+
+    def advance(self, dt):
+        """
+        Moves the underlying time source forward. If the clock is paused, its time does not change.
+
+        :param dt: Amount of time to advance, in seconds.
+        """
+        self.now += dt
+
+    def _now(self):
+        return self.now
+
+
+class SongClock(object):
+    """
+    Estimates the song time that is being *heard* right now, for rhythm games and anything else that has to
+    line up visuals or input with audio.
+
+    The frame counter of a generator (such as :attr:`WaveGenerator.frame <imslib.wavegen.WaveGenerator.frame>`)
+    is where audio is being written, which is ahead of what is heard by the output latency, and only moves
+    in jumps of one audio block. SongClock subtracts :meth:`Audio.get_output_latency` and interpolates between
+    blocks with the wall clock, gently slewing towards the measured time so that the result is smooth and never
+    goes backwards during playback. Big differences (like seeking) are applied right away.
+
+    A user offset (for example, for the latency of the speakers or headphones) can be set directly with
+    :meth:`set_offset`, or measured by tapping along to known beats with :meth:`add_calibration_tap` and
+    :meth:`end_calibration`.
+    """
+
+    # fraction of the measurement error corrected on every call, and the error beyond which we jump
+    kSlewRate = 0.1
+    kSnapError = 0.05
+
+    def __init__(self, audio, generator, offset = 0):
+        """
+        :param audio: The :class:`~imslib.audio.Audio` object that is playing the generator.
+        :param generator: The generator that plays the song. Must have a ``frame`` attribute.
+        :param offset: User offset (in seconds) subtracted from the song time.
+        """
+        super(SongClock, self).__init__()
+
+        self.audio = audio
+        self.generator = generator
+        self.offset = offset
+
+        self.anchor_time = None     # audible song time measured at the last audio update
+        self.anchor_wall = 0        # wall time of that measurement
+        self.anchor_key = None
+        self.time = None            # last returned song time
+        self.wall = 0               # wall time when it was returned
+
+        self.calibration_errors = []
+
+    def get_time(self):
+        """
+        :returns: The estimated song time (in seconds) that is audible right now. Meant to be called once
+            or more per display frame, after :meth:`Audio.on_update`.
+        """
+        now = time.perf_counter()
+        frame = self.generator.frame
+        latency = self.audio.get_output_latency()
+
+        # a new measurement is only available after the audio stream was written to
+        if (frame, latency) != self.anchor_key:
+            self.anchor_key = (frame, latency)
+            self.anchor_time = frame / Audio.sample_rate - latency
+            self.anchor_wall = now
+
+        # audio plays on in real time since the last measurement, but never past what was written
+        written = frame / Audio.sample_rate
+        target = min(self.anchor_time + (now - self.anchor_wall), written) - self.offset
+
+        if self.time is None or abs(target - self.time) > SongClock.kSnapError:
+            self.time = target
+        else:
+            # advance with the wall clock, slew towards the measurement, and don't go backwards
+            estimate = min(self.time + (now - self.wall), written - self.offset)
+            estimate += (target - estimate) * SongClock.kSlewRate
+            self.time = max(self.time, estimate)
+
+        self.wall = now
+        return self.time
+
+    def set_offset(self, offset):
+        """
+        :param offset: User offset (in seconds) subtracted from the song time. Positive values compensate for
+            extra latency that Audio does not know about, such as Bluetooth headphones.
+        """
+        self.offset = offset
+
+    def get_offset(self):
+        """
+        :returns: The current user offset, in seconds.
+        """
+        return self.offset
+
+    def add_calibration_tap(self, period, phase = 0):
+        """
+        Records one tap of a calibration routine, in which the user taps along to a steady beat in the song.
+        Call this when the user taps. The error is measured against the nearest beat.
+
+        :param period: Time between beats, in seconds.
+        :param phase: Song time of any one beat, in seconds.
+        """
+        t = self.get_time() - phase
+        error = (t + 0.5 * period) % period - 0.5 * period
+        self.calibration_errors.append(error)
+
+    def end_calibration(self):
+        """
+        Ends a calibration routine. The median tap error is added to the user offset, so that from now on the
+        beats line up with the taps.
+
+        :returns: The new user offset, in seconds. If no taps were recorded, the offset is not changed.
+        """
+        if self.calibration_errors:
+            self.offset += float(np.median(self.calibration_errors))
+            self.calibration_errors = []
+        return self.offset
+
 
 # For tempo maps - converting bpm to ticks
 kTicksPerQuarter = 480
@@ -111,6 +248,27 @@ class SimpleTempoMap(object):
         time = (tick - self.tick_offset) / slope
         return time
 
+    def times_to_ticks(self, times):
+        """
+        Converts many times into tick numbers at once.
+
+        :param times: A numpy array (or list) of times, in seconds.
+        :returns: A numpy array of the corresponding (integer) ticks.
+        """
+        slope = (kTicksPerQuarter * self.bpm) / 60.
+        ticks = slope * np.asarray(times, dtype=float) + self.tick_offset
+        return ticks.astype(int)
+
+    def ticks_to_times(self, ticks):
+        """
+        Converts many tick numbers into times at once.
+
+        :param ticks: A numpy array (or list) of ticks.
+        :returns: A numpy array of the corresponding times, in seconds.
+        """
+        slope = (kTicksPerQuarter * self.bpm) / 60.
+        return (np.asarray(ticks, dtype=float) - self.tick_offset) / slope
+
     def set_tempo(self, bpm, cur_time):
         """
         Sets the tempo to a new bpm.
@@ -148,6 +306,11 @@ class TempoMap(object):
     """
     A tempo map that reads points of timestamped ticks and linearly
     interpolates between points to determine tempo.
+
+    Points are stored as numpy arrays along with the slope of each segment. Single lookups
+    remember the last segment used, so successive lookups at nearby times are O(1), and otherwise
+    use a binary search. Use :meth:`times_to_ticks` and :meth:`ticks_to_times` to convert
+    many values at once.
     """
     def __init__(self, data = None, filepath = None):
         """
@@ -165,7 +328,25 @@ class TempoMap(object):
         assert(data[0] == (0,0))
         assert(len(data) > 1)
 
-        self.times, self.ticks = list(zip(*data))
+        self.times, self.ticks = np.array(data, dtype=float).T.copy()
+
+        # slope of each segment in both directions. Zero-length segments get a slope of 0,
+        # since they are never interpolated across.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d_times = np.diff(self.times)
+            d_ticks = np.diff(self.ticks)
+            self.tick_slopes = np.where(d_times > 0, d_ticks / d_times, 0)
+            self.time_slopes = np.where(d_ticks > 0, d_times / d_ticks, 0)
+
+        # python lists are faster than numpy arrays for single-value lookups with bisect
+        self._times = self.times.tolist()
+        self._ticks = self.ticks.tolist()
+        self._tick_slopes = self.tick_slopes.tolist()
+        self._time_slopes = self.time_slopes.tolist()
+
+        # last segment found by time_to_tick / tick_to_time
+        self._time_seg = 0
+        self._tick_seg = 0
 
     def time_to_tick(self, time):
         """
@@ -175,8 +356,17 @@ class TempoMap(object):
         :returns: The number of ticks corresponding to the given amount of time,
             linearly interpolated from the given data.
         """
-        tick = np.interp(time, self.times, self.ticks)
-        return tick
+        times = self._times
+        seg = self._time_seg
+        if not (times[seg] <= time < times[seg + 1]):
+            if time <= times[0]:
+                return self._ticks[0]
+            if time >= times[-1]:
+                return self._ticks[-1]
+            seg = bisect.bisect_right(times, time) - 1
+            self._time_seg = seg
+
+        return self._ticks[seg] + (time - times[seg]) * self._tick_slopes[seg]
 
     def tick_to_time(self, tick):
         """
@@ -186,8 +376,42 @@ class TempoMap(object):
         :returns: The time in seconds corresponding to the given number of ticks, ,
             linearly interpolated from the given data.
         """
-        time = np.interp(tick, self.ticks, self.times)
-        return time
+        ticks = self._ticks
+        seg = self._tick_seg
+        if not (ticks[seg] <= tick < ticks[seg + 1]):
+            if tick <= ticks[0]:
+                return self._times[0]
+            if tick >= ticks[-1]:
+                return self._times[-1]
+            seg = bisect.bisect_right(ticks, tick) - 1
+            self._tick_seg = seg
+
+        return self._times[seg] + (tick - ticks[seg]) * self._time_slopes[seg]
+
+    def times_to_ticks(self, times):
+        """
+        Converts many times into tick numbers at once.
+
+        :param times: A numpy array (or list) of times, in seconds.
+        :returns: A numpy array of the corresponding ticks.
+        """
+        return self._convert(times, self.times, self.ticks, self.tick_slopes)
+
+    def ticks_to_times(self, ticks):
+        """
+        Converts many tick numbers into times at once.
+
+        :param ticks: A numpy array (or list) of ticks.
+        :returns: A numpy array of the corresponding times, in seconds.
+        """
+        return self._convert(ticks, self.ticks, self.times, self.time_slopes)
+
+    # piecewise-linear mapping of values from the xs axis to the ys axis
+    def _convert(self, values, xs, ys, slopes):
+        values = np.clip(np.asarray(values, dtype=float), xs[0], xs[-1])
+        seg = np.searchsorted(xs, values, side='right') - 1
+        np.clip(seg, 0, len(slopes) - 1, out=seg)
+        return ys[seg] + (values - xs[seg]) * slopes[seg]
 
     def _read_tempo_data(self, filepath):
         data = [(0,0)]
@@ -215,7 +439,7 @@ class Scheduler(object):
         super(Scheduler, self).__init__()
         self.clock = clock
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandHeap()
 
     def get_time(self):
         """
@@ -231,9 +455,7 @@ class Scheduler(object):
         return self.tempo_map.time_to_tick(sec)
 
     # add a record for the function to call at the particular tick
-    # keep the list of commands sorted from lowest to hightest tick
-    # make sure tick is the first argument so sorting will work out
-    # properly
+    # commands are kept in a heap ordered by tick
     def post_at_tick(self, func, tick, arg = None):
         """
         Adds a record for the function to execute at the specified tick value.
@@ -244,11 +466,8 @@ class Scheduler(object):
 
         :returns: The command object created by this record.
         """
-        now_tick = self.get_tick()
-
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
@@ -259,9 +478,7 @@ class Scheduler(object):
 
         :param cmd: The command object to remove.
         """
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        self.commands.cancel(cmd)
 
     # on_update should be called as often as possible.
     # the only trick here is to make sure we remove the command BEFORE
@@ -272,8 +489,8 @@ class Scheduler(object):
         """
         now_tick = self.get_tick()
         while self.commands:
-            if self.commands[0].tick <= now_tick:
-                command = self.commands.pop(0)
+            if self.commands.peek().tick <= now_tick:
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
@@ -298,13 +515,19 @@ class AudioScheduler(object):
     Generates scheduled audio with a built-in Clock and Scheduler. As a generator,
     for it to work, it must be inserted into an Audio generator chain.
     """
-    def __init__(self, tempo_map):
+    def __init__(self, tempo_map, block_events = False):
         """
         :param tempo_map: The TempoMap object that keeps track of tempo.
+        :param block_events: If False (the default), each block is split at the frame of every
+            command, and the generator is called once per segment. If True, all commands for a block
+            are executed first, and the generator renders the whole block in one call, applying the
+            commands' synth events at their exact frame offsets. This requires a generator
+            that defines ``set_event_offset(offset)``, such as :class:`~imslib.synth.Synth`.
         """
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandHeap()
+        self.block_events = block_events
 
         self.generator = None
         self.cur_frame = 0
@@ -329,7 +552,24 @@ class AudioScheduler(object):
         :returns: A tuple ``(output, True)``. The output is a numpy array of length
             **(num_frames * num_channels)**
         """
-        output = np.empty(num_channels * num_frames, dtype = float)
+        output = np.empty(num_channels * num_frames, dtype = Audio.sample_dtype)
+        self.generate_into(output, num_frames, num_channels)
+        return output, True
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length **(num_frames * num_channels)** to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: True
+        """
+        if self.block_events and self.generator:
+            return self._generate_block_events_into(out, num_frames, num_channels)
+
         o_idx = 0
 
         # the current period of time goes from self.cur_frame to end_frame
@@ -338,32 +578,56 @@ class AudioScheduler(object):
         # advance time and fire off commands for this time frame
         while self.commands:
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
+            cmd_tick = self.commands.peek().tick
             cmd_time = self.tempo_map.tick_to_time(cmd_tick)
             cmd_frame = int(cmd_time * Audio.sample_rate)
 
             if cmd_frame < end_frame:
-                o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
-                command = self.commands.pop(0)
+                o_idx = self._generate_until(cmd_frame, num_channels, out, o_idx)
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
 
-        self._generate_until(end_frame, num_channels, output, o_idx)
+        self._generate_until(end_frame, num_channels, out, o_idx)
 
-        return output, True
+        return True
+
+    # execute all commands in this block, letting the generator record the frame offset
+    # of each command's events. Then generate the whole block in one call.
+    def _generate_block_events_into(self, out, num_frames, num_channels):
+        start_frame = self.cur_frame
+        end_frame = start_frame + num_frames
+
+        while self.commands:
+            cmd_tick = self.commands.peek().tick
+            cmd_time = self.tempo_map.tick_to_time(cmd_tick)
+            cmd_frame = int(cmd_time * Audio.sample_rate)
+
+            if cmd_frame < end_frame:
+                # so that get_time() / get_tick() are correct while the command runs
+                self.cur_frame = max(self.cur_frame, cmd_frame)
+                self.generator.set_event_offset(self.cur_frame - start_frame)
+                command = self.commands.pop()
+                command.execute()
+            else:
+                break
+
+        self.generator.set_event_offset(None)
+        generate_into(self.generator, out, num_frames, num_channels)
+        self.cur_frame = end_frame
+        return True
 
-    # generate audio from self.cur_frame to to_frame
+    # generate audio from self.cur_frame to to_frame, directly into output
     def _generate_until(self, to_frame, num_channels, output, o_idx):
         num_frames = to_frame - self.cur_frame
         if num_frames > 0:
+            next_o_idx = o_idx+(num_channels * num_frames)
             if self.generator:
-                data, cont = self.generator.generate(num_frames, num_channels)
+                generate_into(self.generator, output[o_idx : next_o_idx], num_frames, num_channels)
             else:
-                data = np.zeros(num_channels * num_frames, dtype=float)
+                output[o_idx : next_o_idx] = 0
 
-            next_o_idx = o_idx+(num_channels * num_frames)
-            output[o_idx : next_o_idx] = data
             self.cur_frame += num_frames
             return next_o_idx
         else:
@@ -393,13 +657,10 @@ class AudioScheduler(object):
 
         :returns: The command object created by this record.
         """
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
-        # create a command to hold the function/arg and sort by tick
+        # create a command to hold the function/arg. The command heap is owned by
+        # the audio thread, so it is modified there.
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        run_on_audio_thread(self.commands.push, cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
@@ -410,9 +671,7 @@ class AudioScheduler(object):
 
         :param cmd: The command object to remove.
         """
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        run_on_audio_thread(self.commands.cancel, cmd)
 
     def now_str(self):
         """
@@ -458,6 +717,67 @@ class Command(object):
     def __repr__(self):
         return 'cmd:%d' % self.tick
 
+
+class CommandHeap(object):
+    """
+    Holds pending Commands in a binary heap, ordered by tick. Commands with the same tick come
+    out in the order they were pushed. Posting and popping are O(log n). Cancelling just marks
+    the heap entry as removed, and cancelled entries are discarded when they reach the top.
+    """
+    def __init__(self):
+        super(CommandHeap, self).__init__()
+        self.heap = []          # entries are [tick, sequence number, command or None if cancelled]
+        self.entries = {}       # command -> its heap entry, for pending commands only
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, cmd):
+        """
+        Adds a command.
+
+        :param cmd: The Command object.
+        """
+        entry = [cmd.tick, next(self.counter), cmd]
+        self.entries[cmd] = entry
+        heapq.heappush(self.heap, entry)
+
+    def cancel(self, cmd):
+        """
+        Removes a command. Does nothing if ``cmd`` is not pending.
+
+        :param cmd: The Command object.
+        """
+        entry = self.entries.pop(cmd, None)
+        if entry is not None:
+            entry[2] = None
+
+            # if most of the heap is cancelled entries, rebuild it without them
+            if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+                self.heap = [e for e in self.heap if e[2] is not None]
+                heapq.heapify(self.heap)
+
+    def peek(self):
+        """
+        :returns: The pending command with the lowest tick, or None if there are none.
+        """
+        self._discard_cancelled()
+        return self.heap[0][2] if self.heap else None
+
+    def pop(self):
+        """
+        Removes and returns the pending command with the lowest tick.
+        """
+        self._discard_cancelled()
+        cmd = heapq.heappop(self.heap)[2]
+        del self.entries[cmd]
+        return cmd
+
+    def _discard_cancelled(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
 # helper function for quantization:
 def quantize_tick_up(tick, grid):
     """
@@ -471,3 +791,42 @@ def quantize_tick_up(tick, grid):
     """
     return tick - (tick % grid) + grid
 
+
+
+def benchmark_scheduler(sizes = (10000, 100000, 1000000)):
+    """
+    Measures how fast :class:`Scheduler` can post, cancel and dispatch commands when many
+    commands are pending. Prints thousands of operations per second for each size.
+    """
+    import random
+
+    def noop(tick):
+        pass
+
+    print('{:>9} {:>12} {:>12} {:>12}'.format('pending', 'post k/s', 'cancel k/s', 'dispatch k/s'))
+    for size in sizes:
+        clock = Clock()
+        clock.stop()
+        clock.set_time(0)
+        sched = Scheduler(clock, SimpleTempoMap())
+        ticks = [random.randrange(1, 1000000) for _ in range(size)]
+
+        t0 = time.perf_counter()
+        cmds = [sched.post_at_tick(noop, t) for t in ticks]
+        t1 = time.perf_counter()
+        for cmd in cmds[::10]:
+            sched.cancel(cmd)
+        t2 = time.perf_counter()
+        clock.set_time(1e6)
+        sched.on_update()
+        t3 = time.perf_counter()
+
+        num_cancelled = len(cmds[::10])
+        print('{:>9} {:>12.0f} {:>12.0f} {:>12.0f}'.format(size,
+            size / (t1 - t0) / 1000,
+            num_cancelled / (t2 - t1) / 1000,
+            (size - num_cancelled) / (t3 - t2) / 1000))
+
+
+if __name__ == "__main__":
+    benchmark_scheduler()
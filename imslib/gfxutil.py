@@ -7,16 +7,19 @@
 
 
 from pathlib import Path
+import bisect
 
 from kivy.clock import Clock as kivyClock
 from kivy.graphics.instructions import InstructionGroup
-from kivy.graphics import Rectangle, Ellipse, Color, Line, BindTexture
+from kivy.graphics import Rectangle, Ellipse, Color, Line, Mesh, BindTexture
 from kivy.uix.label import Label
 from kivy.core.text import LabelBase
 from kivy.core.window import Window
 
 import numpy as np
 
+from .meshutil import set_mesh_data
+
 font_path = str(Path(Path(__file__).parent, 'fonts', 'Inconsolata-SemiBold.ttf'))
 LabelBase.register(name='Inconsolata', fn_regular=font_path)
 
@@ -50,6 +53,41 @@ def resize_topleft_label(label):
     label.pos = (Window.width * 0.5 - 40, Window.height * 0.5 - 55)
     label.text_size = (Window.width, Window.height)
 
+
+def profiler_label(profiler, interval = 0.5, font_size='14sp', color=(1,1,0,1)):
+    """
+    Creates an overlay Label positioned at the top-right of the screen that shows the report of an
+    :class:`imslib.profiler.Profiler`. The text updates itself every *interval* seconds while the label
+    is added to a widget, and stays in the top-right corner if the window is resized. Removing the label
+    from its parent stops the updates (the Clock event is ``label.update_event``).
+
+    :param profiler: The Profiler to display.
+    :param interval: Time (in seconds) between updates.
+
+    :returns: A Label object. Add it to a widget to make it visible.
+    """
+
+    l = Label(text = "", valign='top', halign='right',
+              font_size=font_size, font_name='Inconsolata', color=color)
+
+    def update(dt):
+        l.pos = (Window.width * 0.5 - 60, Window.height * 0.5 - 55)
+        l.text_size = (Window.width, Window.height)
+        l.text = profiler.get_report()
+
+    # only update while the label is on screen, so a removed label does not keep itself and the profiler alive
+    def on_parent(label, parent):
+        if parent is None:
+            l.update_event.cancel()
+        else:
+            update(0)
+            l.update_event()
+
+    l.update_event = kivyClock.create_trigger(update, interval, interval=True)
+    l.bind(parent=on_parent)
+    update(0)
+    return l
+
 class CLabelRect(InstructionGroup):
     """
     Class for creating labels that can be added to Widget canvases like standard Kivy graphics
@@ -308,6 +346,296 @@ class AnimGroup(InstructionGroup):
         return len(self.objects)
 
 
+class ScrollingTrack(InstructionGroup):
+    """
+    Manages objects placed at points in time, such as gems or bar lines in a rhythm game, so that only the
+    ones in the active window *[now - behind, now + ahead]* are drawn and updated.
+
+    Objects are kept sorted by time. The window is tracked with two indices that advance as time moves forward,
+    so each call to :meth:`on_update` only touches objects that are entering, leaving, or inside the window.
+    The per-frame cost depends on what is visible, not on the length of the song.
+
+    Subclasses can override :meth:`_enter` and :meth:`_exit` to change what happens when an object enters or
+    leaves the window. By default, the object is added to or removed from this group.
+    """
+
+    def __init__(self, ahead, behind, objects = ()):
+        """
+        :param ahead: How far (in seconds) into the future objects are active.
+        :param behind: How far (in seconds) into the past objects stay active.
+        :param objects: Initial objects. Each must have a ``time`` attribute and an ``on_update(now_time)`` method.
+        """
+        super(ScrollingTrack, self).__init__()
+
+        self.ahead = ahead
+        self.behind = behind
+        self.objects = []
+        self.times = []
+
+        # active window is objects[start:end]
+        self.start = 0
+        self.end = 0
+        self.now = None
+
+        self.set_objects(objects)
+
+    def set_objects(self, objects):
+        """
+        Replaces all objects on the track.
+
+        :param objects: Objects with a ``time`` attribute and an ``on_update(now_time)`` method.
+        """
+        for i in range(self.start, self.end):
+            self._exit(self.objects[i])
+
+        self.objects = sorted(objects, key=lambda o: o.time)
+        self.times = [o.time for o in self.objects]
+        self.start = self.end = 0
+        self.now = None
+
+    def get_objects(self):
+        """
+        :returns: All objects, sorted by time.
+        """
+        return self.objects
+
+    def get_active(self):
+        """
+        :returns: The objects that are currently in the active window.
+        """
+        return self.objects[self.start:self.end]
+
+    def get_num_active(self):
+        """
+        :returns: The number of objects in the active window.
+        """
+        return self.end - self.start
+
+    def on_update(self, now_time):
+        """
+        Moves the active window to the given time, calls ``_enter`` / ``_exit`` for objects entering or
+        leaving the window, and calls ``on_update(now_time)`` on every active object.
+
+        :param now_time: The current time, in seconds.
+        """
+        lo = now_time - self.behind
+        hi = now_time + self.ahead
+        n = len(self.times)
+
+        if self.now is None or not 0 <= now_time - self.now <= self.ahead + self.behind:
+            # first update, going back in time, or jumping ahead (ie, seeking): find the window from scratch
+            start = bisect.bisect_left(self.times, lo)
+            end = bisect.bisect_right(self.times, hi)
+        else:
+            start, end = self.start, self.end
+            while start < n and self.times[start] < lo:
+                start += 1
+            while end < n and self.times[end] <= hi:
+                end += 1
+
+        # objects that were active but no longer are, and the other way around
+        old_start, old_end = self.start, self.end
+        for i in range(old_start, old_end):
+            if not start <= i < end:
+                self._exit(self.objects[i])
+        for i in range(start, end):
+            if not old_start <= i < old_end:
+                self._enter(self.objects[i])
+
+        self.start, self.end = start, end
+        self.now = now_time
+
+        for i in range(start, end):
+            self._update(self.objects[i], now_time)
+
+    def _enter(self, obj):
+        self.add(obj)
+
+    def _exit(self, obj):
+        self.remove(obj)
+
+    def _update(self, obj, now_time):
+        obj.on_update(now_time)
+
+
+class DisplayPool(object):
+    """
+    A pool of reusable display objects. Instead of creating a new object for every use, :meth:`get` hands
+    out an object that was previously returned with :meth:`put`, and only creates a new one when the pool
+    is empty.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: A function with no arguments that creates a new display object.
+        """
+        super(DisplayPool, self).__init__()
+        self.factory = factory
+        self.free = []
+        self.num_created = 0
+
+    def get(self):
+        """
+        :returns: A display object, either recycled or newly created.
+        """
+        if self.free:
+            return self.free.pop()
+        self.num_created += 1
+        return self.factory()
+
+    def put(self, obj):
+        """
+        Returns a display object to the pool so that it can be reused.
+
+        :param obj: The display object.
+        """
+        self.free.append(obj)
+
+    def get_num_created(self):
+        """
+        :returns: The total number of display objects created by the pool.
+        """
+        return self.num_created
+
+
+class PooledScrollingTrack(ScrollingTrack):
+    """
+    A :class:`ScrollingTrack` whose objects are plain data entries (anything with a ``time`` attribute), drawn
+    by display objects from a :class:`DisplayPool`. A display is bound to an entry when the entry enters the
+    active window, and returned to the pool when it leaves. Only as many displays as are ever visible at once
+    get created, no matter how long the chart is.
+
+    Display objects must be InstructionGroups with a ``bind(entry)`` method, which sets up the display to
+    show that entry (including any state it has, since an entry can be bound again after seeking), and an
+    ``on_update(now_time)`` method.
+    """
+
+    def __init__(self, ahead, behind, pool, entries = ()):
+        """
+        :param ahead: How far (in seconds) into the future entries are active.
+        :param behind: How far (in seconds) into the past entries stay active.
+        :param pool: The :class:`DisplayPool` to take display objects from.
+        :param entries: Initial entries. Each must have a ``time`` attribute.
+        """
+        self.pool = pool
+        self.displays = {} # id(entry) -> display
+        super(PooledScrollingTrack, self).__init__(ahead, behind, entries)
+
+    def get_display(self, entry):
+        """
+        :param entry: An entry on this track.
+
+        :returns: The display currently bound to *entry*, or None if the entry is not in the active window.
+        """
+        return self.displays.get(id(entry))
+
+    def _enter(self, entry):
+        display = self.pool.get()
+        display.bind(entry)
+        self.displays[id(entry)] = display
+        self.add(display)
+
+    def _exit(self, entry):
+        display = self.displays.pop(id(entry))
+        self.remove(display)
+        self.pool.put(display)
+
+    def _update(self, entry, now_time):
+        self.displays[id(entry)].on_update(now_time)
+
+
+def circle_template(radius, segments = 24):
+    """
+    :returns: A tuple ``(points, indices)`` describing a filled circle centered at (0, 0) as a triangle fan,
+        for use with :class:`ShapeBatch`.
+    """
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    points = np.zeros((segments + 1, 2))
+    points[1:, 0] = radius * np.cos(angles)
+    points[1:, 1] = radius * np.sin(angles)
+
+    rim = np.arange(segments)
+    indices = np.stack((np.zeros(segments, dtype=int), rim + 1, (rim + 1) % segments + 1), axis=1)
+    return points, indices.ravel()
+
+
+def ring_template(inner_radius, outer_radius, segments = 24):
+    """
+    :returns: A tuple ``(points, indices)`` describing a ring (circle outline) centered at (0, 0),
+        for use with :class:`ShapeBatch`.
+    """
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    unit = np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    points = np.concatenate((unit * inner_radius, unit * outer_radius))
+
+    i = np.arange(segments)
+    j = (i + 1) % segments
+    indices = np.stack((i, j, i + segments, j, j + segments, i + segments), axis=1)
+    return points, indices.ravel()
+
+
+class ShapeBatch(InstructionGroup):
+    """
+    Draws many copies of the same shape in one color with a single Mesh. Instead of one graphics
+    instruction per shape, the positions of all copies are set at once from numpy arrays with
+    :meth:`set_centers`, so drawing N shapes costs a few vectorized numpy operations.
+
+    The shape is given as a template, such as one made by :func:`circle_template` or :func:`ring_template`.
+    Since Mesh indices are 16 bit, at most *65535 / (points in template)* copies can be drawn.
+    """
+
+    def __init__(self, template, color):
+        """
+        :param template: A tuple ``(points, indices)``: an (m, 2) array of points relative to the center of the
+            shape, and a flat array of triangle indices into those points.
+        :param color: An rgb or rgba tuple.
+        """
+        super(ShapeBatch, self).__init__()
+
+        points, indices = template
+        self.points = np.asarray(points, dtype=np.float32)
+        self.template_indices = np.asarray(indices, dtype=np.uint16)
+        self.max_count = 65535 // len(self.points)
+
+        self.color = Color(*color)
+        self.add(self.color)
+        self.mesh = Mesh(fmt=[(b'vPosition', 2, 'float'), (b'vTexCoords0', 2, 'float')], mode='triangles')
+        self.add(self.mesh)
+
+        self.capacity = 0
+        self.count = 0
+        self._reserve(16)
+
+    def set_centers(self, x, y):
+        """
+        Draws one copy of the shape at each center.
+
+        :param x: The x coordinates of the centers. An array, or a single value used for all centers.
+        :param y: The y coordinates of the centers, an array.
+        """
+        count = min(len(y), self.max_count)
+        if count > self.capacity:
+            self._reserve(max(count, 2 * self.capacity))
+
+        m = len(self.points)
+        verts = self.vertices[:count * m].reshape(count, m, 4)
+        np.add(np.reshape(x, (-1, 1))[:count], self.points[:, 0], out=verts[:, :, 0])
+        np.add(np.reshape(y, (-1, 1))[:count], self.points[:, 1], out=verts[:, :, 1])
+
+        self.count = count
+        set_mesh_data(self.mesh, self.vertices[:count * m].ravel(),
+                      self.indices[:count * len(self.template_indices)])
+
+    # grow the vertex and index arrays. Indices and texture coordinates never change, so fill them in now.
+    def _reserve(self, capacity):
+        capacity = min(capacity, self.max_count)
+        m = len(self.points)
+        self.vertices = np.zeros((capacity * m, 4), dtype=np.float32)
+        offsets = (np.arange(capacity, dtype=np.uint16) * m)[:, None]
+        self.indices = (self.template_indices[None, :] + offsets).ravel()
+        self.capacity = capacity
+
+
 class Cursor3D(InstructionGroup):
     """
     A graphics object for displaying a point moving in a pre-defined 3D space
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the cost of a particle system without a window.
+
+Loads a .pex config into a headless :class:`ParticleSystem` and/or :class:`VectorParticleSystem`, simulates it
+for some seconds at a fixed rate and reports how many particles per second each backend advances and builds
+render data for. Example (kivy parses command line options unless KIVY_NO_ARGS is set)::
+
+    KIVY_NO_ARGS=1 python -m imslib.kivyparticle.bench imslib/kivyparticle/particle/fire.pex --seconds 10 --json
+"""
+
+from .engine import ParticleSystem, VectorParticleSystem
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+__all__ = ['bench_particle_system']
+
+BACKENDS = {'scalar': ParticleSystem, 'vector': VectorParticleSystem}
+
+
+def bench_particle_system(config, backend='scalar', seconds=10., rate=60., seed=0, max_particles=None):
+    """
+    Runs one headless particle system and times it.
+
+    :param config: path to a .pex file.
+    :param backend: 'scalar' (:class:`ParticleSystem`) or 'vector' (:class:`VectorParticleSystem`).
+    :param seconds: simulated time, in seconds.
+    :param rate: frames per second. The system advances one time step and renders once per frame.
+    :param seed: seed for the particle system's random numbers.
+    :param max_particles: if not *None*, overrides the config's maximum number of particles.
+    :returns: dict of results. ``advance_particles_per_sec`` and ``render_particles_per_sec`` are the number
+        of particles advanced (or rendered) per second of wall time spent advancing (or rendering).
+    """
+    ps = BACKENDS[backend](config, seed=seed, headless=True)
+    if max_particles is not None:
+        ps.max_num_particles = max_particles
+    ps.time_step = 1. / rate
+    ps.start()
+
+    dt = 1. / rate
+    num_frames = int(round(seconds * rate))
+    advance_time = 0.
+    render_time = 0.
+    num_particles = 0
+    peak_particles = 0
+
+    for frame in range(num_frames):
+        t0 = time.perf_counter()
+        ps.advance(dt)
+        t1 = time.perf_counter()
+        ps.render()
+        t2 = time.perf_counter()
+
+        advance_time += t1 - t0
+        render_time += t2 - t1
+        num_particles += ps.num_particles
+        peak_particles = max(peak_particles, ps.num_particles)
+
+    return {
+        'config': config,
+        'backend': backend,
+        'seconds': seconds,
+        'rate': rate,
+        'seed': seed,
+        'frames': num_frames,
+        'max_particles': int(ps.max_num_particles),
+        'mean_particles': num_particles / float(max(num_frames, 1)),
+        'peak_particles': peak_particles,
+        'advance_ms_per_frame': 1000. * advance_time / max(num_frames, 1),
+        'render_ms_per_frame': 1000. * render_time / max(num_frames, 1),
+        'advance_particles_per_sec': num_particles / advance_time if advance_time else 0.,
+        'render_particles_per_sec': num_particles / render_time if render_time else 0.,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark particle systems without a window.')
+    parser.add_argument('config', help='.pex file to load')
+    parser.add_argument('--backend', choices=sorted(BACKENDS) + ['all'], default='all')
+    parser.add_argument('--seconds', type=float, default=10., help='simulated seconds (default 10)')
+    parser.add_argument('--rate', type=float, default=60., help='frames per second (default 60)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-particles', type=int, default=None, help="override the config's maxParticles")
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(args)
+
+    backends = sorted(BACKENDS) if args.backend == 'all' else [args.backend]
+    results = [bench_particle_system(args.config, b, args.seconds, args.rate, args.seed, args.max_particles)
+               for b in backends]
+
+    if args.json:
+        report = {'python': platform.python_version(), 'numpy': np.__version__, 'results': results}
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        for r in results:
+            print('%-6s: %8.0f particles (peak %d), advance %7.3f ms/frame %12.0f particles/sec, '
+                  'render %7.3f ms/frame %12.0f particles/sec' %
+                  (r['backend'], r['mean_particles'], r['peak_particles'],
+                   r['advance_ms_per_frame'], r['advance_particles_per_sec'],
+                   r['render_ms_per_frame'], r['render_particles_per_sec']))
+
+
+if __name__ == "__main__":
+    main()
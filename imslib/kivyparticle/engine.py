@@ -2,20 +2,28 @@
 
 from kivy.uix.widget import Widget
 from kivy.clock import Clock
-from kivy.graphics import Color, Callback, Rotate, PushMatrix, PopMatrix, Translate, Quad
+from kivy.graphics import Color, Callback, Rotate, PushMatrix, PopMatrix, Translate, Quad, Mesh, RenderContext, InstructionGroup
 from kivy.graphics.opengl import glBlendFunc, GL_SRC_ALPHA, GL_ONE, GL_ZERO, GL_SRC_COLOR, GL_ONE_MINUS_SRC_COLOR, GL_ONE_MINUS_SRC_ALPHA, GL_DST_ALPHA, GL_ONE_MINUS_DST_ALPHA, GL_DST_COLOR, GL_ONE_MINUS_DST_COLOR
 from kivy.core.image import Image
 from kivy.logger import Logger
 from xml.dom.minidom import parse as parse_xml
 from .utils import random_variance, random_color_variance
+try:
+    from ..meshutil import set_mesh_data
+except ImportError:
+    # the editor imports kivyparticle as a top level package, with imslib on the path
+    from meshutil import set_mesh_data
 from kivy.properties import NumericProperty, BooleanProperty, ListProperty, StringProperty, ObjectProperty
 from kivy import metrics
 
 import sys
 import os
 import math
+import random
+import struct
+import numpy as np
 
-__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'Particle', 'ParticleSystem']
+__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'Particle', 'ParticlePool', 'ParticleSystem', 'VectorParticleSystem']
 
 
 EMITTER_TYPE_GRAVITY = 0
@@ -37,16 +45,143 @@ BLEND_FUNC = {0: GL_ZERO,
 # and will look the same even if the display is a high-density display
 px = metrics.sp(1) 
 
+
+class HeadlessTexture(object):
+    """
+    Stands in for a texture when a :class:`ParticleSystem` runs without a window (and so without a GL context).
+    It only knows its size, which is all the simulation needs.
+    """
+
+    def __init__(self, width, height):
+        super(HeadlessTexture, self).__init__()
+        self.width = width
+        self.height = height
+        self.size = (width, height)
+        self.tex_coords = (0., 0., 1., 0., 1., 1., 0., 1.)
+
+
+def read_png_size(path):
+    """
+    Reads the size of a PNG image from its header, without decoding it.
+
+    :param path: path to a .png file.
+    :returns: (width, height) in pixels.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    # 8 byte signature, then the IHDR chunk: length, type, width, height
+    if len(header) < 24 or header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+        raise ValueError('%s is not a PNG file' % path)
+    return struct.unpack('>II', header[16:24])
+
 class Particle(object):
-    x, y, rotation, current_time = -256, -256, 0, 0
-    scale, total_time = 1.0, 0.
-    color = [1.0, 1.0, 1.0, 1.0]
-    color_delta = [0.0, 0.0, 0.0, 0.0]
-    start_x, start_y, velocity_x, velocity_y = 0, 0, 0, 0
-    radial_acceleration, tangent_acceleration = 0, 0
-    emit_radius, emit_radius_delta = 0, 0
-    emit_rotation, emit_rotation_delta = 0, 0
-    rotation_delta, scale_delta = 0, 0
+    __slots__ = ('x', 'y', 'rotation', 'current_time', 'scale', 'total_time', 'color', 'color_delta',
+                 'start_x', 'start_y', 'velocity_x', 'velocity_y', 'radial_acceleration', 'tangent_acceleration',
+                 'emit_radius', 'emit_radius_delta', 'emit_rotation', 'emit_rotation_delta',
+                 'rotation_delta', 'scale_delta', 'prev_x', 'prev_y', 'graphics')
+
+    def __init__(self):
+        super(Particle, self).__init__()
+        self.x, self.y, self.rotation, self.current_time = -256, -256, 0, 0
+        self.scale, self.total_time = 1.0, 0.
+        self.color = [1.0, 1.0, 1.0, 1.0]
+        self.color_delta = [0.0, 0.0, 0.0, 0.0]
+        self.start_x, self.start_y, self.velocity_x, self.velocity_y = 0, 0, 0, 0
+        self.radial_acceleration, self.tangent_acceleration = 0, 0
+        self.emit_radius, self.emit_radius_delta = 0, 0
+        self.emit_rotation, self.emit_rotation_delta = 0, 0
+        self.rotation_delta, self.scale_delta = 0, 0
+        # position before the last simulation step, to interpolate between steps when rendering
+        self.prev_x, self.prev_y = -256, -256
+        # canvas instructions that draw this particle (a ParticleGraphics), created on first render
+        self.graphics = None
+
+
+class ParticleGraphics(object):
+    """
+    The canvas instructions that draw one particle, kept together in an InstructionGroup so they can be
+    moved from one ParticleSystem's canvas to another's.
+    """
+    __slots__ = ('group', 'color', 'translate', 'rotate', 'rect')
+
+    def __init__(self, texture):
+        super(ParticleGraphics, self).__init__()
+        self.group = InstructionGroup()
+        self.color = Color(1, 1, 1, 1)
+        self.translate = Translate()
+        self.rotate = Rotate(angle=0, axis=(0, 0, 1))
+        self.rect = Quad(texture=texture)
+        for instruction in (self.color, PushMatrix(), self.translate, self.rotate, self.rect, PopMatrix()):
+            self.group.add(instruction)
+
+
+class ParticlePool(object):
+    """
+    A free list of :class:`Particle` objects (and their canvas instructions) shared by ParticleSystems.
+    A system takes particles from the pool as it emits them and gives them back when they die, so short-lived
+    emitters (like one burst per hit) reuse particles and graphics instead of creating new ones.
+    """
+
+    def __init__(self):
+        super(ParticlePool, self).__init__()
+        self.free = []
+
+        # allocation counters, see get_stats()
+        self.num_particles_created = 0
+        self.num_graphics_created = 0
+        self.num_acquired = 0
+
+    def reserve(self, num_particles):
+        """
+        Creates particles so that at least *num_particles* are free.
+
+        :param num_particles: the number of free particles wanted.
+        """
+        for i in range(int(num_particles) - len(self.free)):
+            self.free.append(self._create_particle())
+
+    def acquire(self):
+        """
+        :returns: a free :class:`Particle`. Its *graphics* may be left over from an earlier use.
+        """
+        self.num_acquired += 1
+        if self.free:
+            return self.free.pop()
+        return self._create_particle()
+
+    def release(self, particle):
+        """
+        Returns a particle to the pool. Its graphics must already be removed from any canvas.
+
+        :param particle: the :class:`Particle` to give back.
+        """
+        self.free.append(particle)
+
+    def create_graphics(self, texture):
+        """
+        :param texture: texture of the new particle's quad.
+        :returns: a new :class:`ParticleGraphics`.
+        """
+        self.num_graphics_created += 1
+        return ParticleGraphics(texture)
+
+    def get_stats(self):
+        """
+        :returns: dict with the number of free particles and how many particles and graphics were created
+            for the number of particles acquired.
+        """
+        return {'free': len(self.free),
+                'acquired': self.num_acquired,
+                'particles_created': self.num_particles_created,
+                'graphics_created': self.num_graphics_created}
+
+    def _create_particle(self):
+        self.num_particles_created += 1
+        return Particle()
+
+
+# pool shared by all ParticleSystems that don't have their own
+g_particle_pool = ParticlePool()
 
 
 class ParticleSystem(Widget):
@@ -94,9 +229,12 @@ class ParticleSystem(Widget):
     emitter_type = NumericProperty(0)
 
     update_interval = NumericProperty(1. / 30.)
+    # the simulation advances in steps of time_step, at most max_substeps per update
+    time_step = NumericProperty(1. / 60.)
+    max_substeps = NumericProperty(8)
     _is_paused = BooleanProperty(False)
 
-    def __init__(self, config, **kwargs):
+    def __init__(self, config, pool=None, seed=None, headless=False, **kwargs):
         """
         :param config: A pex file with specifications for particle appearance and behavior.
             Includes specifications for properties like speed, color, position, and size.
@@ -111,13 +249,27 @@ class ParticleSystem(Widget):
             | ``speed`` - The speed of particle movement.
             | ``gravity_x`` - Gravity in the x direction.
             | ``gravity_y`` - Gravity in the y direction.
+
+        :param pool: :class:`ParticlePool` to take particles from. Defaults to a pool shared by all systems.
+
+        :param seed: seed for the random numbers of this system, to make its particles reproducible.
+            Defaults to *None* (different every run).
+
+        :param headless: If *True*, the system can run without a window: the texture is not loaded (only its
+            size is read), no canvas instructions are created and nothing is scheduled on the Clock, so the
+            caller must call :meth:`advance` and :meth:`render` itself. :meth:`render` still computes where
+            every quad goes, but does not draw it. Used for benchmarks. Defaults to *False*.
         """
+        self.headless = headless
+        self.pool = pool if pool is not None else g_particle_pool
+        self.rng = self._create_rng(seed)
         super(ParticleSystem, self).__init__(**kwargs)
         self.capacity = 0
+        # live particles
         self.particles = list()
-        self.particles_dict = dict()
         self.emission_time = 0.0
         self.frame_time = 0.0
+        self.time_accumulator = 0.0
         self.num_particles = 0
 
         if config is not None:
@@ -127,12 +279,15 @@ class ParticleSystem(Widget):
         self.max_capacity = self.max_num_particles
         self._raise_capacity(self.initial_capacity)
 
-        with self.canvas.before:
-            Callback(self._set_blend_func)
-        with self.canvas.after:
-            Callback(self._reset_blend_func)
+        # quads computed by render() in headless mode: (x, y, rotation, color, points) per particle
+        self.quads = []
 
-        Clock.schedule_once(self._update, self.update_interval)
+        if not self.headless:
+            with self.canvas.before:
+                Callback(self._set_blend_func)
+            with self.canvas.after:
+                Callback(self._reset_blend_func)
+            Clock.schedule_once(self._update, self.update_interval)
 
     def start(self, duration=sys.maxsize):
         """
@@ -152,9 +307,9 @@ class ParticleSystem(Widget):
         """
         self.emission_time = 0.0
         if clear:
+            while self.particles:
+                self._release_particle(self.particles.pop())
             self.num_particles = 0
-            self.particles_dict = dict()
-            self.canvas.clear()
 
     def on_max_num_particles(self, instance, value):
         self.max_capacity = value
@@ -165,12 +320,11 @@ class ParticleSystem(Widget):
         self.emission_rate = self.max_num_particles / self.life_span
 
     def on_texture(self, instance, value):
+        if self.headless:
+            return
         for p in self.particles:
-            try:
-                self.particles_dict[p]['rect'].texture = self.texture
-            except KeyError:
-                # if particle isn't initialized yet, you can't change its texture.
-                pass
+            if p.graphics is not None:
+                p.graphics.rect.texture = value
 
     def on_life_span(self, instance, value):
         self.emission_rate = self.max_num_particles / value
@@ -194,7 +348,10 @@ class ParticleSystem(Widget):
         else:
             self.texture_path = texture_path
 
-        self.texture = Image(self.texture_path).texture
+        if self.headless:
+            self.texture = HeadlessTexture(*read_png_size(self.texture_path))
+        else:
+            self.texture = Image(self.texture_path).texture
         self.emitter_x = float(self._parse_data('sourcePosition', 'x'))
         self.emitter_y = float(self._parse_data('sourcePosition', 'y'))
         self.emitter_x_variance = float(self._parse_data('sourcePositionVariance', 'x'))
@@ -254,46 +411,88 @@ class ParticleSystem(Widget):
         Resumes particle emission
         """
         self._is_paused = False
-        Clock.schedule_once(self._update, self.update_interval)
+        if not self.headless:
+            Clock.schedule_once(self._update, self.update_interval)
+
+    def advance(self, dt):
+        """
+        Advances the simulation by *dt* seconds in fixed steps of *time_step*. Time left over is carried to the
+        next call. If *dt* needs more than *max_substeps* steps (after a long frame), the extra time is dropped.
+
+        Rendering places particles between their positions before and after the last step, by the fraction of a
+        step left over, so motion stays smooth when the frame rate is not a multiple of the step rate. Scale,
+        rotation and color are drawn as of the last step.
+
+        :param dt: time in seconds.
+        :returns: the number of steps taken.
+        """
+        self.time_accumulator += dt
+        # (the small epsilon keeps rounding error from delaying a step when dt equals time_step)
+        steps = int(self.time_accumulator / self.time_step + 1e-9)
+        if steps > self.max_substeps:
+            steps = int(self.max_substeps)
+            self.time_accumulator = steps * self.time_step
+
+        for i in range(steps):
+            self._advance_time(self.time_step)
+        self.time_accumulator -= steps * self.time_step
+        return steps
 
     def _update(self, dt):
-        self._advance_time(dt)
-        self._render()
+        # render even when no step was taken, since positions are interpolated by the time left over
+        self.advance(dt)
+        self.render()
         if not self._is_paused:
             Clock.schedule_once(self._update, self.update_interval)
 
-    def _create_particle(self):
-        return Particle()
+    def _create_rng(self, seed):
+        return random.Random(seed)
+
+    # headless systems leave the graphics of pooled particles alone
+    def _acquire_particle(self):
+        particle = self.pool.acquire()
+        if particle.graphics is not None and not self.headless:
+            particle.graphics.rect.texture = self.texture
+            self.canvas.add(particle.graphics.group)
+        return particle
+
+    def _release_particle(self, particle):
+        if particle.graphics is not None and not self.headless:
+            self.canvas.remove(particle.graphics.group)
+        self.pool.release(particle)
 
     def _init_particle(self, particle):
-        life_span = random_variance(self.life_span, self.life_span_variance)
+        rng = self.rng
+        life_span = random_variance(self.life_span, self.life_span_variance, rng)
         if life_span <= 0.0:
+            # dies right away
+            particle.current_time = particle.total_time = 0.0
             return
 
         particle.current_time = 0.0
         particle.total_time = life_span
 
-        particle.x = random_variance(self.emitter_x, self.emitter_x_variance)
-        particle.y = random_variance(self.emitter_y, self.emitter_y_variance)
+        particle.x = random_variance(self.emitter_x, self.emitter_x_variance, rng)
+        particle.y = random_variance(self.emitter_y, self.emitter_y_variance, rng)
         particle.start_x = self.emitter_x
         particle.start_y = self.emitter_y
 
-        angle = random_variance(self.emit_angle, self.emit_angle_variance)
-        speed = random_variance(self.speed, self.speed_variance) * px
+        angle = random_variance(self.emit_angle, self.emit_angle_variance, rng)
+        speed = random_variance(self.speed, self.speed_variance, rng) * px
         particle.velocity_x = speed * math.cos(angle)
         particle.velocity_y = speed * math.sin(angle)
 
-        particle.emit_radius = random_variance(self.max_radius, self.max_radius_variance)
+        particle.emit_radius = random_variance(self.max_radius, self.max_radius_variance, rng)
         particle.emit_radius_delta = (self.max_radius - self.min_radius) / life_span
 
-        particle.emit_rotation = random_variance(self.emit_angle, self.emit_angle_variance)
-        particle.emit_rotation_delta = random_variance(self.rotate_per_second, self.rotate_per_second_variance)
+        particle.emit_rotation = random_variance(self.emit_angle, self.emit_angle_variance, rng)
+        particle.emit_rotation_delta = random_variance(self.rotate_per_second, self.rotate_per_second_variance, rng)
 
-        particle.radial_acceleration = random_variance(self.radial_acceleration, self.radial_acceleration_variance)
-        particle.tangent_acceleration = random_variance(self.tangential_acceleration, self.tangential_acceleration_variance)
+        particle.radial_acceleration = random_variance(self.radial_acceleration, self.radial_acceleration_variance, rng)
+        particle.tangent_acceleration = random_variance(self.tangential_acceleration, self.tangential_acceleration_variance, rng)
 
-        start_size = random_variance(self.start_size, self.start_size_variance)
-        end_size = random_variance(self.end_size, self.end_size_variance)
+        start_size = random_variance(self.start_size, self.start_size_variance, rng)
+        end_size = random_variance(self.end_size, self.end_size_variance, rng)
 
         start_size = max(0.1, start_size) * px
         end_size = max(0.1, end_size) * px
@@ -302,21 +501,23 @@ class ParticleSystem(Widget):
         particle.scale_delta = ((end_size - start_size) / life_span) / self.texture.width
 
         # colors
-        start_color = random_color_variance(self.start_color, self.start_color_variance)
-        end_color = random_color_variance(self.end_color, self.end_color_variance)
+        start_color = random_color_variance(self.start_color, self.start_color_variance, rng)
+        end_color = random_color_variance(self.end_color, self.end_color_variance, rng)
 
         particle.color_delta = [(end_color[i] - start_color[i]) / life_span for i in range(4)]
         particle.color = start_color
 
         # rotation
-        start_rotation = random_variance(self.start_rotation, self.start_rotation_variance)
-        end_rotation = random_variance(self.end_rotation, self.end_rotation_variance)
+        start_rotation = random_variance(self.start_rotation, self.start_rotation_variance, rng)
+        end_rotation = random_variance(self.end_rotation, self.end_rotation_variance, rng)
         particle.rotation = start_rotation
         particle.rotation_delta = (end_rotation - start_rotation) / life_span
 
     def _advance_particle(self, particle, passed_time):
         passed_time = min(passed_time, particle.total_time - particle.current_time)
         particle.current_time += passed_time
+        particle.prev_x = particle.x
+        particle.prev_y = particle.y
 
         if self.emitter_type == EMITTER_TYPE_RADIAL:
             particle.emit_rotation += particle.emit_rotation_delta * passed_time
@@ -358,26 +559,15 @@ class ParticleSystem(Widget):
         particle.color = [particle.color[i] + particle.color_delta[i] * passed_time for i in range(4)]
 
     def _raise_capacity(self, by_amount):
-        old_capacity = self.capacity
         new_capacity = min(self.max_capacity, self.capacity + by_amount)
-
-        for i in range(int(new_capacity - old_capacity)):
-            self.particles.append(self._create_particle())
-
-        self.num_particles = int(new_capacity)
+        self.pool.reserve(new_capacity - self.num_particles)
         self.capacity = new_capacity
 
     def _lower_capacity(self, by_amount):
-        old_capacity = self.capacity
         new_capacity = max(0, self.capacity - by_amount)
-
-        for i in range(int(old_capacity - new_capacity)):
-            try:
-                self.canvas.remove(self.particles_dict[self.particles.pop()]['rect'])
-            except:
-                pass
-
-        self.num_particles = int(new_capacity)
+        while self.num_particles > new_capacity:
+            self._release_particle(self.particles.pop())
+            self.num_particles -= 1
         self.capacity = new_capacity
 
     def _advance_time(self, passed_time):
@@ -390,10 +580,11 @@ class ParticleSystem(Widget):
                 self._advance_particle(particle, passed_time)
                 particle_index += 1
             else:
+                # swap with the last particle and give it back to the pool
+                last_particle = self.particles.pop()
                 if particle_index != self.num_particles - 1:
-                    next_particle = self.particles[self.num_particles - 1]
-                    self.particles[self.num_particles - 1] = particle
-                    self.particles[particle_index] = next_particle
+                    self.particles[particle_index] = last_particle
+                self._release_particle(particle)
                 self.num_particles -= 1
                 if self.num_particles == 0:
                     Logger.debug('Particle: COMPLETE')
@@ -405,10 +596,8 @@ class ParticleSystem(Widget):
 
             while self.frame_time > 0:
                 if self.num_particles < self.max_capacity:
-                    if self.num_particles == self.capacity:
-                        self._raise_capacity(self.capacity)
-
-                    particle = self.particles[self.num_particles]
+                    particle = self._acquire_particle()
+                    self.particles.append(particle)
                     self.num_particles += 1
                     self._init_particle(particle)
                     self._advance_particle(particle, self.frame_time)
@@ -418,26 +607,424 @@ class ParticleSystem(Widget):
             if self.emission_time != sys.maxsize:
                 self.emission_time = max(0.0, self.emission_time - passed_time)
 
-    def _render(self):
+    # fraction of a time step that has passed since the last step, to interpolate positions by
+    def _step_fraction(self):
+        return min(max(self.time_accumulator / self.time_step, 0.0), 1.0)
+
+    def render(self):
+        """
+        Updates the canvas to the current state of the particles. Called after every update, except in headless
+        mode, where the caller must call it and it only computes the quads (see *quads*) without drawing them.
+        """
+        if self.headless:
+            del self.quads[:]
         if self.num_particles == 0:
             return
-        for i in range(self.num_particles):
-            particle = self.particles[i]
-            size = (self.texture.size[0] * particle.scale, self.texture.size[1] * particle.scale)
-            if particle not in self.particles_dict:
-                self.particles_dict[particle] = dict()
-                color = particle.color[:]
-                with self.canvas:
-                    self.particles_dict[particle]['color'] = Color(color[0], color[1], color[2], color[3])
-                    PushMatrix()
-                    self.particles_dict[particle]['translate'] = Translate()
-                    self.particles_dict[particle]['rotate'] = Rotate()
-                    self.particles_dict[particle]['rotate'].set(particle.rotation, 0, 0, 1)
-                    self.particles_dict[particle]['rect'] = Quad(texture=self.texture, points=(-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5))
-                    self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                    PopMatrix()
+        alpha = self._step_fraction()
+        for particle in self.particles:
+            half_w = self.texture.size[0] * particle.scale * 0.5
+            half_h = self.texture.size[1] * particle.scale * 0.5
+            xy = (particle.prev_x + (particle.x - particle.prev_x) * alpha,
+                  particle.prev_y + (particle.y - particle.prev_y) * alpha)
+            points = (-half_w, -half_h, half_w, -half_h, half_w, half_h, -half_w, half_h)
+            if self.headless:
+                self.quads.append((xy[0], xy[1], particle.rotation, particle.color, points))
+                continue
+
+            graphics = particle.graphics
+            if graphics is None:
+                graphics = particle.graphics = self.pool.create_graphics(self.texture)
+                self.canvas.add(graphics.group)
+            graphics.rotate.angle = particle.rotation
+            graphics.translate.xy = xy
+            graphics.color.rgba = particle.color
+            graphics.rect.points = points
+
+
+# vertex shader for VectorParticleSystem: like kivy's default shader, but with a color per vertex
+VECTOR_VERTEX_SHADER = '''
+$HEADER$
+attribute vec4 vColor;
+
+void main(void) {
+    frag_color = vColor * vec4(1.0, 1.0, 1.0, opacity);
+    tex_coord0 = vTexCoords0;
+    gl_Position = projection_mat * modelview_mat * vec4(vPosition.xy, 0.0, 1.0);
+}
+'''
+
+VECTOR_FRAGMENT_SHADER = '''
+$HEADER$
+
+void main(void) {
+    gl_FragColor = frag_color * texture2D(texture0, tex_coord0);
+}
+'''
+
+# indices are 16 bit, so each Mesh can hold at most 65535 vertices (4 per particle)
+MAX_QUADS_PER_MESH = 16383
+
+
+class VectorParticleSystem(ParticleSystem):
+    """
+    A :class:`ParticleSystem` that stores particles as NumPy arrays (one array per property, for all particles)
+    instead of one :class:`Particle` object each. Every live particle is advanced with a handful of array
+    operations per frame, and all particles are drawn with a few Meshes (one per 16383 particles) using
+    a shader that reads the color of each particle from its vertices.
+
+    Behaves like :class:`ParticleSystem` and takes the same config files, but can animate tens of thousands of
+    particles at 60 fps.
+    """
+
+    def __init__(self, config, **kwargs):
+        """
+        :param config: A pex file with specifications for particle appearance and behavior.
+            See :class:`ParticleSystem`.
+        """
+        # storage is created by _raise_capacity, which runs while the config is parsed
+        self.arrays = {}
+        self.meshes = []
+        self.tex_coords = None
+
+        super(VectorParticleSystem, self).__init__(config, **kwargs)
+        self.num_particles = 0
+
+        # headless systems only fill self.vertices
+        self.render_context = None
+        if not self.headless:
+            self.render_context = RenderContext(use_parent_projection=True, use_parent_modelview=True,
+                                                use_parent_frag_modelview=True)
+            self.render_context.shader.vs = VECTOR_VERTEX_SHADER
+            self.render_context.shader.fs = VECTOR_FRAGMENT_SHADER
+            self.canvas.add(self.render_context)
+
+    def stop(self, clear=False):
+        """
+        Stops particle emission.
+
+        :param clear: If *True*, clears canvas of already emitted particles. Defaults to *False*.
+        """
+        self.emission_time = 0.0
+        if clear:
+            self.num_particles = 0
+            self.render()
+
+    def _create_rng(self, seed):
+        return np.random.default_rng(seed)
+
+    def on_texture(self, instance, value):
+        self.tex_coords = None
+        for mesh in self.meshes:
+            mesh.texture = value
+
+    # names of the per-particle arrays, and the number of values per particle
+    _array_shapes = {
+        'x': 1, 'y': 1, 'prev_x': 1, 'prev_y': 1, 'start_x': 1, 'start_y': 1, 'velocity_x': 1, 'velocity_y': 1,
+        'radial_acceleration': 1, 'tangent_acceleration': 1,
+        'emit_radius': 1, 'emit_radius_delta': 1, 'emit_rotation': 1, 'emit_rotation_delta': 1,
+        'scale': 1, 'scale_delta': 1, 'rotation': 1, 'rotation_delta': 1,
+        'current_time': 1, 'total_time': 1, 'color': 4, 'color_delta': 4,
+    }
+
+    def _raise_capacity(self, by_amount):
+        self._resize(min(self.max_capacity, self.capacity + by_amount))
+
+    def _lower_capacity(self, by_amount):
+        self._resize(max(0, self.capacity - by_amount))
+
+    # reallocate particle storage, keeping live particles
+    def _resize(self, capacity):
+        capacity = int(capacity)
+        keep = min(self.num_particles if self.arrays else 0, capacity)
+        for name, width in self._array_shapes.items():
+            shape = (capacity, width) if width > 1 else (capacity,)
+            new = np.zeros(shape)
+            if name in self.arrays:
+                new[:keep] = self.arrays[name][:keep]
+            self.arrays[name] = new
+            setattr(self, 'p_' + name, new)
+
+        self.num_particles = keep
+        self.capacity = capacity
+
+        # vertex data: 4 vertices per particle of (x, y, u, v, r, g, b, a)
+        self.vertices = np.zeros((capacity, 4, 8), dtype=np.float32)
+        quad = np.array((0, 1, 2, 2, 3, 0), dtype=np.uint32)
+        offsets = (np.arange(min(capacity, MAX_QUADS_PER_MESH), dtype=np.uint32) * 4)[:, None]
+        self.indices = (quad[None, :] + offsets).astype(np.uint16).ravel()
+
+    def _advance_time(self, passed_time):
+        n = self.num_particles
+
+        # remove dead particles (moving live ones to the front)
+        alive = self.p_current_time[:n] < self.p_total_time[:n]
+        if not alive.all():
+            count = int(alive.sum())
+            for a in self.arrays.values():
+                a[:count] = a[:n][alive]
+            n = self.num_particles = count
+            if n == 0:
+                Logger.debug('Particle: COMPLETE')
+
+        # advance existing particles
+        if n:
+            self._advance_particles(0, n, passed_time)
+
+        # create and advance new particles
+        if self.emission_time > 0:
+            time_between_particles = 1.0 / self.emission_rate
+            self.frame_time += passed_time
+
+            if self.frame_time > 0:
+                # number of emission steps, and how many of them have room for a particle
+                steps = int(math.ceil(self.frame_time / time_between_particles))
+                count = min(steps, int(self.max_capacity) - n)
+                if count > 0:
+                    if n + count > self.capacity:
+                        self._raise_capacity(max(self.capacity, n + count - self.capacity))
+                    self._init_particles(n, n + count)
+                    self.num_particles = n + count
+                    self._advance_particles(n, n + count, self.frame_time - np.arange(count) * time_between_particles)
+                self.frame_time -= steps * time_between_particles
+
+            if self.emission_time != sys.maxsize:
+                self.emission_time = max(0.0, self.emission_time - passed_time)
+
+    # vectorized version of random_variance()
+    def _random_variance(self, base, variance, count):
+        return base + variance * self.rng.uniform(-1.0, 1.0, count)
+
+    def _init_particles(self, start, end):
+        count = end - start
+        s = slice(start, end)
+        rv = self._random_variance
+
+        life_span = rv(self.life_span, self.life_span_variance, count)
+        self.p_current_time[s] = 0.0
+        self.p_total_time[s] = np.maximum(life_span, 0.0)
+        life_span = np.maximum(life_span, 1e-6)
+
+        self.p_x[s] = rv(self.emitter_x, self.emitter_x_variance, count)
+        self.p_y[s] = rv(self.emitter_y, self.emitter_y_variance, count)
+        self.p_start_x[s] = self.emitter_x
+        self.p_start_y[s] = self.emitter_y
+
+        angle = rv(self.emit_angle, self.emit_angle_variance, count)
+        speed = rv(self.speed, self.speed_variance, count) * px
+        self.p_velocity_x[s] = speed * np.cos(angle)
+        self.p_velocity_y[s] = speed * np.sin(angle)
+
+        self.p_emit_radius[s] = rv(self.max_radius, self.max_radius_variance, count)
+        self.p_emit_radius_delta[s] = (self.max_radius - self.min_radius) / life_span
+
+        self.p_emit_rotation[s] = rv(self.emit_angle, self.emit_angle_variance, count)
+        self.p_emit_rotation_delta[s] = rv(self.rotate_per_second, self.rotate_per_second_variance, count)
+
+        self.p_radial_acceleration[s] = rv(self.radial_acceleration, self.radial_acceleration_variance, count)
+        self.p_tangent_acceleration[s] = rv(self.tangential_acceleration, self.tangential_acceleration_variance, count)
+
+        start_size = np.maximum(0.1, rv(self.start_size, self.start_size_variance, count)) * px
+        end_size = np.maximum(0.1, rv(self.end_size, self.end_size_variance, count)) * px
+        self.p_scale[s] = start_size / self.texture.width
+        self.p_scale_delta[s] = ((end_size - start_size) / life_span) / self.texture.width
+
+        # colors
+        start_color = np.clip(self.rng.uniform(-1.0, 1.0, (count, 4)) * self.start_color_variance + self.start_color, 0.0, 1.0)
+        end_color = np.clip(self.rng.uniform(-1.0, 1.0, (count, 4)) * self.end_color_variance + self.end_color, 0.0, 1.0)
+        self.p_color[s] = start_color
+        self.p_color_delta[s] = (end_color - start_color) / life_span[:, None]
+
+        # rotation
+        start_rotation = rv(self.start_rotation, self.start_rotation_variance, count)
+        end_rotation = rv(self.end_rotation, self.end_rotation_variance, count)
+        self.p_rotation[s] = start_rotation
+        self.p_rotation_delta[s] = (end_rotation - start_rotation) / life_span
+
+    # advance particles [start, end) by passed_time, which is a number or an array with one value per particle
+    def _advance_particles(self, start, end, passed_time):
+        s = slice(start, end)
+        current_time = self.p_current_time[s]
+        total_time = self.p_total_time[s]
+        passed_time = np.minimum(passed_time, total_time - current_time)
+        current_time += passed_time
+        self.p_prev_x[s] = self.p_x[s]
+        self.p_prev_y[s] = self.p_y[s]
+
+        if self.emitter_type == EMITTER_TYPE_RADIAL:
+            emit_rotation = self.p_emit_rotation[s]
+            emit_radius = self.p_emit_radius[s]
+            emit_rotation += self.p_emit_rotation_delta[s] * passed_time
+            emit_radius -= self.p_emit_radius_delta[s] * passed_time
+            self.p_x[s] = self.emitter_x - np.cos(emit_rotation) * emit_radius
+            self.p_y[s] = self.emitter_y - np.sin(emit_rotation) * emit_radius
+
+            done = emit_radius < self.min_radius
+            current_time[done] = total_time[done]
+
+        else:
+            x = self.p_x[s]
+            y = self.p_y[s]
+            distance_x = x - self.p_start_x[s]
+            distance_y = y - self.p_start_y[s]
+            distance_scalar = np.maximum(np.sqrt(distance_x * distance_x + distance_y * distance_y), 0.01)
+
+            radial_x = distance_x / distance_scalar
+            radial_y = distance_y / distance_scalar
+            radial_acceleration = self.p_radial_acceleration[s]
+            tangent_acceleration = self.p_tangent_acceleration[s]
+
+            velocity_x = self.p_velocity_x[s]
+            velocity_y = self.p_velocity_y[s]
+            velocity_x += passed_time * (self.gravity_x + radial_x * radial_acceleration - radial_y * tangent_acceleration)
+            velocity_y += passed_time * (self.gravity_y + radial_y * radial_acceleration + radial_x * tangent_acceleration)
+
+            x += velocity_x * passed_time
+            y += velocity_y * passed_time
+
+        self.p_scale[s] += self.p_scale_delta[s] * passed_time
+        self.p_rotation[s] += self.p_rotation_delta[s] * passed_time
+        self.p_color[s] += self.p_color_delta[s] * np.reshape(passed_time, (-1, 1))
+
+    def render(self):
+        """
+        Builds the vertices of all particles and updates the Meshes that draw them. In headless mode, only the
+        vertices (*vertices*) are built.
+        """
+        n = self.num_particles
+        if self.tex_coords is None:
+            self.tex_coords = np.array(self.texture.tex_coords, dtype=np.float32).reshape(4, 2)
+
+        if n:
+            # corners of each quad, scaled and rotated. Like ParticleSystem, rotation is used as degrees
+            half_w = 0.5 * self.texture.size[0] * self.p_scale[:n]
+            half_h = 0.5 * self.texture.size[1] * self.p_scale[:n]
+            angle = np.radians(self.p_rotation[:n])
+            cos = np.cos(angle)
+            sin = np.sin(angle)
+
+            # positions between the last two steps
+            alpha = self._step_fraction()
+            x = self.p_prev_x[:n] + (self.p_x[:n] - self.p_prev_x[:n]) * alpha
+            y = self.p_prev_y[:n] + (self.p_y[:n] - self.p_prev_y[:n]) * alpha
+
+            verts = self.vertices[:n]
+            corners = ((-1, -1), (1, -1), (1, 1), (-1, 1))
+            for i, (cx, cy) in enumerate(corners):
+                dx = cx * half_w
+                dy = cy * half_h
+                verts[:, i, 0] = x + dx * cos - dy * sin
+                verts[:, i, 1] = y + dx * sin + dy * cos
+            verts[:, :, 2:4] = self.tex_coords
+            verts[:, :, 4:8] = self.p_color[:n, None, :]
+
+        if self.headless:
+            return
+
+        # one mesh per chunk of MAX_QUADS_PER_MESH particles
+        num_meshes = (n + MAX_QUADS_PER_MESH - 1) // MAX_QUADS_PER_MESH
+        while len(self.meshes) < num_meshes:
+            mesh = Mesh(fmt=[(b'vPosition', 2, 'float'), (b'vTexCoords0', 2, 'float'), (b'vColor', 4, 'float')],
+                        mode='triangles', texture=self.texture)
+            self.render_context.add(mesh)
+            self.meshes.append(mesh)
+
+        for i, mesh in enumerate(self.meshes):
+            start = min(n, i * MAX_QUADS_PER_MESH)
+            end = min(n, start + MAX_QUADS_PER_MESH)
+            set_mesh_data(mesh, self.vertices[start:end].ravel(), self.indices[:6 * (end - start)])
+
+
+def benchmark_bursts(bursts_per_minute=1000, duration=60., fps=60., burst_particles=50, burst_life=0.5):
+    """
+    Simulates short particle bursts (like one per gem hit): starts *bursts_per_minute* ParticleSystems
+    per minute, each emitting for one particle life span, and discards each one once its particles are dead.
+    Runs *duration* seconds of frames with a shared :class:`ParticlePool` and with one pool per burst,
+    and prints the time per frame and how many particles and canvas instruction groups were created.
+    Opens a window, since textures and canvas instructions need a GL context.
+    """
+    import time
+    from kivy.core.window import Window
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'particle', 'fire.pex')
+    dt = 1. / fps
+    burst_interval = 60. / bursts_per_minute
+    num_frames = int(duration * fps)
+
+    for shared in (True, False):
+        shared_pool = ParticlePool()
+        pools = [shared_pool]
+        bursts = []
+        num_bursts = 0
+        next_burst = 0.
+        now = 0.
+
+        start = time.perf_counter()
+        for frame in range(num_frames):
+            now += dt
+            while next_burst <= now:
+                pool = shared_pool if shared else ParticlePool()
+                if not shared:
+                    pools.append(pool)
+                ps = ParticleSystem(config, pool=pool, seed=num_bursts)
+                num_bursts += 1
+                ps.pause()
+                ps.life_span = burst_life
+                ps.life_span_variance = 0
+                ps.max_num_particles = burst_particles
+                ps.start(burst_life)
+                bursts.append((next_burst + burst_life * 2.5, ps))
+                next_burst += burst_interval
+
+            for end_time, ps in bursts:
+                ps.advance(dt)
+                ps.render()
+
+            # kill finished bursts
+            while bursts and bursts[0][0] <= now:
+                bursts.pop(0)[1].stop(clear=True)
+        elapsed = time.perf_counter() - start
+
+        stats = [p.get_stats() for p in pools]
+        print('%s pool: %6.3f ms/frame, %6d particles acquired, %6d particles created, %6d instruction groups created' %
+              ('shared  ' if shared else 'per burst', 1000. * elapsed / num_frames,
+               sum(s['acquired'] for s in stats), sum(s['particles_created'] for s in stats),
+               sum(s['graphics_created'] for s in stats)))
+
+
+def check_interpolation(frames_per_step=4):
+    """
+    Checks that rendered positions move between fixed steps. Runs a headless :class:`ParticleSystem` and
+    :class:`VectorParticleSystem` with frames *frames_per_step* times shorter than *time_step*, renders after
+    every frame and raises AssertionError if a frame that took no step renders the same positions as the
+    frame before it.
+    """
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'particle', 'fire.pex')
+
+    for cls in (ParticleSystem, VectorParticleSystem):
+        ps = cls(config, seed=0, headless=True)
+        ps.time_step = 1. / 30
+        ps.start()
+        # take a few whole steps so there are particles that have moved
+        for i in range(5):
+            ps.advance(ps.time_step)
+
+        dt = ps.time_step / frames_per_step
+        prev = None
+        num_checked = 0
+        for frame in range(4 * frames_per_step):
+            steps = ps.advance(dt)
+            ps.render()
+            if cls is ParticleSystem:
+                pos = np.array([q[:2] for q in ps.quads])
             else:
-                self.particles_dict[particle]['rotate'].angle = particle.rotation
-                self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                self.particles_dict[particle]['color'].rgba = particle.color
-                self.particles_dict[particle]['rect'].points = (-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5)
+                pos = ps.vertices[:ps.num_particles, :, :2].copy()
+            if steps == 0 and prev is not None and len(pos) == len(prev):
+                assert not np.allclose(pos, prev), '%s: positions did not move between steps' % cls.__name__
+                num_checked += 1
+            prev = pos
+        assert num_checked, '%s: no frames without a step were checked' % cls.__name__
+        print('%s: positions moved in %d frames without a step' % (cls.__name__, num_checked))
+
+
+if __name__ == "__main__":
+    check_interpolation()
+    benchmark_bursts()
@@ -18,7 +18,7 @@ import shutil
 import sys, os
 
 sys.path.insert(0, os.path.abspath('..'))
-from kivyparticle import ParticleSystem
+from kivyparticle import VectorParticleSystem
 
 
 def get_param_default(particle, param_name, param_label=None):
@@ -41,7 +41,7 @@ class ViewPanel(StencilView):
 
         # load up the default particle system
         # TODO fix
-        self.particle = ParticleSystem(os.path.join('particle','particle.pex'))
+        self.particle = VectorParticleSystem(os.path.join('particle','particle.pex'))
         self.particle.emitter_x = -200
         self.particle.emitter_y = -200  # particle will be centered once layout is loaded
         self.particle.start()
@@ -106,7 +106,7 @@ class ViewPanel(StencilView):
     def load_config(self, config_path):
         # load up new particle system
         self.remove_widget(self.particle)
-        self.particle = ParticleSystem(config_path)
+        self.particle = VectorParticleSystem(config_path)
         self.center_particle()
         self.particle.start()
         self.add_widget(self.particle)
@@ -6,7 +6,7 @@ PARTICLE_PARAMETERS = [
         'name':'max_num_particles',
         'label':'Max Particles',
         'min':1,
-        'max':1000,
+        'max':50000,
         'step': 1
     },
     {
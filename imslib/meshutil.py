@@ -0,0 +1,27 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+
+# Mesh helpers. Unlike imslib.gfxutil, this does not import kivy.core.window, so code that runs
+# without a window (like the headless particle benchmark) can use it too.
+
+
+def set_mesh_data(mesh, vertices, indices):
+    """
+    Sets the vertices and indices of a Mesh from numpy arrays. The arrays are passed as buffers, so Kivy can
+    copy them without creating a Python float per value. Falls back to lists on Kivy versions that only accept lists.
+
+    :param mesh: The Mesh.
+    :param vertices: A contiguous float32 numpy array of vertex data, in the Mesh's ``fmt``.
+    :param indices: A contiguous uint16 numpy array of indices.
+    """
+    try:
+        mesh.vertices = memoryview(vertices)
+        mesh.indices = memoryview(indices)
+    except (TypeError, ValueError):
+        mesh.vertices = vertices.tolist()
+        mesh.indices = indices.tolist()
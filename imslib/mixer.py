@@ -6,6 +6,7 @@
 #####################################################################
 
 import numpy as np
+from .audio import Audio, run_on_audio_thread, generate_into, reserve_buffer
 
 
 class Mixer(object):
@@ -17,6 +18,7 @@ class Mixer(object):
         super(Mixer, self).__init__()
         self.generators = []
         self.gain = 0.25
+        self.scratch = np.empty(0, dtype=Audio.sample_dtype)
 
     def add(self, gen):
         """
@@ -29,6 +31,9 @@ class Mixer(object):
         :param gen: The generator object.
         """
 
+        run_on_audio_thread(self._add, gen)
+
+    def _add(self, gen):
         if gen not in self.generators:
             self.generators.append(gen)
 
@@ -39,7 +44,12 @@ class Mixer(object):
         :param gen: The generator object to remove.
         """
 
-        self.generators.remove(gen)
+        run_on_audio_thread(self._remove, gen)
+
+    def _remove(self, gen):
+        # may run later on the audio thread, so a missing generator is ignored instead of raising there
+        if gen in self.generators:
+            self.generators.remove(gen)
 
     def set_gain(self, gain):
         """
@@ -69,17 +79,36 @@ class Mixer(object):
             all added generators.
         """
 
-        output = np.zeros(num_frames * num_channels)
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
 
-        # this calls generate() for each generator. generator must return:
-        # (signal, keep_going). If keep_going is True, it means the generator
-        # has more to generate. False means generator is done and will be
-        # removed from the list. signal must be a numpay array of length
-        # num_frames * num_channels
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: True
+        """
+
+        out[:] = 0
+
+        # each generator renders into the same scratch buffer, which is then added to out
+        num_samples = num_frames * num_channels
+        self.scratch = reserve_buffer(self.scratch, num_samples)
+        signal = self.scratch[:num_samples]
+
+        # this calls generate_into() (or generate()) for each generator. keep_going
+        # is True if the generator has more to generate. False means generator is
+        # done and will be removed from the list.
         kill_list = []
         for g in self.generators:
-            (signal, keep_going) = g.generate(num_frames, num_channels)
-            output += signal
+            keep_going = generate_into(g, signal, num_frames, num_channels)
+            out += signal
             if not keep_going:
                 kill_list.append(g)
 
@@ -87,5 +116,5 @@ class Mixer(object):
         for g in kill_list:
             self.generators.remove(g)
 
-        output *= self.gain
-        return (output, True)
+        out *= self.gain
+        return True
@@ -6,7 +6,7 @@
 #####################################################################
 
 import numpy as np
-from .audio import Audio
+from .audio import Audio, run_on_audio_thread, generate_into, reserve_buffer, frame_ramp
 
 # Twelevth root of 2
 kTRT = pow(2.0, 1.0/12.0)
@@ -22,12 +22,20 @@ def midi_to_frequency(n):
 
     return 440.0 * pow(kTRT, (n - 69))
 
+# For each timbre: the periodic function and the amplitude weights of harmonics 1, 2, 3, ...
+kHarmonics = {
+    "sine": (np.sin, (1., )),
+    "square": (np.sin, (1., 0, 1/3., 0, 1/5., 0, 1/7., 0, 1/9.)),
+    "sawtooth": (np.sin, (1., -1/2., 1/3., -1/4., 1/5., -1/6., 1/7., -1/8., 1/9.)),
+    "triangle": (np.cos, (1., 0, 1/9., 0, 1/25., 0, 1/49.)),
+}
+
 class NoteGenerator(object):
     """
     Generates repeating waveforms to create constant tones/notes.
     """
 
-    def __init__(self, pitch, gain, timbre="sine"):
+    def __init__(self, pitch, gain, timbre="sine", use_wavetable=False):
         """
         :param pitch: The MIDI pitch of the note to be generated.
         :param gain: The gain/volume of the note.
@@ -35,6 +43,9 @@ class NoteGenerator(object):
             and allows the production of different timbres, or sound qualities.
             Can be set to one of the following: ``sine``, ``square``, ``sawtooth``, or ``triangle``.
             Defaults to ``sine``.
+        :param use_wavetable: If True, the note is generated by reading from a precomputed,
+            band-limited :class:`Wavetable` with a phase accumulator, instead of summing one ``sin``
+            per harmonic. This is much cheaper and does not lose precision over long notes.
         """
 
         super(NoteGenerator, self).__init__()
@@ -44,15 +55,17 @@ class NoteGenerator(object):
         self.frame = 0
         self.playing = True
 
-        harmonics = {
-            "sine": (np.sin, (1., )),
-            "square": (np.sin, (1., 0, 1/3., 0, 1/5., 0, 1/7., 0, 1/9.)),
-            "sawtooth": (np.sin, (1., -1/2., 1/3., -1/4., 1/5., -1/6., 1/7., -1/8., 1/9.)),
-            "triangle": (np.cos, (1., 0, 1/9., 0, 1/25., 0, 1/49.)),
-        }
+        self.func = kHarmonics[timbre][0]
+        self.harmonics = kHarmonics[timbre][1]
+
+        # wavetable mode: position within the waveform's cycle, in cycles [0, 1)
+        self.wavetable = get_wavetable(timbre) if use_wavetable else None
+        self.table_pos = 0.0
 
-        self.func = harmonics[timbre][0]
-        self.harmonics = harmonics[timbre][1]
+        # scratch buffers for building the waveform
+        self.phase = np.empty(0)
+        self.signal = np.empty(0)
+        self.tmp = np.empty(0)
 
     def note_off(self):
         """
@@ -74,38 +87,69 @@ class NoteGenerator(object):
             if :meth:`note_off` has been called.
         """
 
-        # create time series from frame range
-        time = np.arange(self.frame, self.frame + num_frames) / Audio.sample_rate
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: The continue_flag. ``False`` if :meth:`note_off` has been called.
+        """
 
-        # frequency
-        omega = (2.0 * np.pi) * self.freq
+        self.phase = reserve_buffer(self.phase, num_frames)
+        self.signal = reserve_buffer(self.signal, num_frames)
+        self.tmp = reserve_buffer(self.tmp, num_frames)
+        phase = self.phase[:num_frames]
+        signal = self.signal[:num_frames]
+
+        if self.wavetable:
+            # phase accumulator, in cycles
+            inc = self.freq / Audio.sample_rate
+            np.multiply(frame_ramp(num_frames), inc, out=phase)
+            phase += self.table_pos
+            self.wavetable.lookup(self.wavetable.get_level(self.freq), phase, signal)
+            self.table_pos = (self.table_pos + inc * num_frames) % 1.0
+
+        else:
+            # create time series from frame range, and scale by frequency
+            omega = (2.0 * np.pi) * self.freq
+            np.add(frame_ramp(num_frames), self.frame, out=phase)
+            phase *= omega / Audio.sample_rate
+            self._make_waveform(phase, signal, self.tmp[:num_frames])
 
         # final output, gain
-        output = self.gain * self._make_waveform(omega * time)
+        signal *= self.gain
 
         # advance frame counter
         self.frame += num_frames
 
-        # convert from mono to stereo
-        if num_channels == 2:
-            stereo = np.empty(num_frames * 2)
-            stereo[0::2] = output
-            stereo[1::2] = output
-            output = stereo
+        # write into all channels (mono or interleaved stereo)
+        for c in range(num_channels):
+            out[c::num_channels] = signal
 
-        return (output, self.playing)
+        return self.playing
 
     # Constructs waveform defined by specified timbre during initialization.
-    def _make_waveform(self, time):
+    # Result is written into signal. tmp is scratch space of the same size.
+    def _make_waveform(self, phase, signal, tmp):
         # create fundamental frequency
-        signal = self.harmonics[0] * self.func( time )
+        self.func(phase, out=signal)
+        signal *= self.harmonics[0]
 
         # add additional harmonics
         for (h, w) in enumerate( self.harmonics[1:] ):
             if w != 0: # optimization for amplitude weight = 0
-                signal += w * self.func( time * (h+2))
-
-        return signal
+                np.multiply(phase, h+2, out=tmp)
+                self.func(tmp, out=tmp)
+                tmp *= w
+                signal += tmp
 
 
 class Envelope(object):
@@ -142,6 +186,7 @@ class Envelope(object):
         self.n2 = n2
 
         self.frame = 0
+        self.env = np.empty(0)
 
     def generate(self, num_frames, num_channels):
         """
@@ -156,24 +201,45 @@ class Envelope(object):
             The continue_flag is ``False`` if the envelope has ended, and ``True`` otherwise.
         """
 
-        # get data from predecessor:
-        data, continue_flag = self.generator.generate(num_frames, num_channels)
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return output, continue_flag
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: The continue_flag. ``False`` if the envelope has ended.
+        """
+
+        # get data from predecessor, directly into out:
+        continue_flag = generate_into(self.generator, out, num_frames, num_channels)
 
         # set up correct frame ranges:
         end_frame = self.frame + num_frames
-        frames = np.arange(self.frame, end_frame)
+        self.env = reserve_buffer(self.env, num_frames)
+        env = self.env[:num_frames]
+        np.add(frame_ramp(num_frames), self.frame, out=env)
 
         # boundary is the transition location between attack and decay functions
         boundary = int(np.clip(self.attack_frames - self.frame, 0, num_frames))
 
         # attack part:
-        env1 = (frames[:boundary] / self.attack_frames) ** (1.0/self.n1)
+        env1 = env[:boundary]
+        env1 /= self.attack_frames
+        env1 **= (1.0/self.n1)
 
         # decay part:
-        env2 = 1.0 - ((frames[boundary:] - self.attack_frames) / self.decay_frames) ** (1.0/self.n2)
-
-        # combine:
-        env = np.append(env1, env2)
+        env2 = env[boundary:]
+        env2 -= self.attack_frames
+        env2 /= self.decay_frames
+        env2 **= (1.0/self.n2)
+        np.subtract(1.0, env2, out=env2)
 
         # deal with end of envelope:
         # clamp curve to 0, so we don't get any negative values and don't continue
@@ -184,13 +250,331 @@ class Envelope(object):
         # advance frame counter
         self.frame = end_frame
 
-        # make envelope work for stereo if needed
-        if num_channels == 2:
-            stereo = np.empty(num_frames * 2)
-            stereo[0::2] = env
-            stereo[1::2] = env
-            env = stereo
+        # apply the envelope to every channel
+        frames = out.reshape(num_frames, num_channels)
+        frames *= env[:, np.newaxis]
+        return continue_flag
+
+
+# number of samples in one cycle of a wavetable
+kWavetableSize = 2048
+
+# Wavetable mip-map levels are one octave apart. Level n is used for fundamentals up to
+# kMipBaseFreq * 2**n, and only holds the harmonics that are below Nyquist at that frequency.
+kMipBaseFreq = 20.0
+kNumMipLevels = 11
+
+def make_wavetable(timbre, size = kWavetableSize, max_harmonic = None):
+    """
+    Builds one cycle of the given timbre, using the same harmonics as :class:`NoteGenerator`.
+
+    :param timbre: One of ``sine``, ``square``, ``sawtooth``, or ``triangle``.
+    :param size: The number of samples in one cycle.
+    :param max_harmonic: If given, harmonics above this number are left out.
+
+    :returns: A numpy array of length *size + 1*. The last sample is a copy of the first so that
+        lookups can interpolate without wrapping around.
+    """
+    func, harmonics = kHarmonics[timbre]
+    phase = np.arange(size + 1) * (2.0 * np.pi / size)
+
+    table = np.zeros(size + 1)
+    for (h, w) in enumerate(harmonics[:max_harmonic]):
+        if w != 0:
+            table += w * func(phase * (h+1))
+    table[size] = table[0]
+    return table
+
+
+class Wavetable(object):
+    """
+    Mip-mapped, band-limited wavetables for one timbre. Each level is one cycle of the waveform
+    with only the harmonics that stay below the Nyquist frequency, so high notes do not alias.
+    """
+
+    def __init__(self, timbre, size = kWavetableSize):
+        """
+        :param timbre: One of ``sine``, ``square``, ``sawtooth``, or ``triangle``.
+        :param size: The number of samples in one cycle.
+        """
+        super(Wavetable, self).__init__()
+
+        self.size = size
+        nyquist = Audio.sample_rate / 2.0
+        levels = []
+        for n in range(kNumMipLevels):
+            max_freq = kMipBaseFreq * 2 ** n
+            levels.append(make_wavetable(timbre, size, max(1, int(nyquist // max_freq))))
+
+        # tables[level] is one cycle of length size + 1
+        self.tables = np.array(levels)
+
+    def get_level(self, freq):
+        """
+        :param freq: The fundamental frequency (in Hz) that will be played. May also be a numpy array.
+
+        :returns: The mip-map level to use for this frequency.
+        """
+        level = np.ceil(np.log2(np.maximum(freq, kMipBaseFreq) / kMipBaseFreq))
+        level = np.minimum(level, kNumMipLevels - 1).astype(np.intp)
+        return level if np.ndim(level) else int(level)
+
+    def lookup(self, level, phase, out):
+        """
+        Reads from the table with linear interpolation.
+
+        :param level: The mip-map level, from :meth:`get_level`.
+        :param phase: A numpy array of phases, in cycles (1.0 is one full cycle). Will be modified.
+        :param out: A numpy array of the same length as ``phase`` to write the result into.
+        """
+        table = self.tables[level]
+        phase %= 1.0
+        phase *= self.size
+        idx = phase.astype(np.intp)
+        phase -= idx
+        np.take(table, idx, out=out)
+        out += phase * (table[idx + 1] - out)
+
+
+# one shared Wavetable per timbre, created when first needed
+g_wavetables = {}
+
+def get_wavetable(timbre):
+    """
+    :param timbre: One of ``sine``, ``square``, ``sawtooth``, or ``triangle``.
+
+    :returns: The shared :class:`Wavetable` for this timbre.
+    """
+    if timbre not in g_wavetables:
+        g_wavetables[timbre] = Wavetable(timbre)
+    return g_wavetables[timbre]
+
+
+class VoiceBank(object):
+    """
+    Generates many notes at once. Instead of one :class:`NoteGenerator` per note, the pitch, gain,
+    phase, timbre and envelope of every voice are stored in numpy arrays, and all active voices
+    are rendered together with band-limited wavetable lookups (see :class:`Wavetable`). Each note gets a short linear attack and release
+    so that notes start and stop without clicks.
+    """
+
+    def __init__(self, max_voices = 256, attack_time = 0.005, release_time = 0.05):
+        """
+        :param max_voices: The maximum number of simultaneous voices. When all voices are in use,
+            :meth:`note_on` steals a voice that is already fading out if there is one, otherwise the oldest
+            note (the quietest one breaks ties).
+        :param attack_time: Duration of the fade-in at the start of each note, in seconds.
+        :param release_time: Duration of the fade-out after :meth:`note_off`, in seconds.
+        """
+        super(VoiceBank, self).__init__()
+
+        self.max_voices = max_voices
+        self.attack_delta = 1.0 / max(1, round(attack_time * Audio.sample_rate))
+        self.release_delta = -1.0 / max(1, round(release_time * Audio.sample_rate))
+
+        # all mip-map levels of all timbres, stored as rows of a single table.
+        # row (timbre_idx * kNumMipLevels + level) is one band-limited cycle
+        self.timbres = list(kHarmonics.keys())
+        self.tables = np.concatenate([get_wavetable(t).tables for t in self.timbres])
+
+        # per-voice state
+        self.active = np.zeros(max_voices, dtype=bool)
+        self.handles = np.full(max_voices, -1, dtype=np.int64)
+        self.pitch = np.zeros(max_voices)
+        self.gain = np.zeros(max_voices)
+        self.timbre = np.zeros(max_voices, dtype=np.intp)
+        self.table_row = np.zeros(max_voices, dtype=np.intp)
+        self.phase = np.zeros(max_voices)       # current phase, in cycles [0, 1)
+        self.phase_inc = np.zeros(max_voices)   # phase advance per frame, in cycles
+        self.env = np.zeros(max_voices)         # current envelope level [0, 1]
+        self.env_delta = np.zeros(max_voices)   # envelope change per frame
+
+        self.next_handle = 0
+
+        # scratch buffers for generate_into(), each holding a (voices x frames) array
+        self.phase_buf = np.empty(0)
+        self.index_buf = np.empty(0, dtype=np.intp)
+        self.signal_buf = np.empty(0)
+        self.temp_buf = np.empty(0)
+        self.mono_buf = np.empty(0)
+
+    def note_on(self, pitch, gain, timbre = "sine"):
+        """
+        Starts playing a note.
+
+        :param pitch: The MIDI pitch of the note.
+        :param gain: The gain/volume of the note.
+        :param timbre: One of ``sine``, ``square``, ``sawtooth``, or ``triangle``.
+
+        :returns: A handle (an integer) identifying this note, to be passed into :meth:`note_off`.
+        """
+        handle = self.next_handle
+        self.next_handle += 1
+        run_on_audio_thread(self._note_on, handle, pitch, float(gain), self.timbres.index(timbre))
+        return handle
+
+    def note_off(self, handle):
+        """
+        Releases a note. The note fades out over *release_time* and its voice is then freed.
+        Does nothing if the note has already ended.
+
+        :param handle: The handle returned from :meth:`note_on`.
+        """
+        run_on_audio_thread(self._note_off, handle)
+
+    def get_num_voices(self):
+        """
+        :returns: The number of voices currently sounding (including ones that are fading out).
+        """
+        return int(np.count_nonzero(self.active))
+
+    def _note_on(self, handle, pitch, gain, timbre_idx):
+        # use a free voice, or steal one: voices that are fading out first, then the oldest note,
+        # then the quietest. (Voices still in their attack are quiet but new, so they are not taken first)
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            v = free[0]
+        else:
+            v = np.lexsort((self.env * self.gain, self.handles, self.env_delta >= 0))[0]
+
+        self.active[v] = True
+        self.handles[v] = handle
+        self.pitch[v] = pitch
+        self.gain[v] = gain
+        self.timbre[v] = timbre_idx
+        self.phase[v] = 0
+        freq = midi_to_frequency(pitch)
+        self.phase_inc[v] = freq / Audio.sample_rate
+        self.table_row[v] = timbre_idx * kNumMipLevels + get_wavetable(self.timbres[timbre_idx]).get_level(freq)
+        self.env[v] = 0
+        self.env_delta[v] = self.attack_delta
+
+    def _note_off(self, handle):
+        voices = np.flatnonzero(self.active & (self.handles == handle))
+        self.env_delta[voices] = self.release_delta
+
+    def generate(self, num_frames, num_channels):
+        """
+        Generates the sum of all active voices.
+
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: A tuple ``(output, True)``.
+        """
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: True
+        """
+        voices = np.flatnonzero(self.active)
+        if len(voices) == 0:
+            out[:] = 0
+            return True
+
+        ramp = frame_ramp(num_frames + 1)
+        table_size = self.tables.shape[1] - 1
+
+        # (voices x frames) views into the scratch buffers, so nothing is allocated per block
+        shape = (len(voices), num_frames)
+        size = shape[0] * shape[1]
+        self.phase_buf = reserve_buffer(self.phase_buf, size)
+        self.index_buf = reserve_buffer(self.index_buf, size)
+        self.signal_buf = reserve_buffer(self.signal_buf, size)
+        self.temp_buf = reserve_buffer(self.temp_buf, size)
+        phase = self.phase_buf[:size].reshape(shape)
+        idx = self.index_buf[:size].reshape(shape)
+        signal = self.signal_buf[:size].reshape(shape)
+        temp = self.temp_buf[:size].reshape(shape)
+
+        # phase of every voice at every frame, in table samples
+        np.multiply.outer(self.phase_inc[voices], ramp[:num_frames], out=phase)
+        phase += self.phase[voices, np.newaxis]
+        phase %= 1.0
+        phase *= table_size
+
+        # linearly interpolated lookup into each voice's table (indexing the flattened tables)
+        np.copyto(idx, phase, casting='unsafe')
+        phase -= idx
+        idx += (self.table_row[voices] * (table_size + 1))[:, np.newaxis]
+        flat_tables = self.tables.ravel()
+        np.take(flat_tables, idx, out=signal, mode='clip')
+        idx += 1
+        np.take(flat_tables, idx, out=temp, mode='clip')
+        temp -= signal
+        temp *= phase
+        signal += temp
+
+        # envelope of every voice at every frame (reusing temp)
+        env = temp
+        np.multiply.outer(self.env_delta[voices], ramp[1:], out=env)
+        env += self.env[voices, np.newaxis]
+        np.clip(env, 0, 1, out=env)
+        signal *= env
+        signal *= self.gain[voices, np.newaxis]
+
+        # mix all voices down into every channel
+        self.mono_buf = reserve_buffer(self.mono_buf, num_frames)
+        mono = self.mono_buf[:num_frames]
+        signal.sum(axis=0, out=mono)
+        for c in range(num_channels):
+            out[c::num_channels] = mono
+
+        # advance state, and free voices that have faded out
+        self.phase[voices] = (self.phase[voices] + self.phase_inc[voices] * num_frames) % 1.0
+        self.env[voices] = env[:, -1]
+        done = voices[(self.env_delta[voices] < 0) & (self.env[voices] <= 0)]
+        self.active[done] = False
+        return True
+
+
+def benchmark_oscillators(voice_counts = (1, 16, 128), num_frames = 512, num_blocks = 100):
+    """
+    Compares the cost of rendering notes with the additive :class:`NoteGenerator`, the wavetable
+    :class:`NoteGenerator` (``use_wavetable=True``), and :class:`VoiceBank`. Prints the average
+    time to render one stereo block for each voice count.
+    """
+    import time
+    from .mixer import Mixer
+
+    out = np.empty(num_frames * 2, dtype=Audio.sample_dtype)
+    timbres = list(kHarmonics.keys())
+
+    def time_blocks(gen):
+        start = time.perf_counter()
+        for _ in range(num_blocks):
+            gen.generate_into(out, num_frames, 2)
+        return 1000 * (time.perf_counter() - start) / num_blocks
+
+    print(f'ms per {num_frames}-frame stereo block:')
+    print('{:>7} {:>10} {:>10} {:>10}'.format('voices', 'additive', 'wavetable', 'voicebank'))
+    for num_voices in voice_counts:
+        pitches = [48 + (v * 7) % 36 for v in range(num_voices)]
+
+        results = []
+        for use_wavetable in (False, True):
+            mixer = Mixer()
+            for v, p in enumerate(pitches):
+                mixer.add(NoteGenerator(p, 0.1, timbres[v % 4], use_wavetable))
+            results.append(time_blocks(mixer))
+
+        bank = VoiceBank(max_voices = num_voices)
+        for v, p in enumerate(pitches):
+            bank.note_on(p, 0.1, timbres[v % 4])
+        results.append(time_blocks(bank))
+
+        print('{:>7} {:>10.3f} {:>10.3f} {:>10.3f}'.format(num_voices, *results))
 
-        output = env * data
-        return output, continue_flag
 
+if __name__ == "__main__":
+    benchmark_oscillators()
@@ -0,0 +1,187 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+import numpy as np
+import time
+import weakref
+from . import audio
+
+
+class _Node(object):
+    # timing history of one generator or listener
+    def __init__(self, obj, name, history):
+        super(_Node, self).__init__()
+        try:
+            self.ref = weakref.ref(obj)
+        except TypeError:
+            self.ref = lambda: obj
+        self.name = name
+        self.times = np.zeros(history)
+        self.count = 0
+        self.block_time = 0
+        self.last_block = 0
+
+    def record(self):
+        self.times[self.count % len(self.times)] = self.block_time
+        self.count += 1
+        self.block_time = 0
+
+    def get_stats(self):
+        times = self.times[:min(self.count, len(self.times))]
+        return {'name': self.name, 'mean': 1000 * times.mean(), 'p99': 1000 * np.percentile(times, 99),
+                'max': 1000 * times.max(), 'blocks': self.count}
+
+
+class Profiler(object):
+    """
+    Opt-in instrumentation of the generator graph. Once enabled with :meth:`start`, every generator called
+    through :func:`imslib.audio.generate_into` (the generator set on :class:`~imslib.audio.Audio`, everything
+    in a :class:`~imslib.mixer.Mixer`, the generator of an :class:`~imslib.clock.AudioScheduler`, and so on)
+    and every listen function is timed.
+
+    Times are *self* times: the time spent in a node minus the time spent in the nodes it calls, so a
+    :class:`~imslib.mixer.Mixer` only reports the cost of mixing. For each node, the total time per audio
+    block is kept for the last *history* blocks, and :meth:`get_stats` reports its mean, 99th percentile and
+    maximum, along with the total per block and the number of underruns reported by the audio stream.
+
+    This module does not depend on Kivy. For an on-screen display, see :func:`imslib.gfxutil.profiler_label`.
+    """
+
+    def __init__(self, history = 1000):
+        """
+        :param history: Number of audio blocks used to compute statistics.
+        """
+        super(Profiler, self).__init__()
+
+        self.history = history
+        self.nodes = {}
+        self.type_counts = {}
+        self.total = _Node(self, 'total', history)
+        self.source = None
+
+        self.stack = []
+        self.touched = []
+        self.num_blocks = 0
+        self.block_start = 0
+
+    def start(self):
+        """
+        Starts profiling.
+        """
+        audio.set_profiler(self)
+
+    def stop(self):
+        """
+        Stops profiling. Collected statistics are kept.
+        """
+        if audio.g_profiler is self:
+            audio.set_profiler(None)
+
+    def begin_block(self, source = None):
+        """
+        Called by the audio engine before generating each block.
+
+        :param source: The object generating audio. If it has a ``get_underruns()`` method, underruns are
+            included in the statistics.
+        """
+        self.source = source
+        self.block_start = time.perf_counter()
+
+    def end_block(self):
+        """
+        Called by the audio engine after each block is generated and sent to listeners.
+        """
+        self.total.block_time = time.perf_counter() - self.block_start
+        self.total.record()
+        for node in self.touched:
+            node.record()
+        self.touched.clear()
+
+        # forget about generators that have not played for a while (ie, finished notes)
+        self.num_blocks += 1
+        if self.num_blocks % self.history == 0:
+            old = self.num_blocks - self.history
+            self.nodes = {k: n for k, n in self.nodes.items() if n.last_block > old}
+
+    def time_generate(self, gen, out, num_frames, num_channels):
+        """
+        Times one call of :func:`imslib.audio.generate_into`.
+
+        :returns: The generator's continue_flag.
+        """
+        t_start = time.perf_counter()
+        self.stack.append(0)
+        try:
+            return audio._generate_into(gen, out, num_frames, num_channels)
+        finally:
+            self._add(gen, time.perf_counter() - t_start)
+
+    def time_call(self, fn, *args):
+        """
+        Times a call to ``fn(*args)``, such as a listen function.
+        """
+        t_start = time.perf_counter()
+        self.stack.append(0)
+        try:
+            fn(*args)
+        finally:
+            self._add(fn, time.perf_counter() - t_start)
+
+    def get_stats(self):
+        """
+        :returns: A dictionary with keys ``'nodes'``, a list of per-node statistics sorted by mean time (most
+            expensive first), ``'total'``, the statistics of whole blocks, and ``'underruns'``. Statistics are
+            dictionaries with keys ``'name'``, ``'mean'``, ``'p99'``, ``'max'`` (all in milliseconds) and
+            ``'blocks'``, the number of blocks in which the node ran.
+        """
+        nodes = [n.get_stats() for n in list(self.nodes.values()) if n.count]
+        nodes.sort(key=lambda s: s['mean'], reverse=True)
+
+        underruns = 0
+        if hasattr(self.source, 'get_underruns'):
+            underruns = self.source.get_underruns()
+
+        total = self.total.get_stats() if self.total.count else None
+        return {'nodes': nodes, 'total': total, 'underruns': underruns}
+
+    def get_report(self, max_nodes = 8):
+        """
+        :param max_nodes: Maximum number of nodes to list.
+
+        :returns: A multi-line text summary of :meth:`get_stats`.
+        """
+        stats = self.get_stats()
+        lines = ['%-20s %6s %6s %6s' % ('node (ms)', 'mean', 'p99', 'max')]
+        rows = stats['nodes'][:max_nodes]
+        if stats['total']:
+            rows = rows + [stats['total']]
+        for s in rows:
+            lines.append('%-20s %6.3f %6.3f %6.3f' % (s['name'][:20], s['mean'], s['p99'], s['max']))
+        lines.append('underruns: %d' % stats['underruns'])
+        return '\n'.join(lines)
+
+    # record the time of a call, subtracting time spent in nested calls
+    def _add(self, obj, elapsed):
+        children = self.stack.pop()
+        if self.stack:
+            self.stack[-1] += elapsed
+
+        node = self.nodes.get(id(obj))
+        if node is None or node.ref() is not obj:
+            node = _Node(obj, self._make_name(obj), self.history)
+            self.nodes[id(obj)] = node
+
+        if node.last_block != self.num_blocks + 1:
+            node.last_block = self.num_blocks + 1
+            self.touched.append(node)
+        node.block_time += elapsed - children
+
+    def _make_name(self, obj):
+        name = getattr(obj, '__qualname__', type(obj).__name__)
+        num = self.type_counts.get(name, 0) + 1
+        self.type_counts[name] = num
+        return '%s#%d' % (name, num)
@@ -0,0 +1,168 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+import numpy as np
+import time
+import wave
+from . import audio
+from .audio import Audio, generate_into
+from .clock import VirtualClock
+
+
+class OfflineRenderer(object):
+    """
+    Renders audio from a generator without an audio device, as fast as the generator allows.
+    This is useful for rendering songs to a wave file, for regression-testing mixes, and for
+    measuring how many frames per second a generator graph can produce.
+
+    Time is kept by a :class:`~imslib.clock.VirtualClock` (see :attr:`clock`), which is advanced by
+    the duration of each rendered block. Code that normally runs from ``on_update`` (for example,
+    :meth:`Scheduler.on_update() <imslib.clock.Scheduler.on_update>`) can be registered with
+    :meth:`add_update_func` and is called between blocks. :class:`~imslib.clock.AudioScheduler`
+    keeps time by counting frames, so it works as-is.
+    """
+
+    def __init__(self, generator, num_channels = 2, block_size = 8192):
+        """
+        :param generator: The generator to render. Any object with ``generate(num_frames, num_channels)``
+            or ``generate_into(out, num_frames, num_channels)``.
+        :param num_channels: Number of channels to render. Can be 1 (mono) or 2 (stereo).
+        :param block_size: Number of frames generated per block. Larger blocks are faster, but update
+            functions are called less often, so :class:`~imslib.clock.Scheduler` timing gets coarser.
+        """
+        super(OfflineRenderer, self).__init__()
+
+        self.generator = generator
+        self.num_channels = num_channels
+        self.block_size = block_size
+
+        self.clock = VirtualClock()
+        self.frame = 0
+        self.update_funcs = []
+        self.listen_funcs = []
+
+        self.out_buffer = np.empty(block_size * num_channels, dtype=Audio.sample_dtype)
+        self.int_buffer = np.empty(block_size * num_channels, dtype=np.int16)
+
+    def add_update_func(self, fn):
+        """
+        Adds a function that is called before every block, like a ``MainWidget.on_update()``.
+
+        :param fn: A function with no arguments.
+        """
+        self.update_funcs.append(fn)
+
+    def add_listen_func(self, fn):
+        """
+        Adds a function that receives every rendered block, like :meth:`Audio.add_listen_func`.
+
+        :param fn: A function with signature ``fn(data, num_channels)``.
+        """
+        self.listen_funcs.append(fn)
+
+    def get_time(self):
+        """
+        :returns: The amount of audio rendered so far, in seconds.
+        """
+        return self.frame / Audio.sample_rate
+
+    def render(self, duration, filepath = None):
+        """
+        Renders audio until *duration* seconds have been generated, or until the generator is done.
+
+        :param duration: Amount of audio to render, in seconds.
+        :param filepath: If given, the output is streamed to this 16 bit wave file.
+
+        :returns: A dictionary with the number of ``frames`` rendered, the ``wall_time`` it took, the
+            throughput in ``frames_per_sec``, and the ``realtime_factor`` (seconds of audio rendered per
+            second of wall-clock time).
+        """
+        end_frame = self.frame + int(round(duration * Audio.sample_rate))
+        start_frame = self.frame
+
+        writer = None
+        if filepath is not None:
+            writer = wave.open(filepath, 'w')
+            writer.setnchannels(self.num_channels)
+            writer.setsampwidth(2)
+            writer.setframerate(Audio.sample_rate)
+
+        t_start = time.perf_counter()
+        try:
+            while self.generator and self.frame < end_frame:
+                for fn in self.update_funcs:
+                    fn()
+
+                num_frames = min(self.block_size, end_frame - self.frame)
+                num_samples = num_frames * self.num_channels
+                data = self.out_buffer[:num_samples]
+
+                profiler = audio.g_profiler
+                if profiler:
+                    profiler.begin_block(self)
+
+                continue_flag = generate_into(self.generator, data, num_frames, self.num_channels)
+
+                for fn in self.listen_funcs:
+                    if profiler:
+                        profiler.time_call(fn, data, self.num_channels)
+                    else:
+                        fn(data, self.num_channels)
+
+                if profiler:
+                    profiler.end_block()
+
+                if writer:
+                    writer.writeframesraw(self._to_int16(data).tobytes())
+
+                self.frame += num_frames
+                self.clock.advance(num_frames / Audio.sample_rate)
+
+                if not continue_flag:
+                    self.generator = None
+        finally:
+            # closing the writer fixes up the header with the final length
+            if writer:
+                writer.close()
+
+        wall_time = time.perf_counter() - t_start
+        frames = self.frame - start_frame
+        rate = frames / wall_time if wall_time > 0 else float('inf')
+        return {'frames': frames, 'wall_time': wall_time, 'frames_per_sec': rate,
+                'realtime_factor': rate / Audio.sample_rate}
+
+    # scale to 16 bit, clipping instead of wrapping around on overloads.
+    # data is scaled in place, since it is our own buffer and is not used again.
+    def _to_int16(self, data):
+        np.multiply(data, 2**15, out=data)
+        np.clip(data, -2**15, 2**15 - 1, out=data)
+        out = self.int_buffer[:len(data)]
+        out[:] = data
+        return out
+
+
+def benchmark_render(num_notes = 32, duration = 30, block_sizes = (512, 4096, 32768)):
+    """
+    Renders a :class:`~imslib.mixer.Mixer` of wavetable notes at different block sizes and prints
+    the throughput of each.
+    """
+    from .mixer import Mixer
+    from .note import NoteGenerator
+
+    for block_size in block_sizes:
+        mixer = Mixer()
+        for n in range(num_notes):
+            mixer.add(NoteGenerator(48 + n, 1.0 / num_notes, 'sawtooth', use_wavetable=True))
+
+        renderer = OfflineRenderer(mixer, 2, block_size)
+        stats = renderer.render(duration)
+        print('block size %6d: %10.0f frames/sec (%5.1fx real time)' %
+              (block_size, stats['frames_per_sec'], stats['realtime_factor']))
+
+
+if __name__ == "__main__":
+    benchmark_render()
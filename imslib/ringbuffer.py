@@ -0,0 +1,184 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Preallocated float32 ring buffer of interleaved audio, written by one thread (the audio path)
+    and read by any number of consumers on other threads at their own pace. See :meth:`Audio.add_tap`.
+
+    No locks are used. Positions are counted in frames since the buffer was created and only grow. The
+    writer announces the range it is about to overwrite (:attr:`write_end`) before copying, and only
+    publishes the new :attr:`write_pos` after copying. A reader copies what it wants and then checks
+    ``write_end`` again: any part of its copy that the writer may have overwritten in the meantime (a
+    torn read) is dropped and counted as an overrun. Integer assignment is atomic in Python, so this
+    is safe without locks.
+    """
+
+    def __init__(self, num_frames, num_channels):
+        """
+        :param num_frames: Capacity of the ring buffer, in frames.
+        :param num_channels: Number of interleaved channels.
+        """
+        super(RingBuffer, self).__init__()
+
+        self.size = num_frames
+        self.num_channels = num_channels
+        self.data = np.zeros(num_frames * num_channels, dtype=np.float32)
+
+        # frame counters. write_end >= write_pos. Frames in [write_end - size, write_pos) are readable.
+        self.write_pos = 0
+        self.write_end = 0
+
+        # number of frames the writer could not hold because a single write was larger than the buffer
+        self.frames_dropped = 0
+
+    def write(self, data, num_channels):
+        """
+        Copies a block of audio into the ring buffer, overwriting the oldest frames. Must only be called
+        from a single thread. Has the same signature as a listen function (see :meth:`Audio.add_listen_func`).
+
+        :param data: A numpy array of interleaved audio.
+        :param num_channels: Number of channels in *data*. Must match the ring buffer.
+        """
+        assert(num_channels == self.num_channels)
+        num_frames = len(data) // num_channels
+
+        # a block larger than the whole buffer: only the newest frames can be kept
+        if num_frames > self.size:
+            skip = num_frames - self.size
+            self.frames_dropped += skip
+            self.write_pos += skip
+            self.write_end = self.write_pos
+            data = data[skip * num_channels:]
+            num_frames = self.size
+
+        start = self.write_pos
+        self.write_end = start + num_frames
+        self._copy_in(start, data)
+        self.write_pos = start + num_frames
+
+    def get_write_pos(self):
+        """
+        :returns: The total number of frames written so far.
+        """
+        return self.write_pos
+
+    def read(self, start_frame, num_frames, out = None):
+        """
+        Copies frames out of the ring buffer, starting at an absolute frame position.
+
+        :param start_frame: The first frame to read (a position as returned by :meth:`get_write_pos`).
+        :param num_frames: The number of frames to read.
+        :param out: Optional float32 array of length *(num_frames * num_channels)* to copy into.
+
+        :returns: A tuple ``(data, start_frame)``. ``data`` holds the frames that were valid for the whole
+            copy, which may start later and be shorter than requested if the writer has already overwritten
+            (or is overwriting) the oldest frames. ``start_frame`` is the position of the first returned frame.
+        """
+        if out is None:
+            out = np.empty(num_frames * self.num_channels, dtype=np.float32)
+
+        end_frame = min(start_frame + num_frames, self.write_pos)
+        start_frame = max(start_frame, self.write_end - self.size)
+        if end_frame <= start_frame:
+            return out[:0], end_frame
+
+        n = end_frame - start_frame
+        self._copy_out(start_frame, out[:n * self.num_channels])
+
+        # check for a torn read: did the writer start overwriting frames we were copying?
+        oldest = self.write_end - self.size
+        if oldest > start_frame:
+            skip = min(oldest - start_frame, n)
+            return out[skip * self.num_channels : n * self.num_channels], start_frame + skip
+
+        return out[:n * self.num_channels], start_frame
+
+    def get_reader(self):
+        """
+        :returns: A new :class:`RingReader` that starts reading at the current write position.
+        """
+        return RingReader(self)
+
+    def _copy_in(self, start_frame, data):
+        ch = self.num_channels
+        idx = (start_frame % self.size) * ch
+        first = min(len(data), len(self.data) - idx)
+        self.data[idx : idx + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+
+    def _copy_out(self, start_frame, out):
+        ch = self.num_channels
+        idx = (start_frame % self.size) * ch
+        first = min(len(out), len(self.data) - idx)
+        out[:first] = self.data[idx : idx + first]
+        out[first:] = self.data[:len(out) - first]
+
+
+class RingReader(object):
+    """
+    A consumer's read position into a :class:`RingBuffer`. Each consumer should have its own reader.
+    If the consumer falls so far behind that the writer overwrites frames it has not read yet, those frames
+    are skipped and counted in :attr:`overruns` and :attr:`frames_lost`.
+    """
+
+    def __init__(self, ring):
+        """
+        :param ring: The :class:`RingBuffer` to read from.
+        """
+        super(RingReader, self).__init__()
+
+        self.ring = ring
+        self.pos = ring.get_write_pos()
+        self.overruns = 0
+        self.frames_lost = 0
+
+    def get_available(self):
+        """
+        :returns: Number of frames written since the last read (including any that were already overwritten).
+        """
+        return self.ring.get_write_pos() - self.pos
+
+    def read(self, max_frames = None, out = None):
+        """
+        Reads all new frames since the last read, or up to *max_frames* of them.
+
+        :param max_frames: The maximum number of frames to read. If None, reads everything available.
+        :param out: Optional float32 array to copy into. Must be large enough for the requested frames.
+
+        :returns: A numpy array of interleaved float32 audio.
+        """
+        num_frames = self.get_available()
+        if max_frames is not None:
+            num_frames = min(num_frames, max_frames)
+
+        data, start = self.ring.read(self.pos, num_frames, out)
+        if start > self.pos:
+            self.overruns += 1
+            self.frames_lost += start - self.pos
+
+        self.pos = start + len(data) // self.ring.num_channels
+        return data
+
+    def read_latest(self, num_frames, out = None):
+        """
+        Reads the most recent *num_frames* frames, regardless of what has been read before, and moves the
+        read position to the end. Useful for visualizers and analyzers that only care about "now".
+
+        :param num_frames: Number of frames to read.
+        :param out: Optional float32 array of length *(num_frames * num_channels)* to copy into.
+
+        :returns: A numpy array of interleaved float32 audio. Shorter than requested if not enough audio
+            has been written yet.
+        """
+        end = self.ring.get_write_pos()
+        data, start = self.ring.read(end - num_frames, num_frames, out)
+        self.pos = end
+        return data
@@ -7,7 +7,7 @@
 
 import numpy as np
 import fluidsynth
-from .audio import Audio
+from .audio import Audio, run_on_audio_thread, is_audio_thread
 import pathlib
 import os
 
@@ -30,7 +30,11 @@ class Synth(fluidsynth.Synth, object):
         self.sfid = self.sfload(filepath)
         if self.sfid == -1:
             raise Exception('Error in fluidsynth.sfload(): cannot open ' + filepath)
-        
+
+        # events recorded by set_event_offset(): (frame offset, function, args)
+        self.event_offset = None
+        self.events = []
+
         # set default sound for each channel upfront
         for channel in range(16):
             self.program(channel, 0, 0)
@@ -45,7 +49,7 @@ class Synth(fluidsynth.Synth, object):
         :param preset: The preset to use.
         """
 
-        self.program_select(chan, self.sfid, bank, preset)
+        self._post(self.program_select, chan, self.sfid, bank, preset)
 
     def generate(self, num_frames, num_channels):
         """
@@ -58,12 +62,63 @@ class Synth(fluidsynth.Synth, object):
             **(num_frames * num_channels)**
         """
 
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length **(num_frames * num_channels)** to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Must be 2 (stereo)
+
+        :returns: True
+        """
+
         assert(num_channels == 2)
-        # get_samples() returns interleaved stereo, so all we have to do is scale
-        # the data to [-1, 1].
-        samples = self.get_samples(num_frames).astype(np.float32)
-        samples *= (1.0/32768.0)
-        return (samples, True)
+
+        # apply recorded events at their exact frame offsets, rendering the audio in between
+        frame = 0
+        if self.events:
+            events, self.events = self.events, []
+            events.sort(key = lambda e: e[0])
+            for (offset, func, args) in events:
+                if offset > frame:
+                    self._render_into(out, frame, offset)
+                    frame = offset
+                func(*args)
+
+        self._render_into(out, frame, num_frames)
+        return True
+
+    # render frames [start, end) of out
+    def _render_into(self, out, start, end):
+        if end > start:
+            # get_samples() returns interleaved stereo, so all we have to do is scale
+            # the data to [-1, 1].
+            np.multiply(self.get_samples(end - start), 1.0/32768.0, out=out[2 * start : 2 * end])
+
+    def set_event_offset(self, offset):
+        """
+        Used by :class:`~imslib.clock.AudioScheduler` to get sample-accurate timing for a whole block
+        in one :meth:`generate_into` call. While an offset is set, :meth:`noteon`, :meth:`noteoff`,
+        :meth:`pitch_bend`, :meth:`cc` and :meth:`program` calls made on the audio thread are not
+        applied right away. Instead they are recorded, and applied exactly *offset* frames into the
+        next block that is generated.
+
+        :param offset: The frame offset into the next block, or ``None`` to apply calls immediately.
+        """
+        self.event_offset = offset
+
+    # record a synth call if an event offset is set, otherwise run it on the audio thread
+    def _post(self, func, *args):
+        if self.event_offset is not None and is_audio_thread():
+            self.events.append((self.event_offset, func, args))
+        else:
+            run_on_audio_thread(func, *args)
 
     def noteon(self, chan, key, vel):
         """
@@ -74,7 +129,7 @@ class Synth(fluidsynth.Synth, object):
         :param vel: The velocity to play the note at -- correlates with volume.
             Ranges from 0 to 127.
         """
-        super().noteon(chan, key, vel)
+        self._post(super().noteon, chan, key, vel)
 
     def noteoff(self, chan, key):
         """
@@ -83,7 +138,7 @@ class Synth(fluidsynth.Synth, object):
         :param chan: The channel on which the note should be stopped.
         :param key: The key to stop.
         """
-        super().noteoff(chan, key)
+        self._post(super().noteoff, chan, key)
 
     def pitch_bend(self, chan, val):
         """
@@ -98,7 +153,7 @@ class Synth(fluidsynth.Synth, object):
         :param chan: The channel to use for audio playback.
         :param val: The value to adjust pitch by, as specified above.
         """
-        super().pitch_bend(chan, val)
+        self._post(super().pitch_bend, chan, val)
 
     def cc(self, chan, ctrl, val):
         """
@@ -118,7 +173,7 @@ class Synth(fluidsynth.Synth, object):
         :param ctrl: The control to modify, examples provided above.
         :param val: The new value for the control. Always ranges 0 to 127.
         """
-        super().cc(chan, ctrl, val)
+        self._post(super().cc, chan, ctrl, val)
 
     def set_pitchbend_range(self, chan, semitones):
         """The default pitchbend range is +/- 2 semitones. Use this to set a new pitchbend range
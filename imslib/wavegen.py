@@ -7,6 +7,7 @@
 
 
 import numpy as np
+from .audio import Audio, run_on_audio_thread, generate_into, reserve_buffer, frame_ramp
 
 # generates audio data by asking an audio-source (ie, WaveFile) for that data.
 class WaveGenerator(object):
@@ -31,6 +32,9 @@ class WaveGenerator(object):
         """
         Restarts playback from frame 0.
         """
+        run_on_audio_thread(self._reset)
+
+    def _reset(self):
         self.paused = True
         self.frame = 0
 
@@ -38,19 +42,25 @@ class WaveGenerator(object):
         """
         Toggles play and pause.
         """
+        run_on_audio_thread(self._toggle)
+
+    def _toggle(self):
         self.paused = not self.paused
 
     def play(self):
         """
         Starts audio generation from the last frame it played.
         """
-        self.paused = False
+        run_on_audio_thread(self._set_paused, False)
 
     def pause(self):
         """
         Pauses audio generation.
         """
-        self.paused = True
+        run_on_audio_thread(self._set_paused, True)
+
+    def _set_paused(self, paused):
+        self.paused = paused
 
     def release(self):
         """
@@ -85,42 +95,65 @@ class WaveGenerator(object):
         :returns: A tuple ``(output, True)``. The output is the audio data from
             wave source, a numpy array of size num_frames * num_channels.
         """
-        if self.paused:
-            output = np.zeros(num_frames * num_channels)
-            return (output, True)
-
-        else:
-            # get data based on our position and requested # of frames
-            output = self.source.get_frames(self.frame, num_frames)
-            src_channels = self.source.get_num_channels()
-            if num_channels != src_channels:
-                output = convert_channels(output, src_channels, num_channels)
-
-            # check for end-of-buffer condition:
-            actual_num_frames = len(output) // num_channels
-            continue_flag = actual_num_frames == num_frames
-
-            # advance current-frame
-            self.frame += actual_num_frames
-
-            # looping. If we got to the end of the buffer, don't actually end.
-            # Instead, read some more from the beginning
-            if self.loop and not continue_flag:
-                continue_flag = True
-                remainder = num_frames - actual_num_frames
-                output = np.append(output, self.source.get_frames(0, remainder))
-                self.frame = remainder
+        output = np.empty(num_frames * num_channels, dtype=Audio.sample_dtype)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
 
-            if self._release:
-                continue_flag = False
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
 
-            # zero-pad if output is too short (may happen if not looping / end of buffer)
-            shortfall = num_frames * num_channels - len(output)
-            if shortfall > 0:
-                output = np.append(output, np.zeros(shortfall))
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
 
-            # return
-            return (output * self.gain, continue_flag)
+        :returns: The continue_flag. *False* when the end of the (non-looping) wave source was
+            reached or :meth:`release` was called.
+        """
+        if self.paused:
+            out[:] = 0
+            return True
+
+        # get data based on our position and requested # of frames
+        data = self._get_frames(self.frame, num_frames, num_channels)
+        o_idx = len(data)
+        out[:o_idx] = data
+
+        # check for end-of-buffer condition:
+        actual_num_frames = o_idx // num_channels
+        continue_flag = actual_num_frames == num_frames
+
+        # advance current-frame
+        self.frame += actual_num_frames
+
+        # looping. If we got to the end of the buffer, don't actually end.
+        # Instead, read some more from the beginning
+        if self.loop and not continue_flag:
+            continue_flag = True
+            remainder = num_frames - actual_num_frames
+            data = self._get_frames(0, remainder, num_channels)
+            out[o_idx : o_idx + len(data)] = data
+            o_idx += len(data)
+            self.frame = remainder
+
+        if self._release:
+            continue_flag = False
+
+        # zero-pad if output is too short (may happen if not looping / end of buffer)
+        out[o_idx:] = 0
+
+        if self.gain != 1.0:
+            out *= self.gain
+        return continue_flag
+
+    # read from the wave source, converting to num_channels if needed
+    def _get_frames(self, start_frame, num_frames, num_channels):
+        data = self.source.get_frames(start_frame, num_frames)
+        src_channels = self.source.get_num_channels()
+        if num_channels != src_channels:
+            data = convert_channels(data, src_channels, num_channels)
+        return data
 
 
 def convert_channels(data, in_channels, out_channels):
@@ -134,7 +167,7 @@ def convert_channels(data, in_channels, out_channels):
     # copy mono input into all output channels, interleaved
     if in_channels == 1:
         frames = len(data)
-        output = np.empty(frames * out_channels)
+        output = np.empty(frames * out_channels, dtype=Audio.sample_dtype)
         for c in range(out_channels):
             output[c::out_channels] = data
         return output
@@ -142,7 +175,7 @@ def convert_channels(data, in_channels, out_channels):
     # reduce all input interleaved input channels into one mono output, averaging data
     if out_channels == 1:
         frames = len(data) // in_channels
-        in_data = np.empty((in_channels, frames))
+        in_data = np.empty((in_channels, frames), dtype=Audio.sample_dtype)
         for c in range(in_channels):
             in_data[c] = data[c::in_channels]
         return in_data.mean(axis=0)
@@ -164,6 +197,7 @@ class SpeedModulator(object):
         super(SpeedModulator, self).__init__()
         self.generator = generator
         self.speed = speed
+        self.scratch = np.empty(0, dtype=Audio.sample_dtype)
 
     def set_speed(self, speed):
         """
@@ -185,28 +219,40 @@ class SpeedModulator(object):
         :returns: A tuple ``(output, True)``. The output is the audio data from
             wave source, a numpy array of size num_frames * num_channels.
         """
+        output = np.empty(num_channels * num_frames, dtype=Audio.sample_dtype)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels):
+        """
+        Same as :meth:`generate`, but writes the output into a caller-owned buffer instead
+        of allocating a new one.
+
+        :param out: A numpy array of type ``Audio.sample_dtype`` and length *(num_frames * num_channels)* to write into.
+        :param num_frames: An integer number of frames to generate.
+        :param num_channels: Number of channels. Can be 1 (mono) or 2 (stereo)
+
+        :returns: The continue_flag of the underlying generator.
+        """
         # optimization if speed is 1.0
         if self.speed == 1.0:
-            return self.generator.generate(num_frames, num_channels)
+            return generate_into(self.generator, out, num_frames, num_channels)
 
         # otherwise, we need to ask self.generator for a number of frames that is
         # larger or smaller than num_frames, depending on self.speed
         adj_frames = int(round(num_frames * self.speed))
 
         # get data from generator
-        data, continue_flag = self.generator.generate(adj_frames, num_channels)
-
-        # split into multi-channels:
-        data_chans = [ data[n::num_channels] for n in range(num_channels) ]
-
-        # stretch or squash data to fit exactly into num_frames
-        from_range = np.arange(adj_frames)
-        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
-        resampled = [ np.interp(to_range, from_range, data_chans[n]) for n in range(num_channels) ]
-
-        # convert back by interleaving into a single buffer
-        output = np.empty(num_channels * num_frames, dtype=float)
+        num_samples = adj_frames * num_channels
+        self.scratch = reserve_buffer(self.scratch, num_samples)
+        data = self.scratch[:num_samples]
+        continue_flag = generate_into(self.generator, data, adj_frames, num_channels)
+
+        # stretch or squash each channel to fit exactly into num_frames, interleaving
+        # directly into the output
+        from_range = frame_ramp(adj_frames)
+        to_range = frame_ramp(num_frames) * (float(adj_frames) / num_frames)
         for n in range(num_channels):
-            output[n::num_channels] = resampled[n]
+            out[n::num_channels] = np.interp(to_range, from_range, data[n::num_channels])
 
-        return (output, continue_flag)
+        return continue_flag
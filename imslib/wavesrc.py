@@ -6,14 +6,18 @@
 #####################################################################
 
 import numpy as np
+import os
 import wave
+import struct
+import threading
+from collections import OrderedDict
 from .audio import Audio
 
 class WaveFile(object):
     """
 
     Interface for reading data from a wave file. Does not store this data locally.
-    Simply call `get_frames()` to get data in a format we like *(numpy array, floats)*.
+    Simply call `get_frames()` to get data in a format we like *(numpy array of* ``Audio.sample_dtype`` *)*.
 
     """
 
@@ -49,10 +53,10 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(num_frames)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
-        samples = samples.astype(float)
+        samples = samples.astype(Audio.sample_dtype)
         samples *= (1 / 32768.0)
 
         return samples
@@ -64,25 +68,235 @@ class WaveFile(object):
 
         return self.num_channels
 
+class MappedWaveFile(object):
+    """
+    Interface for reading data from a wave file by memory-mapping the file's sample data.
+    Nothing is read or copied up front, and :meth:`get_frames` does not make any file system calls,
+    so seeking to any position is O(1). Only the requested window is converted to ``Audio.sample_dtype``.
+    This is the best choice for long files that are streamed during playback.
+    """
+
+    def __init__(self, filepath):
+        """
+        :param filepath: The path to the wave file. Should be a 16 bit PCM file with a sample rate of 44100Hz.
+        """
+        super(MappedWaveFile, self).__init__()
+
+        data_offset, data_size, params = self._read_header(filepath)
+        audio_format, self.num_channels, self.sr, bits = params
+
+        # for now, we will only accept 16 bit files and the sample rate must match
+        assert(audio_format in (1, 0xFFFE)) # PCM or WAVE_FORMAT_EXTENSIBLE
+        assert(bits == 16)
+        assert(self.sr == Audio.sample_rate)
+
+        # map only whole frames
+        self.end = data_size // (2 * self.num_channels)
+        self.data = np.memmap(filepath, dtype='<i2', mode='r', offset=data_offset,
+                              shape=(self.end * self.num_channels,))
+
+    def get_frames(self, start_frame, num_frames):
+        """
+        Gets a range of frames of audio data from the provided wavefile.
+
+        :param start_frame: The frame of the wave file to start on.
+        :param num_frames: The number of frames of the wave file to read.
+
+        :returns: A numpy array (of ``Audio.sample_dtype``) of audio data in the range [-1, 1], starting from *start_frame*
+            in the wave file. Array length is *num_frames*, but could be smaller if more frames are
+            asked for than are available.
+        """
+        samples = self.get_frames_int16(start_frame, num_frames)
+        return np.multiply(samples, 1 / 32768.0, dtype=Audio.sample_dtype)
+
+    def get_frames_int16(self, start_frame, num_frames):
+        """
+        Same as :meth:`get_frames`, but returns the raw 16 bit samples. No data is copied: the returned
+        array is a read-only view into the memory-mapped file.
+        """
+        start_sample = start_frame * self.num_channels
+        end_sample = (start_frame + num_frames) * self.num_channels
+        return self.data[start_sample : end_sample]
+
+    def get_num_channels(self):
+        """
+        :returns: The number of channels of the loaded wave file.
+        """
+        return self.num_channels
+
+    # walk the RIFF chunks to find the format and the location of the sample data.
+    # returns (data_offset, data_size, (audio_format, num_channels, sample_rate, bits_per_sample))
+    def _read_header(self, filepath):
+        params = None
+        with open(filepath, 'rb') as f:
+            riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave_id != b'WAVE':
+                raise ValueError(filepath + ' is not a wave file')
+
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError(filepath + ' has no data chunk')
+
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    fmt = struct.unpack('<HHIIHH', f.read(16))
+                    params = (fmt[0], fmt[1], fmt[2], fmt[5])
+                    f.seek(chunk_size - 16, 1)
+
+                elif chunk_id == b'data':
+                    if params is None:
+                        raise ValueError(filepath + ' has no fmt chunk')
+
+                    # some writers leave the size unset while streaming, so don't trust it past the end of file
+                    data_offset = f.tell()
+                    file_size = f.seek(0, 2)
+                    return data_offset, min(chunk_size, file_size - data_offset), params
+
+                else:
+                    f.seek(chunk_size, 1)
+
+                # chunks are padded to an even number of bytes
+                if chunk_size & 1:
+                    f.seek(1, 1)
+
+
+class WaveCache(object):
+    """
+    Process-wide, size-bounded LRU cache of decoded wave files.
+
+    Each file is decoded once into a single read-only array, keyed by (path, mtime), so editing a file
+    on disk invalidates its entry. Regions are handed out as read-only views into that array and are
+    themselves cached by (path, mtime, start, len), keeping at most *max_regions* of them (least recently
+    used first out). When the total size of the decoded arrays goes over *max_bytes*, the least recently
+    used files and their regions are dropped. Views that are still held elsewhere keep their data alive,
+    but it no longer counts against the cache.
+
+    Use the module instance ``g_wave_cache`` rather than creating your own.
+    """
+    def __init__(self, max_bytes = 256 * 1024 * 1024, max_regions = 4096):
+        """
+        :param max_bytes: The maximum number of bytes of decoded audio to keep resident.
+        :param max_regions: The maximum number of region views to keep.
+        """
+        super(WaveCache, self).__init__()
+
+        self.max_bytes = max_bytes
+        self.max_regions = max_regions
+        self.bytes_resident = 0
+        self.hits = 0
+        self.misses = 0
+
+        # (path, mtime) -> (data, num_channels), in least to most recently used order
+        self.files = OrderedDict()
+        # (path, mtime, start, len) -> view into the data of files[(path, mtime)], least to most recently used
+        self.regions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_region(self, filepath, start_frame, num_frames):
+        """
+        Gets a range of frames of a wave file, decoding the file if it is not already cached.
+
+        :param filepath: The path to the wave file. Should be a 16 bit file with a sample rate of 44100Hz.
+        :param start_frame: The frame of the wave file to start on.
+        :param num_frames: The number of frames to return. Could be smaller if more frames are asked for
+            than are available.
+
+        :returns: A tuple (data, num_channels), where data is a read-only numpy array view (of
+            ``Audio.sample_dtype``) into the decoded file.
+        """
+        path = os.path.abspath(filepath)
+        file_key = (path, os.path.getmtime(path))
+        region_key = file_key + (start_frame, num_frames)
+
+        with self.lock:
+            entry = self.files.get(file_key)
+            if entry is None:
+                self.misses += 1
+                entry = self._load(file_key)
+            else:
+                self.hits += 1
+                self.files.move_to_end(file_key)
+
+            data, num_channels = entry
+            view = self.regions.get(region_key)
+            if view is None:
+                view = data[start_frame * num_channels : (start_frame + num_frames) * num_channels]
+                self.regions[region_key] = view
+                if len(self.regions) > self.max_regions:
+                    self.regions.popitem(last=False)
+            else:
+                self.regions.move_to_end(region_key)
+            return view, num_channels
+
+    def get_stats(self):
+        """
+        :returns: A dictionary with the number of hits and misses, the number of bytes of decoded audio
+            resident, and the number of cached files and regions.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes_resident': self.bytes_resident,
+                    'files': len(self.files), 'regions': len(self.regions)}
+
+    def clear(self):
+        """
+        Drops all cached data. Stats are not reset.
+        """
+        with self.lock:
+            self.files.clear()
+            self.regions.clear()
+            self.bytes_resident = 0
+
+    # decode a whole file and add it as the most recently used entry. Must be called with the lock held.
+    def _load(self, file_key):
+        wr = WaveFile(file_key[0])
+        data = wr.get_frames(0, wr.end)
+        data.flags.writeable = False
+        entry = (data, wr.get_num_channels())
+        wr.wave.close()
+
+        self.files[file_key] = entry
+        self.bytes_resident += data.nbytes
+        self._evict()
+        return entry
+
+    # drop least recently used files (and their regions) until we fit. Always keeps the newest file.
+    def _evict(self):
+        while self.bytes_resident > self.max_bytes and len(self.files) > 1:
+            file_key, (data, num_channels) = self.files.popitem(last=False)
+            self.bytes_resident -= data.nbytes
+            for key in [k for k in self.regions if k[:2] == file_key]:
+                del self.regions[key]
+
+g_wave_cache = WaveCache()
+
+
 class WaveBuffer(object):
     """
     Reads certain data from a wave file and stores it in memory.
 
     This is a WaveSource -- a wave data providing interface. Call :meth:`get_frames()`
-    to get audio data in the format we like *(numpy array, float)*.
+    to get audio data in the format we like *(numpy array of* ``Audio.sample_dtype`` *)*.
+
+    Buffers made from a file path share their data through ``g_wave_cache``, so the stored
+    data is read-only.
     """
     def __init__(self, filepath, start_frame, num_frames):
         """
-        :param filepath: The path to the wave file. Should be a 16 bit file with a sample rate of 44100Hz.
+        :param filepath: The path to the wave file, or a file-like object (which is read directly, bypassing
+            the cache). Should be a 16 bit file with a sample rate of 44100Hz.
         :param start_frame: The frame of the wave file that this buffer should start on.
         :param num_frames: The length, in frames, this buffer should be.
         """
         super(WaveBuffer, self).__init__()
 
-        # get a local copy of the audio data from WaveFile
-        wr = WaveFile(filepath)
-        self.data = wr.get_frames(start_frame, num_frames)
-        self.num_channels = wr.get_num_channels()
+        if isinstance(filepath, (str, bytes, os.PathLike)):
+            self.data, self.num_channels = g_wave_cache.get_region(filepath, start_frame, num_frames)
+        else:
+            # get a local copy of the audio data from WaveFile
+            wr = WaveFile(filepath)
+            self.data = wr.get_frames(start_frame, num_frames)
+            self.num_channels = wr.get_num_channels()
 
     # start and end args are in units of frames,
     # so take into account num_channels when accessing sample data
@@ -146,6 +360,7 @@ class SongRegions(object):
 def make_wave_buffers(wave_path, regions_path):
     """
     Reads from a regions file and a wave file to create one WaveBuffer per region.
+    The wave file is decoded once and all buffers share views into it (see ``g_wave_cache``).
 
     :param wave_path: The path to the wave file.
     :param regions_path: The path to the text file containing one region per line.
@@ -8,7 +8,10 @@
 import numpy as np
 import os.path
 import wave
+import queue
+import threading
 from .audio import Audio
+from .wavegen import convert_channels
 
 class AudioWriter(object):
     """Class for recording audio data. To use, create an AudioWriter, and pass its method
@@ -37,8 +40,9 @@ class AudioWriter(object):
         """
         if self.active:
             # convert audio from num_channels to the # channels selected for writing
+            # (copy, since Audio reuses data for the next buffer)
             data = convert_channels(data, num_channels, self.num_channels)
-            self.buffers.append(data)
+            self.buffers.append(np.array(data))
 
     def toggle(self):
         """
@@ -89,6 +93,115 @@ class AudioWriter(object):
                 suffix += 1
 
 
+class StreamingAudioWriter(AudioWriter):
+    """Like :class:`AudioWriter`, but writes to disk while recording instead of keeping the whole take
+    in memory. Each block is converted to 16 bit in :meth:`add_audio` and handed to a background thread
+    that appends it to an open wave file. Memory use does not grow with the length of the take, and
+    :meth:`stop` only has to wait for the blocks that have not been written yet. If the disk falls more
+    than ``kMaxQueuedBlocks`` blocks behind, new blocks are dropped (and counted in *blocks_dropped*)
+    rather than queued.
+    """
+    kMaxQueuedBlocks = 256
+
+    def __init__(self, filebase, num_channels = 1):
+        """
+        :param filebase: The name of the file to output (without the extension). File extension
+            is added automatically.
+
+        :param num_channels: When writing the wave file, write with this many channels
+        """
+        super(StreamingAudioWriter, self).__init__(filebase, num_channels)
+        self.queue = None
+        self.thread = None
+        self.filename = None
+        self.blocks_dropped = 0
+
+    def add_audio(self, data, num_channels):
+        """Function to add more audio to the file being written.
+
+        :param data: the frames of audio data.
+        :param num_channels: number of channels of interleaved audio data in `data`.
+
+        """
+        # may run on the audio thread while stop() runs on another, so only look at self.queue once
+        q = self.queue
+        if self.active and q is not None:
+            data = convert_channels(data, num_channels, self.num_channels)
+            try:
+                q.put_nowait(to_int16(data).tobytes())
+            except queue.Full:
+                self.blocks_dropped += 1
+
+    def start(self):
+        """
+        Opens a new wave file and starts writing audio frames from :meth:`add_audio` into it.
+        """
+
+        if not self.active:
+            self.filename = self._get_filename('wav')
+            print('AudioWriter: start capture to', self.filename)
+
+            f = wave.open(self.filename, 'w')
+            f.setnchannels(self.num_channels)
+            f.setsampwidth(2)
+            f.setframerate(Audio.sample_rate)
+
+            self.blocks_dropped = 0
+            self.queue = queue.Queue(maxsize=StreamingAudioWriter.kMaxQueuedBlocks)
+            self.thread = threading.Thread(target=self._write_thread, args=(f, self.queue), daemon=True)
+            self.thread.start()
+            self.active = True
+
+    def stop(self):
+        """
+        Stops recording, waits for pending audio to be written, and closes the file.
+        """
+
+        if self.active:
+            print('AudioWriter: stop capture')
+            self.active = False
+
+            # tell the thread to finish up. It also writes blocks that arrive just after the None
+            q = self.queue
+            self.queue = None
+            q.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.blocks_dropped:
+                print('AudioWriter: dropped', self.blocks_dropped, 'blocks because the disk was too slow')
+            print('AudioWriter: saved', self.filename)
+
+    # runs on its own thread. Appends blocks to the file until it gets None, then writes whatever
+    # add_audio() managed to queue after that.
+    def _write_thread(self, f, q):
+        try:
+            while True:
+                data = q.get()
+                if data is None:
+                    break
+                f.writeframesraw(data)
+            while True:
+                try:
+                    data = q.get_nowait()
+                except queue.Empty:
+                    break
+                f.writeframesraw(data)
+        finally:
+            # closing fixes up the header with the final length
+            f.close()
+
+
+def to_int16(buf):
+    """Convert audio data to 16 bit samples, clipping values outside of [-1, 1]
+
+    :param buf: Buffer of audio data as a numpy float array, assuming a range of [-1, 1]
+
+    :returns: A new numpy array of type int16.
+    """
+    buf = np.clip(buf * (2**15), -2**15, 2**15 - 1)
+    return buf.astype(np.int16)
+
+
 def write_wave_file(buf, num_channels, filename):
     """Write a Wave File
 
@@ -107,42 +220,13 @@ def write_wave_file(buf, num_channels, filename):
     f.writeframes(buf.tobytes())
 
 
-# TODO move to some imslib folder
-def convert_channels(data, in_channels, out_channels):
-    """
-    Convert an audio data buffer of a given number of channels to a different number of channels.
-    Currently only handles going from mono to multi-channel, or from multi-channel to mono.
-    """
-    if in_channels == out_channels:
-        return data
-
-    # copy mono input into all output channels, interleaved
-    if in_channels == 1:
-        frames = len(data)
-        output = np.empty(frames * out_channels)
-        for c in range(out_channels):
-            output[c::out_channels] = data
-        return output
-
-    # reduce all input interleaved input channels into one mono output, averaging data
-    if out_channels == 1:
-        frames = len(data) // in_channels
-        in_data = np.empty((in_channels, frames))
-        for c in range(in_channels):
-            in_data[c] = data[c::in_channels]
-        return in_data.mean(axis=0)
-
-    else:
-        assert("can't convert unless input or output is mono")
-
-
 # create single buffer from an array of buffers:
 def combine_buffers(buffers):
     """Concatenates a list of numpy arrays into a single numpy array
 
     :param buffers: A list of numpy arrays
 
-    :returns: A concatenated numpy float array with length being the sum of lengths of
+    :returns: A concatenated numpy array (of ``Audio.sample_dtype``) with length being the sum of lengths of
         arrays in input buffers.
 
     """
@@ -151,7 +235,7 @@ def combine_buffers(buffers):
         size += len(b)
 
     # create a single output buffer of the right size
-    output = np.empty( size, dtype=float)
+    output = np.empty( size, dtype=Audio.sample_dtype)
     f = 0
     for b in buffers:
         output[f:f+len(b)] = b
@@ -16,9 +16,10 @@ sys.path.insert(0, os.path.abspath('..'))
 from imslib.core import BaseWidget, run, lookup
 from imslib.audio import Audio
 from imslib.mixer import Mixer
+from imslib.clock import SongClock
 from imslib.wavegen import WaveGenerator
 from imslib.wavesrc import WaveFile
-from imslib.gfxutil import topleft_label, resize_topleft_label, CLabelRect
+from imslib.gfxutil import topleft_label, resize_topleft_label, CLabelRect, ScrollingTrack
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
@@ -76,12 +77,11 @@ from kivy.core.window import Window
 #         to screen position. When this works, you should play the song and see the beat markers flowing down.
 #         Then, play around with the constants below to see how these affect the display.
 #
-# Part 5: Right now, all BeatDisplays are being drawn all the time, even though most are off-screen.
-#         Optimize your code so that BeatDisplay is only drawn (ie, is added to canvas) when it is
-#         actually visible on screen. This requires two steps: 1) BeatDisplay.on_update() should
-#         return True if the BeatDisplay is visible, False otherwise. 2) When GameDisplay.on_update()
-#         updates the BeatDisplays, use the return value to add or remove the BeatDisplay.
-#         Hint: You can test if object 'obj' is in the instruction group's draw list with: obj in self.children
+# Part 5: Only BeatDisplays that are visible on screen should be drawn (ie, added to canvas).
+#         GameDisplay uses a ScrollingTrack (see imslib.gfxutil) for this: given how many seconds
+#         of the song fit above and below the nowbar, it adds each BeatDisplay when its time comes
+#         on screen, removes it when it leaves, and only calls on_update() on the visible ones.
+#         So BeatDisplay.on_update() just positions the line; it does not report visibility.
 #
 # Part 6 (optional): use CLabelRect to add a number (the beat-number) to appear next to the beat line.
 
@@ -130,7 +130,6 @@ class MainWidget(BaseWidget):
         self.info.text += f'num objects: {self.display.get_num_object()}'
 
 
-
 # Handles everything about Audio.
 #   creates the main python Audio object
 #   load song track
@@ -149,14 +148,16 @@ class AudioController(object):
         # start paused
         self.track.pause()
 
+        # estimates the song time that is heard right now
+        self.song_clock = SongClock(self.audio, self.track)
+
     # start / stop the song
     def toggle(self):
         self.track.play_toggle()
         
     # return current time (in seconds) of song
     def get_time(self):
-        # TODO write this
-        return self.track.frame / Audio.sample_rate
+        return self.song_clock.get_time()
 
     # needed to update audio
     def on_update(self):
@@ -218,7 +219,6 @@ class BeatDisplay(InstructionGroup):
 
         self.line.points = [left_x, y_pos, right_x, y_pos]
 
-        return 0 <= y_pos <= Window.height
 
 # Displays game elements: nowbar and beats:
 class GameDisplay(InstructionGroup):
@@ -226,9 +226,11 @@ class GameDisplay(InstructionGroup):
         super(GameDisplay, self).__init__()
         self.beat_data = song_data.get_beats()
 
+        # only beats on screen (from the bottom of the window to the top) are drawn and updated
         self.beats = [BeatDisplay(*b) for b in self.beat_data]
-        for b in self.beats:
-            self.add(b)
+        seconds_behind = time_span * nowbar_h / (1 - nowbar_h)
+        self.beat_track = ScrollingTrack(time_span, seconds_behind, self.beats)
+        self.add(self.beat_track)
 
         # TODO write code to draw the nowbar here (make it a white line)
         self.nowbar = Line(width = 3)
@@ -256,23 +258,13 @@ class GameDisplay(InstructionGroup):
         nowbar_y = Window.height * nowbar_h
         self.nowbar.points = [left_margin, nowbar_y, right_margin, nowbar_y]
 
-
     def get_num_object(self):
-        return len(self.children)
+        return self.beat_track.get_num_active()
 
     # call every frame to handle animation needs. The value now_time is in seconds
     # and is an absolute time position (not a delta time)
     def on_update(self, now_time):
-        for b in self.beats:
-            vis = b.on_update(now_time)
-
-            if vis and b not in self.children:
-                self.add(b)
-            elif not vis and b in self.children:
-                self.remove(b)
-            
-            # TODO write optimization code here
-            
+        self.beat_track.on_update(now_time)
 
 
 if __name__ == "__main__":
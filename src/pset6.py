@@ -8,13 +8,19 @@
 import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 
+import numpy as np
+
+from pset6_player import SongData, Player
+
 from imslib.core import BaseWidget, run, lookup
 from imslib.audio import Audio
 from imslib.mixer import Mixer
+from imslib.clock import SongClock
 from imslib.note import NoteGenerator
 from imslib.wavegen import WaveGenerator
-from imslib.wavesrc import WaveBuffer, WaveFile
-from imslib.gfxutil import topleft_label, resize_topleft_label
+from imslib.wavesrc import MappedWaveFile
+from imslib.gfxutil import topleft_label, resize_topleft_label, DisplayPool, PooledScrollingTrack, \
+    ShapeBatch, circle_template, ring_template
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
@@ -114,11 +120,11 @@ class AudioController(object):
         self.audio.set_generator(self.mixer)
 
         # (Background track)
-        self.bg_track = WaveGenerator(WaveFile(song_path + "_bg.wav"))
+        self.bg_track = WaveGenerator(MappedWaveFile(song_path + "_bg.wav"))
         self.mixer.add(self.bg_track)
 
         # (Guitar solo)
-        self.solo_track = WaveGenerator(WaveFile(song_path + "_solo.wav"))
+        self.solo_track = WaveGenerator(MappedWaveFile(song_path + "_solo.wav"))
         self.mixer.add(self.solo_track)
 
         # (Sq. wave denoting miss)
@@ -129,6 +135,9 @@ class AudioController(object):
         self.solo_track.pause()
         self.solo_muted = False
         self.solo_gain = 1.0
+
+        # (Latency-compensated, smoothed song time)
+        self.song_clock = SongClock(self.audio, self.bg_track)
         
     # start / stop the song
     def toggle(self):
@@ -156,167 +165,137 @@ class AudioController(object):
         self.mixer.add(miss_sound)
         Clock.schedule_once(lambda dt: miss_sound.note_off(), 0.2)
 
-    # return current time (in seconds) of song
+    # return current time (in seconds) of song, as heard (see SongClock)
     def get_time(self):
-        return self.bg_track.frame / float(Audio.sample_rate)
+        return self.song_clock.get_time()
 
     # needed to update audio
     def on_update(self):
         self.audio.on_update()
 
 
-# Holds data for gems and downbeats.
-class SongData(object):
-    def __init__(self, gems_filepath, downbeats_filepath):
-        super(SongData, self).__init__()
+# A downbeat in the chart. Displays are bound to entries only while they are on screen.
+class ChartEntry(object):
+    def __init__(self, time):
+        super(ChartEntry, self).__init__()
+        self.time = time
 
-        # (Populated from our Sonic Vis. annotations)
-        self.gems = []
-        self.downbeats = []
 
-        self._parse_gems(gems_filepath)
-        self._parse_downbeats(downbeats_filepath)
-        
-    def _parse_gems(self, filepath):
-        # (Parse gem annotations from Sonic Vis.)
-        with open(filepath, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 2:
-                    # (Index 0 is time)
-                    time = float(parts[0])
-                    # (Index 1 is lane)
-                    lane = int(parts[1])
-                    self.gems.append((time, lane))
-    
-    def _parse_downbeats(self, filepath):
-        # (Parse downbeat annotations from Sonic Vis.)
-        with open(filepath, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 1:
-                    # (In this case, we only care about 0 index: time)
-                    time = float(parts[0])
-                    self.downbeats.append(time)
-
-    def get_gems(self):
-        return self.gems
-    
-    def get_downbeats(self):
-        return self.downbeats
-        
-# Display for a single gem at a position with a hue or color
-class GemDisplay(InstructionGroup):
-    def __init__(self, lane, time, color):
-        super(GemDisplay, self).__init__()
+# gem states, stored per gem in GameDisplay.gem_states
+kGemNormal = 0
+kGemHit = 1
+kGemPass = 2
 
-        self.lane = lane # (1-5)
-        self.time = time
-        self.state = 'normal' # (Can be 'normal', 'hit', or 'pass')
+# convert the time of a gem or bar (relative to now) to a y position. Works on numpy arrays too.
+def time_to_ypos(time_diff):
+    window_height = Window.height
+    seconds_on_screen = 2.0
+    nowbar_pos_y = window_height * 0.2
+    return nowbar_pos_y + (time_diff / seconds_on_screen) * (window_height - nowbar_pos_y)
 
-        # (Color, shape init.)
-        self.color = Color(*color)
-        self.add(self.color)
-        self.gem = Ellipse(size=(30, 30))
-        self.add(self.gem)
+# x position of the center of a lane
+def lane_to_xpos(lane):
+    num_lanes = 5
+    lane_width = Window.width / (num_lanes + 1)
+    return lane * lane_width
 
-        # (Border init.)
-        self.border_color = Color(1, 1, 1, 0.7)
-        self.add(self.border_color)
-        self.border = Line(width=2, circle=(0, 0, 15, 0, 360))
-        self.add(self.border)
 
-        # (Hit metadata)
-        self.hit_effect = None
-        self.hit_alpha = None
+# Displays all gems of one lane. Instead of one Ellipse + Line per gem, each gem state (normal, hit, pass)
+# has a fill mesh and a border mesh holding all of the visible gems in that state, so the cost of
+# drawing a lane does not depend on how many gems are on screen.
+class LaneGemDisplay(InstructionGroup):
+    def __init__(self, lane, color, times, gem_idxs, gem_states):
+        super(LaneGemDisplay, self).__init__()
+
+        # (Sorted gem times of this lane, their indices, and the states of all gems)
+        self.lane = lane
+        self.times = times
+        self.gem_idxs = gem_idxs
+        self.gem_states = gem_states
+
+        # (One fill + border batch per state, in drawing order)
+        fill = circle_template(15)
+        border = ring_template(14, 16)
+        self.batches = []
+        for state, fill_color, border_color in ((kGemPass, (0.5, 0.5, 0.5), (1, 1, 1, 0.3)),
+                                                (kGemNormal, color, (1, 1, 1, 0.7)),
+                                                (kGemHit, (1, 1, 1), (1, 1, 1, 0.7))):
+            fill_batch = ShapeBatch(fill, fill_color)
+            border_batch = ShapeBatch(border, border_color)
+            self.add(fill_batch)
+            self.add(border_batch)
+            self.batches.append((state, fill_batch, border_batch))
+
+    # position all visible gems based on current time
+    def on_update(self, now_time):
+        seconds_ahead = 2.0
+        seconds_behind = 0.5
+
+        # (Visible gems of this lane, and where they are)
+        start, end = np.searchsorted(self.times, (now_time - seconds_behind, now_time + seconds_ahead))
+        y_pos = time_to_ypos(self.times[start:end] - now_time)
+        states = self.gem_states[self.gem_idxs[start:end]]
+        x_pos = lane_to_xpos(self.lane)
+
+        for state, fill_batch, border_batch in self.batches:
+            ys = y_pos[states == state]
+            fill_batch.set_centers(x_pos, ys)
+            border_batch.set_centers(x_pos, ys)
+
+
+# Expanding ring shown when a gem is hit. Follows the gem as it scrolls.
+# Pooled: call bind() to start the effect for a gem.
+class GemHitEffect(InstructionGroup):
+    def __init__(self):
+        super(GemHitEffect, self).__init__()
+
+        self.lane = 0
+        self.time = 0
         self.hit_time = 0
 
-        self.anim = None
-        
-    # change to display this gem being hit
-    def on_hit(self):
-        if self.state == 'normal':
-            self.state = 'hit'
-
-            # (Change to white)
-            self.color.rgb = (1, 1, 1)
-            if self.hit_effect is None:
-                # (Edit alpha + border)
-                self.hit_alpha = Color(1, 1, 1, 0.8)
-                self.add(self.hit_alpha)
-                self.hit_effect = Line(width=2, circle=(0, 0, 20, 0, 360))
-                self.add(self.hit_effect)
-            
-            self.hit_time = 0
-            
-    # change to display a passed or missed gem
-    def on_pass(self):
-        if self.state == 'normal':
-            self.state = 'pass'
-            # (Grey out the gem and make more transparent)
-            self.color.rgb = (0.5, 0.5, 0.5)
-            self.border_color.a = 0.3
+        self.color = Color(1, 1, 1, 0.8)
+        self.add(self.color)
+        self.ring = Line(width=2)
+        self.add(self.ring)
 
-            
-    # animate gem (position and animation) based on current time
-    def on_update(self, now_time):
-        # (Take y position as a differential from nowbar)
-        time_diff = self.time - now_time
-        window_height = Window.height
-        seconds_on_screen = 2.0
-        nowbar_pos_y = window_height * 0.2
-        y_pos = nowbar_pos_y + (time_diff / seconds_on_screen) * (window_height - nowbar_pos_y)
-
-        # (X pos. can be taken from window width / lanes)
-        num_lanes = 5
-        lane_width = Window.width / (num_lanes + 1)
-        x_pos = self.lane * lane_width
-        gem_size = self.gem.size
-        self.gem.pos = (x_pos - gem_size[0]/2, y_pos - gem_size[1]/2)
-        self.border.circle = (x_pos, y_pos, 15, 0, 360)
-
-        # (Trigger anim if we haven't yet nullified hit_effect)
-        if self.state == 'hit' and self.hit_effect is not None:
-            self.hit_time += 1/60.0
-            size = 15 + 30 * self.hit_time
-            self.hit_alpha.a = max(0, 0.8 - self.hit_time * 2)
-            self.hit_effect.circle = (x_pos, y_pos, size, 0, 360)
-
-            # (Nullify hit effect if anim. has faded to 0)
-            if self.hit_alpha.a <= 0:
-                self.remove(self.hit_alpha)
-                self.remove(self.hit_effect)
-                self.hit_effect = None
-                self.hit_alpha = None
-        
-        return 0 <= y_pos <= window_height
+    def bind(self, lane, time):
+        self.lane = lane
+        self.time = time
+        self.hit_time = 0
+        self.color.a = 0.8
+
+    # returns False when the effect has faded out
+    def on_update(self, now_time, dt):
+        self.hit_time += dt
+        size = 15 + 30 * self.hit_time
+        self.color.a = max(0, 0.8 - self.hit_time * 2)
+        self.ring.circle = (lane_to_xpos(self.lane), time_to_ypos(self.time - now_time), size, 0, 360)
+        return self.color.a > 0
 
         
-# Displays the location of a downbeat in the song
+# Displays the location of a downbeat in the song.
+# Pooled: call bind() to show a ChartEntry.
 class DownbeatDisplay(InstructionGroup):
-    def __init__(self, time):
+    def __init__(self):
         super(DownbeatDisplay, self).__init__()
 
         # (Kivy line init.)
-        self.time = time
+        self.time = 0
         self.color = Color(0.8, 0.8, 0.8)
         self.add(self.color)
         self.line = Line(width=1)
         self.add(self.line)
+
+    def bind(self, entry):
+        self.time = entry.time
         
-    # animate the position based on current time
+    # animate the position based on current time. (Visibility is handled by the track that owns this display)
     def on_update(self, now_time):
-        # (Use time differential to take updated y pos.)
-        time_diff = self.time - now_time
-        window_height = Window.height
+        y_pos = time_to_ypos(self.time - now_time)
         window_width = Window.width
-        seconds_on_screen = 2.0
-        nowbar_pos_y = window_height * 0.2
-        y_pos = nowbar_pos_y + (time_diff / seconds_on_screen) * (window_height - nowbar_pos_y)
         margin = window_width * 0.1
         # (Update points on line using updated y pos.)
         self.line.points = [margin, y_pos, window_width - margin, y_pos]
-        return 0 <= y_pos <= window_height
         
 
 # Displays one button on the nowbar
@@ -416,17 +395,28 @@ class GameDisplay(InstructionGroup):
             self.add(button)
             self.buttons.append(button)
 
-        # (Gems init.)
-        self.gems = []
-        for time, lane in song_data.get_gems():
-            gem = GemDisplay(lane, time, self.lane_colors[lane-1])
-            self.gems.append(gem)
+        # (Chart entries for downbeats. These are only data: no graphics are created here)
+        self.downbeats = [ChartEntry(time) for time in song_data.get_downbeats()]
 
-        # (Downbeat bars init.)
-        self.downbeats = []
-        for time in song_data.get_downbeats():
-            downbeat = DownbeatDisplay(time)
-            self.downbeats.append(downbeat)
+        # (Only entries within [now - 0.5, now + 2.0] are drawn, using displays recycled from a pool)
+        seconds_ahead = 2.0
+        seconds_behind = 0.5
+        self.downbeat_track = PooledScrollingTrack(seconds_ahead, seconds_behind, DisplayPool(DownbeatDisplay), self.downbeats)
+        self.add(self.downbeat_track)
+
+        # (Gems are drawn in batches, one display per lane)
+        self.gems = song_data.get_gems()
+        self.gem_states = np.full(len(self.gems), kGemNormal, dtype=np.int8)
+        self.lane_gems = []
+        for lane in song_data.get_lanes():
+            times, gem_idxs = song_data.get_lane(lane)
+            lane_gems = LaneGemDisplay(lane, self.lane_colors[lane-1], times, gem_idxs, self.gem_states)
+            self.add(lane_gems)
+            self.lane_gems.append(lane_gems)
+
+        # (Hit effects in progress. Finished ones go back to the pool to be reused)
+        self.hit_effects = []
+        self.hit_effect_pool = DisplayPool(GemHitEffect)
 
         self.score = 0
 
@@ -435,13 +425,18 @@ class GameDisplay(InstructionGroup):
             
     # called by Player when succeeded in hitting this gem.
     def gem_hit(self, gem_idx):
-        if 0 <= gem_idx < len(self.gems):
-            self.gems[gem_idx].on_hit()
+        if 0 <= gem_idx < len(self.gems) and self.gem_states[gem_idx] == kGemNormal:
+            self.gem_states[gem_idx] = kGemHit
+            time, lane = self.gems[gem_idx]
+            effect = self.hit_effect_pool.get()
+            effect.bind(lane, time)
+            self.add(effect)
+            self.hit_effects.append(effect)
 
     # called by Player on pass or miss.
     def gem_pass(self, gem_idx):
-        if 0 <= gem_idx < len(self.gems):
-            self.gems[gem_idx].on_pass()
+        if 0 <= gem_idx < len(self.gems) and self.gem_states[gem_idx] == kGemNormal:
+            self.gem_states[gem_idx] = kGemPass
 
     # called by Player on button down
     def on_button_down(self, lane):
@@ -472,113 +467,23 @@ class GameDisplay(InstructionGroup):
         
     # call every frame to handle animation needs
     def on_update(self, now_time):
-        seconds_ahead = 2.0
-        seconds_behind = 0.5
-
-        for i, gem in enumerate(self.gems):
-            gem_time = gem.time
-
-            # (If our gem should be spawned at the top, add it to our gems)
-            if now_time - seconds_behind <= gem_time <= now_time + seconds_ahead:
-                if gem not in self.children:
-                    self.add(gem)
-
-                visible = gem.on_update(now_time)
-
-                if not visible and gem in self.children:
-                    # (Conversely, if it's disappeared below the screen, remove it)
-                    self.remove(gem)
-
-            elif gem_time < now_time - seconds_behind and gem in self.children:
-                self.remove(gem)
-
-
-        for i, downbeat in enumerate(self.downbeats):
-            # (Proceed identically for downbeats: if it should be spawned, do so)
-            downbeat_time = downbeat.time
-            
-            if now_time - seconds_behind <= downbeat_time <= now_time + seconds_ahead:
-                if downbeat not in self.children:
-                    self.add(downbeat)
-                
-                visible = downbeat.on_update(now_time)
-                
-                if not visible and downbeat in self.children:
-                    # (And if it should be removed, do so)
-                    self.remove(downbeat)
-            
-            elif downbeat_time < now_time - seconds_behind and downbeat in self.children:
-                self.remove(downbeat)
-            
-
-# Handles game logic and keeps track of score.
-# Controls the GameDisplay and AudioCtrl based on what happens
-class Player(object):
-    def __init__(self, song_data, audio_ctrl, display):
-        super(Player, self).__init__()
-        # (Audio data + control init.)
-        self.song_data = song_data
-        self.audio_ctrl = audio_ctrl
-        self.display = display
-
-        # (Other metadata)
-        self.slop_window = 0.1
-        self.score = 0
-        self.combo = 0
-
-        self.gem_status = {} # (gem_idx -> status (None, 'hit', 'miss', 'pass'))
-        for idx, _ in enumerate(self.song_data.get_gems()):
-            self.gem_status[idx] = None
-
-    # called by MainWidget
-    def on_button_down(self, lane):
-        now_time = self.audio_ctrl.get_time()
-        valid_gems = []
-        # (Attempt to strike gem)
-        for idx, (time, gem_lane) in enumerate(self.song_data.get_gems()):
-            if self.gem_status[idx] is None:
-                if abs(time - now_time) < self.slop_window:
-                    valid_gems.append((idx, gem_lane, abs(time - now_time)))
-
-        # (If no gems are currently valid, miss by default)
-        if not valid_gems:
-            self.audio_ctrl.play_miss()
-            self.audio_ctrl.set_mute(True)
-            self.combo = 0
-            return
-
-        # (Dictate hit or miss based on closest lane)
-        valid_gems.sort(key=lambda x: x[2])
-        closest_idx, closest_lane, _ = valid_gems[0]
-
-        if closest_lane == lane:
-            # (Hit)
-            self.gem_status[closest_idx] = 'hit'
-            self.display.gem_hit(closest_idx)
-            self.audio_ctrl.set_mute(False)
-
-            self.combo += 1
-            self.score += 100 * self.combo
-            self.display.set_score(self.score)
-        else:
-            # (Miss)
-            self.gem_status[closest_idx] = 'miss'
-            self.display.gem_pass(closest_idx)
-            self.audio_ctrl.play_miss()
-            self.audio_ctrl.set_mute(True)
-            self.combo = 0
-                    
-    # called by MainWidget
-    def on_button_up(self, lane):
-        self.display.on_button_up(lane)
-
-    # needed to check for pass gems (ie, went past the slop window)
-    def on_update(self, time):
-        for idx, (gem_time, _) in enumerate(self.song_data.get_gems()):
-            if self.gem_status[idx] is None and (time - gem_time) > self.slop_window:
-                self.gem_status[idx] = 'pass'
-                self.display.gem_pass(idx)
-                self.audio_ctrl.set_mute(True)
+        # (Track adds, removes and updates only the downbeats near now_time)
+        self.downbeat_track.on_update(now_time)
+
+        # (Gem batches update all visible gems of a lane at once)
+        for lane_gems in self.lane_gems:
+            lane_gems.on_update(now_time)
+
+        # (Hit effects animate by the real time of this frame)
+        dt = Clock.frametime
+        alive = []
+        for effect in self.hit_effects:
+            if effect.on_update(now_time, dt):
+                alive.append(effect)
+            else:
+                self.remove(effect)
+                self.hit_effect_pool.put(effect)
+        self.hit_effects = alive
 
 
 if __name__ == "__main__":
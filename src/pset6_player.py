@@ -0,0 +1,326 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+# Game logic of pset6 (song data, hit and pass detection). Kept free of kivy and audio imports so it can be
+# benchmarked headless.
+
+import time
+import random
+import numpy as np
+from bisect import bisect_left
+
+
+# Holds data for gems and downbeats.
+class SongData(object):
+    def __init__(self, gems_filepath, downbeats_filepath):
+        super(SongData, self).__init__()
+
+        # (Populated from our Sonic Vis. annotations)
+        self.gems = []
+        self.downbeats = []
+
+        if gems_filepath:
+            self._parse_gems(gems_filepath)
+        if downbeats_filepath:
+            self._parse_downbeats(downbeats_filepath)
+        
+    def _parse_gems(self, filepath):
+        # (Parse gem annotations from Sonic Vis.)
+        gems = []
+        with open(filepath, 'r') as f:
+            for line in f:
+                parts = line.strip().split('\t')
+                if len(parts) >= 2:
+                    # (Index 0 is time)
+                    time = float(parts[0])
+                    # (Index 1 is lane)
+                    lane = int(parts[1])
+                    gems.append((time, lane))
+        self.set_gems(gems)
+
+    # (Store gems sorted by time, and index them per lane)
+    def set_gems(self, gems):
+        self.gems = sorted(gems, key=lambda g: g[0])
+
+        # (lane -> sorted array of gem times, and the matching indices into self.gems)
+        self.lane_times = {}
+        self.lane_gems = {}
+        lanes = np.array([lane for _, lane in self.gems], dtype=int)
+        times = np.array([time for time, _ in self.gems], dtype=float)
+        for lane in np.unique(lanes):
+            idxs = np.flatnonzero(lanes == lane)
+            self.lane_times[int(lane)] = times[idxs]
+            self.lane_gems[int(lane)] = idxs
+    
+    def _parse_downbeats(self, filepath):
+        # (Parse downbeat annotations from Sonic Vis.)
+        with open(filepath, 'r') as f:
+            for line in f:
+                parts = line.strip().split('\t')
+                if len(parts) >= 1:
+                    # (In this case, we only care about 0 index: time)
+                    time = float(parts[0])
+                    self.downbeats.append(time)
+
+    def get_gems(self):
+        return self.gems
+
+    # (Sorted times of gems in one lane, and their indices into get_gems())
+    def get_lane(self, lane):
+        return self.lane_times[lane], self.lane_gems[lane]
+
+    def get_lanes(self):
+        return list(self.lane_times.keys())
+    
+    def get_downbeats(self):
+        return self.downbeats
+
+
+# Handles game logic and keeps track of score.
+# Controls the GameDisplay and AudioCtrl based on what happens
+class Player(object):
+    def __init__(self, song_data, audio_ctrl, display):
+        super(Player, self).__init__()
+        # (Audio data + control init.)
+        self.song_data = song_data
+        self.audio_ctrl = audio_ctrl
+        self.display = display
+
+        # (Other metadata)
+        self.slop_window = 0.1
+        self.score = 0
+        self.combo = 0
+
+        self.gem_status = [None] * len(self.song_data.get_gems()) # (gem_idx -> status (None, 'hit', 'miss', 'pass'))
+
+        # (Per lane: position of the next unresolved gem. Everything before it is resolved)
+        self.cursors = {lane: 0 for lane in self.song_data.get_lanes()}
+
+    # called by MainWidget
+    def on_button_down(self, lane):
+        now_time = self.audio_ctrl.get_time()
+
+        # (Attempt to strike gem: find the closest unresolved gem of each lane within the window)
+        closest = None
+        for gem_lane in self.cursors:
+            found = self._find_closest(gem_lane, now_time)
+            # (Ties, like gems of a chord, go to the earliest gem in the chart)
+            if found and (closest is None or (found[2], found[0]) < (closest[2], closest[0])):
+                closest = found
+
+        # (If no gems are currently valid, miss by default)
+        if closest is None:
+            self.audio_ctrl.play_miss()
+            self.audio_ctrl.set_mute(True)
+            self.combo = 0
+            return
+
+        # (Dictate hit or miss based on closest lane)
+        closest_idx, closest_lane, _ = closest
+
+        if closest_lane == lane:
+            # (Hit)
+            self.gem_status[closest_idx] = 'hit'
+            self.display.gem_hit(closest_idx)
+            self.audio_ctrl.set_mute(False)
+
+            self.combo += 1
+            self.score += 100 * self.combo
+            self.display.set_score(self.score)
+        else:
+            # (Miss)
+            self.gem_status[closest_idx] = 'miss'
+            self.display.gem_pass(closest_idx)
+            self.audio_ctrl.play_miss()
+            self.audio_ctrl.set_mute(True)
+            self.combo = 0
+                    
+    # called by MainWidget
+    def on_button_up(self, lane):
+        self.display.on_button_up(lane)
+
+    # needed to check for pass gems (ie, went past the slop window)
+    def on_update(self, time):
+        # (Only gems at the front of each lane can have passed)
+        for lane in self.cursors:
+            times, gems = self.song_data.get_lane(lane)
+            cursor = self._advance_cursor(lane)
+            while cursor < len(times) and (time - times[cursor]) > self.slop_window:
+                idx = gems[cursor]
+                if self.gem_status[idx] is None:
+                    self.gem_status[idx] = 'pass'
+                    self.display.gem_pass(idx)
+                    self.audio_ctrl.set_mute(True)
+                cursor += 1
+            self.cursors[lane] = cursor
+
+    # (Skip over resolved gems at the front of a lane, and return the new cursor)
+    def _advance_cursor(self, lane):
+        gems = self.song_data.get_lane(lane)[1]
+        cursor = self.cursors[lane]
+        while cursor < len(gems) and self.gem_status[gems[cursor]] is not None:
+            cursor += 1
+        self.cursors[lane] = cursor
+        return cursor
+
+    # (Returns (gem_idx, lane, distance) of the closest unresolved gem in this lane within the slop window, or None)
+    def _find_closest(self, lane, now_time):
+        times, gems = self.song_data.get_lane(lane)
+        start = max(self._advance_cursor(lane), bisect_left(times, now_time - self.slop_window))
+
+        closest = None
+        for i in range(start, len(times)):
+            if times[i] - now_time >= self.slop_window:
+                break
+            dist = abs(times[i] - now_time)
+            idx = gems[i]
+            if self.gem_status[idx] is None and dist < self.slop_window and (closest is None or dist < closest[2]):
+                closest = (idx, lane, dist)
+        return closest
+
+
+# Measures Player hit and pass detection on a long chart, without a window. Run with: python pset6_player.py
+def benchmark_player(num_gems = 100000, num_presses = 20000):
+    # (Stand-ins for audio and display, so that only Player is measured)
+    class BenchAudioCtrl(object):
+        def __init__(self):
+            self.time = 0
+        def get_time(self):
+            return self.time
+        def play_miss(self):
+            pass
+        def set_mute(self, mute):
+            pass
+
+    class BenchDisplay(object):
+        def gem_hit(self, gem_idx):
+            pass
+        def gem_pass(self, gem_idx):
+            pass
+        def set_score(self, score):
+            pass
+
+    # (Gems every 50ms on random lanes)
+    rng = random.Random(1)
+    song_data = SongData(None, None)
+    song_data.set_gems([(0.05 * i, rng.randint(1, 5)) for i in range(num_gems)])
+    song_len = 0.05 * num_gems
+
+    audio_ctrl = BenchAudioCtrl()
+    player = Player(song_data, audio_ctrl, BenchDisplay())
+
+    # (Play through the song at 60fps, pressing buttons at random times)
+    press_times = sorted(rng.uniform(0, song_len) for _ in range(num_presses))
+    num_frames = int(song_len * 60)
+    update_time = 0
+    press_time = 0
+    p = 0
+    for f in range(num_frames):
+        audio_ctrl.time = f / 60.
+        while p < len(press_times) and press_times[p] <= audio_ctrl.time:
+            t_start = time.perf_counter()
+            player.on_button_down(rng.randint(1, 5))
+            press_time += time.perf_counter() - t_start
+            p += 1
+
+        t_start = time.perf_counter()
+        player.on_update(audio_ctrl.time)
+        update_time += time.perf_counter() - t_start
+
+    print(f'{num_gems} gems, {num_frames} frames, {p} presses')
+    print(f'on_update:      {1e6 * update_time / num_frames:.2f} us per frame')
+    print(f'on_button_down: {1e6 * press_time / p:.2f} us per press')
+
+
+# Checks that Player resolves gems exactly like a plain scan over all gems (the original implementation),
+# on random charts with chords (several gems at the same time). Run with: python pset6_player.py
+def check_player(num_runs = 300, num_gems = 200, num_presses = 150):
+    # (Records what Player tells the display and audio, so runs can be compared)
+    class RecordingCtrl(object):
+        def __init__(self):
+            self.time = 0
+            self.events = []
+        def get_time(self):
+            return self.time
+        def play_miss(self):
+            self.events.append(('miss_sound',))
+        def set_mute(self, mute):
+            self.events.append(('mute', mute))
+        def gem_hit(self, gem_idx):
+            self.events.append(('hit', gem_idx))
+        def gem_pass(self, gem_idx):
+            self.events.append(('pass', gem_idx))
+        def set_score(self, score):
+            self.events.append(('score', score))
+
+    # (Reference: linear scan, closest gem first, ties to the lowest gem index)
+    class ScanPlayer(Player):
+        def on_button_down(self, lane):
+            now_time = self.audio_ctrl.get_time()
+            valid = [(abs(t - now_time), idx, gem_lane) for idx, (t, gem_lane) in enumerate(self.song_data.get_gems())
+                     if self.gem_status[idx] is None and abs(t - now_time) < self.slop_window]
+            if not valid:
+                self.audio_ctrl.play_miss()
+                self.audio_ctrl.set_mute(True)
+                self.combo = 0
+                return
+            _, idx, gem_lane = min(valid)
+            if gem_lane == lane:
+                self.gem_status[idx] = 'hit'
+                self.display.gem_hit(idx)
+                self.audio_ctrl.set_mute(False)
+                self.combo += 1
+                self.score += 100 * self.combo
+                self.display.set_score(self.score)
+            else:
+                self.gem_status[idx] = 'miss'
+                self.display.gem_pass(idx)
+                self.audio_ctrl.play_miss()
+                self.audio_ctrl.set_mute(True)
+                self.combo = 0
+
+        def on_update(self, time):
+            for idx, (t, _) in enumerate(self.song_data.get_gems()):
+                if self.gem_status[idx] is None and (time - t) > self.slop_window:
+                    self.gem_status[idx] = 'pass'
+                    self.display.gem_pass(idx)
+                    self.audio_ctrl.set_mute(True)
+
+    rng = random.Random(2)
+    mismatches = 0
+    for run in range(num_runs):
+        # (Gems on a 50ms grid, so many share a time and form chords)
+        gems = [(0.05 * rng.randint(0, num_gems // 2), rng.randint(1, 5)) for _ in range(num_gems)]
+        song_data = SongData(None, None)
+        song_data.set_gems(gems)
+        song_len = 0.05 * (num_gems // 2) + 0.5
+        presses = sorted((rng.uniform(0, song_len), rng.randint(1, 5)) for _ in range(num_presses))
+
+        results = []
+        for player_class in (Player, ScanPlayer):
+            ctrl = RecordingCtrl()
+            player = player_class(song_data, ctrl, ctrl)
+            p = 0
+            for f in range(int(song_len * 60)):
+                ctrl.time = f / 60.
+                while p < len(presses) and presses[p][0] <= ctrl.time:
+                    player.on_button_down(presses[p][1])
+                    p += 1
+                player.on_update(ctrl.time)
+            # (Passes are reported per lane by Player, so compare them as a set)
+            results.append((player.score, player.gem_status,
+                            [e for e in ctrl.events if e[0] != 'pass'], sorted(e for e in ctrl.events if e[0] == 'pass')))
+        if results[0] != results[1]:
+            mismatches += 1
+
+    print(f'check_player: {mismatches} of {num_runs} random charts with chords differ from a full scan')
+    return mismatches == 0
+
+
+if __name__ == "__main__":
+    check_player()
+    benchmark_player()